@@ -9,10 +9,25 @@ class LSTMConfig:
     GLOVE_EMBEDDING_SIZE = 300
     # Paragramcf word embedding settings
     PARAGRAMCF_DIR = '/vol/bitbucket/fh422/paragramcf'
+    # Binary cache of the GloVe / paragramcf vectors (utils/embedding_store.py), None for the embedding folder
+    EMBEDDING_CACHE_DIR = None
+    # Compact vocabulary from utils/prune_embeddings.py, None for the full embedding
+    PRUNED_EMBEDDING_DIR = None
+    # Top-k counter-fitted neighbours built by utils/synonym_index.py, None to use nn.npy
+    SYNONYM_INDEX_DIR = None
 
     NUM_EPOCHS = 50
     MAX_SEQ_LENGTH = 150
     BATCH_SIZE = 200
+    # DataLoader settings (utils/data_pipeline.py)
+    NUM_WORKERS = 4  # processes that tokenize ahead of the model, 0 for the main process
+    PREFETCH_FACTOR = 2  # batches prefetched by each worker
+    PERSISTENT_WORKERS = True  # keep the workers alive between epochs
+    PIN_MEMORY = True  # page-locked batches for asynchronous copies to the GPU
+    # Split every batch into micro-batches with accumulated gradients (standard training), None for BATCH_SIZE
+    MICRO_BATCH_SIZE = None
+    # Pick MICRO_BATCH_SIZE to train within this peak RSS (utils/memory_budget.py)
+    MEMORY_BUDGET_MB = None
     LEARNING_RATE = 0.001
 
     USE_ADAMW = False
@@ -26,6 +41,19 @@ class LSTMConfig:
     LABEL_SMOOTHING = False
     LABEL_SMOOTHING_EPSILON = 0.1  # 0 means no smoothing
 
+    # Embedding-space adversarial training (train.py --embedding-adversarial-training)
+    # 'pgd' or 'freelb' (about EMB_ADV_STEPS + 1 times the cost of standard training per epoch)
+    # or 'free' (replays each batch EMB_ADV_STEPS times, trains ceil(NUM_EPOCHS / EMB_ADV_STEPS) epochs)
+    EMB_ADV_METHOD = 'pgd'
+    EMB_ADV_STEPS = 3  # gradient ascent steps per batch
+    EMB_ADV_STEP_SIZE = 0.1
+    EMB_ADV_EPSILON = 0.5  # L2 norm bound of the perturbation of each token
+    EMB_ADV_INIT_MAG = 0.05
+    EMB_ADV_MIX_CLEAN = False  # pgd only, average clean and adversarial loss
+    # Only for paragramcf, restrict perturbations to counter-fitted neighbours
+    EMB_ADV_NEIGHBOUR_PROJECTION = False
+    EMB_ADV_NUM_NEIGHBOURS = 8
+
     LSTM_HIDDEN_SIZE = 200
     LSTM_EMBEDDING_SIZE = 300
     LSTM_NUM_LAYERS = 4
@@ -27,9 +27,16 @@ echo "Attacking model $TA_VICTIM_MODEL_PATH"
 
 # textattack
 NUM_EXAMPLES=5000
+# ta_data_loader.py attacks the same seeded, stratified subset for every recipe
+export TA_NUM_EXAMPLES=${NUM_EXAMPLES}
 QUERY_BUDGET=300  # 0 means unlimited
 for ATTACK in textbugger textfooler bae deepwordbug pwws a2t ;
 do
+    if [ "$ATTACK" = "a2t" ] && [ -n "$TA_INFERENCE_SERVER" ]; then
+        # a2t ranks words by gradients, the inference server only returns probabilities
+        echo "Skipping attack $ATTACK, it needs gradients which $TA_INFERENCE_SERVER cannot compute"
+        continue
+    fi
     echo ""
     echo "Running attack $ATTACK"
     export TA_ATTACK_RECIPE=$ATTACK
@@ -23,13 +23,28 @@ TA_VICTIM_MODEL_DIR=$(dirname "$TA_VICTIM_MODEL_PATH")
 export TA_VICTIM_MODEL_EPOCH=$(basename $TA_VICTIM_MODEL_PATH | cut -d '_' -f 3)  # epoch50.pt
 echo "Epoch: $TA_VICTIM_MODEL_EPOCH"
 export TA_VICTIM_MODEL_EPOCH=$(basename "$TA_VICTIM_MODEL_EPOCH" ".pt")  # epoch50
+# a .onnx victim from utils/onnx_export.py is run by onnxruntime instead of PyTorch,
+# without the gradient based a2t
+export TA_VICTIM_MODEL_EPOCH=$(basename "$TA_VICTIM_MODEL_EPOCH" ".onnx")
 echo "Attacking model $TA_VICTIM_MODEL_PATH"
 
 # textattack
 NUM_EXAMPLES=5000
+# ta_data_loader.py attacks the same seeded, stratified subset for every recipe
+export TA_NUM_EXAMPLES=${NUM_EXAMPLES}
 QUERY_BUDGET=300  # 0 means unlimited
 for ATTACK in textbugger textfooler bae deepwordbug pwws a2t ;
 do
+    if [ "$ATTACK" = "a2t" ] && [ -n "$TA_INFERENCE_SERVER" ]; then
+        # a2t ranks words by gradients, the inference server only returns probabilities
+        echo "Skipping attack $ATTACK, it needs gradients which $TA_INFERENCE_SERVER cannot compute"
+        continue
+    fi
+    if [ "$ATTACK" = "a2t" ] && [[ "$TA_VICTIM_MODEL_PATH" == *.onnx ]]; then
+        # onnxruntime only runs the forward, attack the .pt checkpoint for a2t
+        echo "Skipping attack $ATTACK, it needs gradients which an ONNX victim cannot compute"
+        continue
+    fi
     echo ""
     echo "Running attack $ATTACK"
     export TA_ATTACK_RECIPE=$ATTACK
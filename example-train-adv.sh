@@ -16,6 +16,8 @@ cd /homes/fh422/ic/project
 
 # Note: we do split-for-adv-train because of the memory limit of machines
 # The splitting is done by utils/split_csv.py
+# Alternatively, ingest the data folder once with utils/review_shards.py and train on
+# virtual chunks instead of copies: python train.py --csv <data folder> --train-chunk $i/10 ...
 # Note: the victim model needs to be copied to the output folder
 
 # check if all arguments are provided
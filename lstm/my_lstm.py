@@ -1,12 +1,9 @@
-import numpy as np
 import torch
 import torch.nn as nn
 
-import os
-
 
 class MyLSTM(torch.nn.Module):
-    def __init__(self, Config, vocab_size, num_classes, device):
+    def __init__(self, Config, vocab_size, num_classes, device, embedding_store=None):
         super(MyLSTM, self).__init__()
         self.num_layers = Config.LSTM_NUM_LAYERS
         self.hidden_size = Config.LSTM_HIDDEN_SIZE
@@ -16,23 +13,15 @@ class MyLSTM(torch.nn.Module):
             self.embedding_size = Config.LSTM_EMBEDDING_SIZE
             self.embedding = nn.Embedding(
                 vocab_size, self.embedding_size, padding_idx=0)
-        elif Config.WORD_EMBEDDING == 'glove':
-            # Use pretrained GloVe embeddings
-            import torchtext
-            self.embedding_size = Config.GLOVE_EMBEDDING_SIZE
-            glove = torchtext.vocab.GloVe(
-                name='6B', dim=self.embedding_size, cache=Config.GLOVE_CACHE_DIR)
-            print(f"Loading GloVe embeddings of shape: {glove.vectors.shape}")
-            self.embedding = torch.nn.Embedding.from_pretrained(
-                glove.vectors, freeze=True)
-        elif Config.WORD_EMBEDDING == 'paragramcf':
-            self.embedding_size = 300
-            word_embeddings_file = os.path.join(
-                Config.PARAGRAMCF_DIR, "paragram.npy")
-            paragramcf = torch.from_numpy(np.load(word_embeddings_file))
-            print(f"Loading Paragram embeddings of shape: {paragramcf.shape}")
+        elif Config.WORD_EMBEDDING in ['glove', 'paragramcf']:
+            # Use pretrained GloVe / Paragram embeddings, loaded once per process
+            if embedding_store is None:
+                from project.utils.embedding_store import load_embedding_store
+                embedding_store = load_embedding_store(Config)
+            self.embedding_size = embedding_store.dim
+            print(f"Using {embedding_store.name} embeddings of shape: {tuple(embedding_store.vectors.shape)}")
             self.embedding = nn.Embedding.from_pretrained(
-                paragramcf, freeze=True)
+                embedding_store.vectors, freeze=True)
 
         self.lstm = torch.nn.LSTM(
             self.embedding_size, self.hidden_size, self.num_layers,
@@ -1,12 +1,28 @@
 # Custom dataset loader for textattack
-import pandas as pd
+import atexit
+import os
 
 import textattack
 
-# Load a dataset
-data_path = "data/yelp-polarity/test.csv"
-df = pd.read_csv(data_path)
+# Remember to set the PYTHONPATH environment variable to the root of the project
+from project.utils.attack_subset import subset_from_env
+from project.utils.model_factory import load_config
+from project.utils.tokenizer import MyTokenizer
+from project.utils.truncation import TruncatedDataset
 
-# transform df into a list of tuples [(text, label), ...]
-data = list(zip(df['text'].tolist(), df['label'].tolist()))
-dataset = textattack.datasets.Dataset(data)
+# Load the seeded, stratified attack examples of TA_DATA_FOLDER/test (utils/attack_subset.py),
+# the same examples for every recipe and checkpoint. Only the row numbers are read here,
+# the reviews are read when they are attacked.
+data = subset_from_env("test", default_num_examples=5000)
+
+# Truncate reviews to the MAX_SEQ_LENGTH tokens the victim model can see,
+# set TA_TRUNCATE_TO_MODEL=0 to attack the full reviews
+if os.environ.get("TA_TRUNCATE_TO_MODEL", "1") == "1" and \
+        os.environ.get("TA_VICTIM_MODEL_PATH") is not None:
+    model_path = os.environ.get("TA_VICTIM_MODEL_PATH")
+    Config = load_config(f"{os.path.dirname(model_path)}/config.py")
+    model_tokenizer = MyTokenizer(None, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    dataset = TruncatedDataset(data, model_tokenizer)
+    atexit.register(lambda: print(dataset.stats.report()))
+else:
+    dataset = textattack.datasets.Dataset(data)
@@ -1,8 +1,6 @@
 # Custom model loader for textattack
-import torch
+import atexit
 import os
-from textattack.models.wrappers import PyTorchModelWrapper
-from project.utils.model_factory import construct_model_from_config, ModelWithSigmoid
 
 # Remember to set the PYTHONPATH environment variable to the root of the project
 from project.utils import tokenizer
@@ -13,16 +11,60 @@ assert os.environ.get(
 model_path = os.environ.get("TA_VICTIM_MODEL_PATH")
 output_dir = model_path[:model_path.rfind("/")]
 config_file = f"{output_dir}/config.py"
-print(f"Loading model from {model_path}")
 
-my_model, Config, vocab, device = construct_model_from_config(config_file)
-my_model.load_state_dict(torch.load(model_path))
-my_model.eval()
+# TA_INFERENCE_SERVER: address of a running utils/inference_server.py that already
+# serves TA_VICTIM_MODEL_PATH, e.g. /tmp/victim.sock or localhost:6000.
+# The model is then not loaded in this process, so gradient based recipes
+# (e.g. a2t) cannot attack it.
+inference_server = os.environ.get("TA_INFERENCE_SERVER")
+if inference_server:
+    from project.utils.inference_server import RemoteModelWrapper
+    print(f"Using model {model_path} served by {inference_server}")
+    model = RemoteModelWrapper(inference_server)
+elif model_path.endswith(".onnx"):
+    # exported by utils/onnx_export.py, run by onnxruntime, no gradients for e.g. a2t
+    # TA_ONNX_THREADS: intra-op threads of the onnxruntime session
+    from project.utils.model_factory import load_config, load_vocab
+    from project.utils.onnx_export import OnnxModelWrapper
+    print(f"Loading ONNX model from {model_path}")
+    Config = load_config(config_file)
+    model_tokenizer = tokenizer.MyTokenizer(
+        load_vocab(Config), Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    onnx_threads = os.environ.get("TA_ONNX_THREADS")
+    model = OnnxModelWrapper(model_path, model_tokenizer, int(onnx_threads) if onnx_threads else None)
+else:
+    from textattack.models.wrappers import PyTorchModelWrapper
+    from project.utils.cached_model_wrapper import CachedModelWrapper
+    from project.utils.model_factory import ModelWithSigmoid
+    from project.utils.quantization import load_model_checkpoint
+    print(f"Loading model from {model_path}")
 
+    # TA_QUANTIZE=1: int8 dynamic quantization of an fp32 checkpoint (CPU only).
+    # Artifacts saved by utils/quantization.py are recognized without it.
+    quantize = os.environ.get("TA_QUANTIZE", "0") == "1"
+    my_model, Config, vocab, device = load_model_checkpoint(config_file, model_path, quantize)
+    # TA_COMPILE: 'trace' or 'compile' to run compiled graphs instead of eager mode
+    compile_backend = os.environ.get("TA_COMPILE")
+    if compile_backend:
+        from project.utils.model_compiler import compile_model
+        my_model = compile_model(my_model, Config, compile_backend)
+        atexit.register(lambda compiled_model=my_model: print(compiled_model.report()))
 
-my_model = ModelWithSigmoid(my_model)
-# Load the tokenizer
-model_tokenizer = tokenizer.MyTokenizer(
-    vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
-# Wrap the model with Textattack's wrapper
-model = PyTorchModelWrapper(my_model, model_tokenizer)
+    my_model = ModelWithSigmoid(my_model)
+    # Load the tokenizer
+    model_tokenizer = tokenizer.MyTokenizer(
+        vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    # Wrap the model with Textattack's wrapper
+    # TA_MODEL_CACHE_SIZE: number of predictions cached by token ids, 0 means no cache
+    model_cache_size = int(os.environ.get("TA_MODEL_CACHE_SIZE", 2**15))
+    if model_cache_size > 0:
+        model = CachedModelWrapper(my_model, model_tokenizer, model_cache_size)
+        atexit.register(lambda: print(model.report()))
+    else:
+        model = PyTorchModelWrapper(my_model, model_tokenizer)
+
+# TA_ATTACK_RECIPE (set by example-attack.sh): fail now rather than in the middle of the attack
+attack_recipe = os.environ.get("TA_ATTACK_RECIPE")
+if attack_recipe:
+    from project.utils.attack_stream import check_recipe_supported
+    check_recipe_supported(attack_recipe, model)
@@ -1,62 +1,151 @@
+# Test a model on the test set, as a throughput oriented inference runner.
+# Reports accuracy, loss and the confusion matrix, plus sustained reviews/sec and
+# p50/p99 batch latency, to size CPU hosts for inference.
+
+# Usage:
+# python test.py --csv-folder data/yelp-polarity --model-path tran/transformer_model_epoch50.pt \
+# --config-file tran/config.py <--num-workers 4 --num-threads 8 --bf16 --quantize --output-probs probs.npy>
+
 import argparse
-import pandas as pd
+import time
+import numpy as np
 import torch
 import torch.nn as nn
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
-from utils.yelp_review_dataset import YelpReviewDataset
+from utils.data_pipeline import make_dataloader
+from utils.review_shards import open_split, review_dataset
 from utils.model_factory import construct_model_from_config
+from utils.quantization import quantize_model, is_quantized_checkpoint
+from utils.model_compiler import BACKENDS, compile_model
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--csv-folder', type=str, required=True)
-    parser.add_argument('--model-path', type=str, required=True)
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='fp32 checkpoint or int8 artifact from utils/quantization.py')
     parser.add_argument('--config-file', type=str, required=True)
+    parser.add_argument('--batch-size', type=int, default=None,
+                        help='Defaults to Config.BATCH_SIZE')
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='DataLoader workers that tokenize ahead of the model, defaults to Config.NUM_WORKERS')
+    parser.add_argument('--prefetch-factor', type=int, default=None,
+                        help='Batches prefetched by each DataLoader worker, defaults to Config.PREFETCH_FACTOR')
+    parser.add_argument('--num-threads', type=int, default=None,
+                        help='torch.set_num_threads for the forward passes')
+    parser.add_argument('--bf16', action='store_true', default=False,
+                        help='Run the forward passes under bf16 autocast')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='int8 dynamic quantization of Linear/LSTM layers (CPU only)')
+    parser.add_argument('--compile', type=str, default=None, choices=BACKENDS,
+                        help='Run compiled graphs (TorchScript trace or torch.compile) instead of eager mode')
+    parser.add_argument('--output-probs', type=str, default=None,
+                        help='Write the positive probability of every review to this .npy file (float32)')
+    parser.add_argument('--warmup-batches', type=int, default=2,
+                        help='Batches excluded from the throughput and latency numbers')
     args = parser.parse_args()
 
+    if args.bf16 and args.quantize:
+        raise ValueError("--bf16 and --quantize cannot be combined, quantized layers run in fp32/int8")
+    if args.num_threads:
+        torch.set_num_threads(args.num_threads)
+
     output_dir = args.model_path[:args.model_path.rfind("/")]
     print(f"Loading model from {args.model_path}")
 
     model, Config, vocab, device = construct_model_from_config(args.config_file)
-    model.load_state_dict(torch.load(args.model_path))
+    checkpoint = torch.load(args.model_path, map_location=device)
+    # int8 artifacts hold the state dict of the quantized model
+    args.quantize = args.quantize or is_quantized_checkpoint(checkpoint)
+    if args.quantize:
+        if args.bf16:
+            raise ValueError("--bf16 cannot be used with an int8 model")
+        if device.type != 'cpu':
+            raise ValueError("int8 dynamic quantization only runs on CPU, set USE_GPU = False")
+        print("Using int8 dynamic quantization")
+    if is_quantized_checkpoint(checkpoint):
+        model = quantize_model(model)
+        model.load_state_dict(checkpoint["state_dict"])
+    else:
+        model.load_state_dict(checkpoint)
+        if args.quantize:
+            model = quantize_model(model)
     model.eval()
+    model = compile_model(model, Config, args.compile)
 
-    test_data = pd.read_csv(f'{args.csv_folder}/test.csv')
+    # ingested split (utils/review_shards.py) or test.csv
+    test_data = open_split(args.csv_folder, 'test')
+    test_dataset = review_dataset(test_data, vocab, Config.MAX_SEQ_LENGTH)
 
-    # Reset dataframe index so that we can use df.loc[idx, 'text']
-    test_data = test_data.reset_index(drop=True)
-    test_dataset = YelpReviewDataset(test_data, vocab, Config.MAX_SEQ_LENGTH)
+    # get dataloader from dataset, workers tokenize the next batches while the model runs
+    test_loader = make_dataloader(
+        test_dataset, Config, batch_size=args.batch_size, with_text=False, device=device,
+        num_workers=args.num_workers, prefetch_factor=args.prefetch_factor)
 
-    # get dataloader from dataset
-    test_loader = DataLoader(
-        test_dataset, batch_size=Config.BATCH_SIZE, shuffle=False)
+    probs_out = None
+    if args.output_probs:
+        probs_out = np.lib.format.open_memmap(
+            args.output_probs, mode='w+', dtype=np.float32, shape=(len(test_dataset),))
 
     criterion = nn.BCEWithLogitsLoss()
-    # test
+    # test, the counters stay on the device so there is no sync per batch
+    confusion = torch.zeros(4, dtype=torch.long, device=device)  # TP, FP, TN, FN
+    total_loss = torch.zeros(1, device=device)
+    total = 0
+    batch_latencies = []
+    num_measured = 0
+    measure_start = None
+    offset = 0
     with torch.no_grad():
-        correct = 0
-        total = 0
-        total_loss = 0
-        TP, FP, TN, FN = 0, 0, 0, 0
         print("Testing...")
-        for data, labels, _ in tqdm(test_loader):
-            data = data.to(device)
-            labels = labels.unsqueeze(1).float().to(device)
-            outputs = model(data)
-
-            loss = criterion(outputs, labels)
-            total_loss += loss.item()
+        for batch_idx, (data, labels) in enumerate(tqdm(test_loader)):
+            if batch_idx == args.warmup_batches:
+                measure_start = time.perf_counter()
+            start_time = time.perf_counter()
+            data = data.to(device, non_blocking=True)
+            labels = labels.unsqueeze(1).float().to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16):
+                outputs = model(data)
+            outputs = outputs.float()
 
-            predicted = torch.round(torch.sigmoid(outputs))
+            total_loss += criterion(outputs, labels)
+            predicted = (outputs > 0).float()  # == torch.round(torch.sigmoid(outputs))
+            confusion += torch.stack([
+                ((predicted == 1) & (labels == 1)).sum(),
+                ((predicted == 1) & (labels == 0)).sum(),
+                ((predicted == 0) & (labels == 0)).sum(),
+                ((predicted == 0) & (labels == 1)).sum(),
+            ])
+            probs = torch.sigmoid(outputs).squeeze(1)
+            if probs_out is not None:
+                probs_out[offset:offset + len(probs)] = probs.cpu().numpy()
+            elif device.type == 'cuda':
+                torch.cuda.synchronize()
+            offset += len(probs)
             total += labels.size(0)
+            if batch_idx >= args.warmup_batches:
+                batch_latencies.append(time.perf_counter() - start_time)
+                num_measured += labels.size(0)
+        measure_end = time.perf_counter()
 
-            TP += ((predicted == 1) & (labels == 1)).sum().item()
-            FP += ((predicted == 1) & (labels == 0)).sum().item()
-            TN += ((predicted == 0) & (labels == 0)).sum().item()
-            FN += ((predicted == 0) & (labels == 1)).sum().item()
-        print(f"Accuracy: {(TP + TN) / total:.4f}")
-        print(f"Test Loss: {total_loss / len(test_loader):.4f}")
+    TP, FP, TN, FN = confusion.tolist()
+    print(f"Accuracy: {(TP + TN) / total:.4f}")
+    # mean of the per batch mean losses, as before
+    print(f"Test Loss: {total_loss.item() / len(test_loader):.4f}")
 
     # print confusion matrix
     print(f"TP: {TP}, FP: {FP}, TN: {TN}, FN: {FN}")
+
+    if probs_out is not None:
+        probs_out.flush()
+        print(f"Saved probabilities of {len(probs_out)} reviews to {args.output_probs}")
+    if batch_latencies:
+        latencies_ms = np.array(batch_latencies) * 1000
+        print(f"Throughput: {num_measured / (measure_end - measure_start):.1f} reviews/sec "
+              f"(batch size {test_loader.batch_size}, {test_loader.num_workers} workers, "
+              f"{torch.get_num_threads()} threads, bf16 {args.bf16}, int8 {args.quantize}, compile {args.compile})")
+        print(f"Batch latency: p50 {np.percentile(latencies_ms, 50):.1f}ms, "
+              f"p99 {np.percentile(latencies_ms, 99):.1f}ms")
+    if args.compile:
+        print(model.report())
@@ -1,15 +1,16 @@
 import argparse
 import os
-import pandas as pd
+import time
 import torch
-from torch.utils.data import DataLoader
 
+from utils.data_pipeline import make_dataloader
+from utils.memory_budget import get_peak_rss_mb
 from utils.model_factory import construct_model_from_config
-from utils.plot_loss import do_plot
-from utils.yelp_review_dataset import YelpReviewDataset
+from utils.review_shards import open_split, review_dataset, review_labels, take_chunk
+from utils.upsampling import NegativeUpsamplingSampler
 
-from training_scheme.adversarial import adversarial_training
-from training_scheme.standard import standard_training
+# the training schemes and the plotting are imported when they are used,
+# e.g. standard training does not need TextAttack and matplotlib
 
 
 if __name__ == '__main__':
@@ -23,10 +24,19 @@ if __name__ == '__main__':
                         default=False, help='Output txt files of loss values')
     parser.add_argument('--adversarial-training', action='store_true', default=False,
                         help='Use adversarial training rather than standard training')
+    parser.add_argument('--embedding-adversarial-training', action='store_true', default=False,
+                        help='Use embedding-space adversarial training (PGD, FreeLB or free AT, \
+                        see EMB_ADV_* in config) rather than standard training')
     parser.add_argument('--resume-training', action='store_true', default=False,
                         help='Resume training from the largest epoch in {output_dir}/checkpoints, \
-                        currently only support standard training')
+                        currently only support standard and embedding adversarial training')
+    parser.add_argument('--train-chunk', type=str, default=None,
+                        help='Train on chunk i/n (from 1) of the training set, e.g. 3/10, \
+                        without copying it with utils/split_csv.py')
     args = parser.parse_args()
+    if args.adversarial_training and args.embedding_adversarial_training:
+        raise ValueError(
+            "Cannot use adversarial training and embedding adversarial training at the same time!")
 
     # default config file to output_dir/config.py
     config_path = f'{args.output_dir}/config.py'
@@ -41,6 +51,10 @@ if __name__ == '__main__':
 
     # Constructing model...
     model, Config, vocab, device = construct_model_from_config(config_path)
+    if getattr(Config, 'MICRO_BATCH_SIZE', None) and \
+            (args.adversarial_training or args.embedding_adversarial_training):
+        raise ValueError(
+            "MICRO_BATCH_SIZE is only supported by standard training, set it to None for adversarial training!")
 
     if args.load_trained:
         if args.resume_training:
@@ -55,48 +69,73 @@ if __name__ == '__main__':
     model.train()
     model.to(device)
 
+    if getattr(Config, 'MEMORY_BUDGET_MB', None):
+        # pick the checkpointed layers and the micro-batch size that fit the budget,
+        # only standard training accumulates micro-batches
+        from utils.memory_budget import plan_memory_budget
+        plan = plan_memory_budget(
+            model, Config, device, Config.MEMORY_BUDGET_MB,
+            allow_micro_batches=not (args.adversarial_training or args.embedding_adversarial_training))
+        Config.MICRO_BATCH_SIZE = plan["micro_batch_size"]
+
     # load data
     print(f"Loading data from {args.csv_folder}")
-    train_data = pd.read_csv(f'{args.csv_folder}/train.csv')
-    val_data = pd.read_csv(f'{args.csv_folder}/val.csv')
+    data_start_time = time.time()
+    # ingested splits (utils/review_shards.py) are read on demand, else the csv files
+    train_data = open_split(args.csv_folder, 'train')
+    val_data = open_split(args.csv_folder, 'val')
+    if args.train_chunk:
+        chunk, num_chunks = map(int, args.train_chunk.split('/'))
+        train_data = take_chunk(train_data, chunk - 1, num_chunks)
+        print(f"Training on chunk {chunk}/{num_chunks} of the training set")
+
+    train_dataset = review_dataset(
+        train_data, vocab, Config.MAX_SEQ_LENGTH)
+    train_labels = review_labels(train_data)
+    num_positive = int((train_labels == 1).sum())
+    num_negative = int((train_labels == 0).sum())
     if Config.UPSAMPLE_NEGATIVE:
-        # Upsample negative reviews according to Config.UPSAMPLE_RATIO
-        train_data_pos = train_data[train_data['label'] == 1]
-        train_data_neg = train_data[train_data['label'] == 0]
-        train_data_neg_upsampled = train_data_neg.sample(
-            n=int(len(train_data_neg) * Config.UPSAMPLE_RATIO), replace=True)
-        train_data = pd.concat([train_data_pos, train_data_neg_upsampled])
+        # Upsample negative reviews according to Config.UPSAMPLE_RATIO,
+        # by sampling their indices rather than duplicating the reviews
+        sampler = NegativeUpsamplingSampler(train_labels, Config.UPSAMPLE_RATIO)
+        num_negative = sampler.num_negative
         print(f"Upsampled negative reviews by {Config.UPSAMPLE_RATIO}x")
-    
-    # Reset dataframe index so that we can use df.loc[idx, 'text']
-    train_data = train_data.reset_index(drop=True)
+    else:
+        sampler = None
     print(
-        f"Num positive reviews in training set: {len(train_data[train_data['label'] == 1])}")
+        f"Num positive reviews in training set: {num_positive}")
     print(
-        f"Num negative reviews in training set: {len(train_data[train_data['label'] == 0])}")
+        f"Num negative reviews in training set: {num_negative}")
 
-    train_dataset = YelpReviewDataset(
-        train_data, vocab, Config.MAX_SEQ_LENGTH)
-    # get dataloader from dataset
-    train_loader = DataLoader(
-        train_dataset, batch_size=Config.BATCH_SIZE, shuffle=True)
-    val_data = val_data.reset_index(drop=True)
-    val_dataset = YelpReviewDataset(
+    # get dataloader from dataset, only adversarial training attacks the raw review texts
+    train_loader = make_dataloader(
+        train_dataset, Config, shuffle=sampler is None, sampler=sampler,
+        with_text=args.adversarial_training, device=device)
+    val_dataset = review_dataset(
         val_data, vocab, Config.MAX_SEQ_LENGTH)
-    val_loader = DataLoader(
-        val_dataset, batch_size=Config.BATCH_SIZE, shuffle=False)
+    val_loader = make_dataloader(val_dataset, Config, with_text=False, device=device)
+    print(f"DataLoader workers: {train_loader.num_workers}, pin memory: {train_loader.pin_memory}")
+    print(f"Built datasets in {time.time() - data_start_time:.2f}s, "
+          f"peak RSS {get_peak_rss_mb():.0f}MB")
 
     # train model
     if args.adversarial_training:
+        from training_scheme.adversarial import adversarial_training
         adversarial_training(model, Config, device, args,
                              train_loader, val_loader, vocab)
+    elif args.embedding_adversarial_training:
+        from training_scheme.embedding_adversarial import embedding_adversarial_training
+        embedding_adversarial_training(model, Config, device, args,
+                                       train_loader, val_loader)
     else:
+        from training_scheme.standard import standard_training
         standard_training(model, Config, device, args,
                           train_loader, val_loader)
     print(f"Training complete with output directory {args.output_dir}")
 
     # plot train/val loss and val accuracy
     if args.loss_values:
+        from utils.plot_loss import do_plot
         print(f"Plotting loss and accuracy to {args.output_dir}")
         model_choice = os.environ["MODEL_CHOICE"]
         do_plot(model_choice, Config.NUM_EPOCHS, args.output_dir)
@@ -6,19 +6,18 @@ import textattack
 import torch.nn as nn
 from tqdm import tqdm
 
-from textattack import Attacker
-
-from textattack import AttackArgs
-from textattack.attack_recipes import TextFoolerJin2019, A2TYoo2021, DeepWordBugGao2018, PWWSRen2019
-from textattack.attack_results import (
-    FailedAttackResult,
-    MaximizedAttackResult,
-    SkippedAttackResult,
-    SuccessfulAttackResult,
-)
 from textattack.models.wrappers import PyTorchModelWrapper
 
+from utils.attack_stream import (
+    RecyclingAttackWorker,
+    RSSMonitor,
+    build_attack_recipe,
+    stream_attack_records,
+)
+from utils.cached_model_wrapper import CachedModelWrapper
+from utils.memory_budget import get_rss_mb
 from utils.model_factory import ModelWithSigmoid
+from utils.truncation import TruncationStats, truncate_texts
 from project.utils import tokenizer
 
 
@@ -43,77 +42,45 @@ def _get_recipe_and_budget(Config) -> (str, int):
     return attack_recipe, query_budget
 
 
-def _generate_attacked_texts(model_wrapper, train_dataset, Config):
+def _generate_attacked_texts(model_wrapper, train_dataset, Config, rss_monitor=None):
     """
     Adapted from https://github.com/Falanke21/TextAttack/blob/master/textattack/trainer.py
     Generate adversarial examples using attacker.
+    Each AttackResult is turned into a compact record as soon as it is produced,
+    instead of keeping all of them alive in Attacker.attack_dataset().
     params:
-        args: command line arguments from train.py
         model_wrapper: PyTorchModelWrapper from TextAttack
         train_dataset: training dataset wrapped by textattack.datasets.Dataset
-        epoch: current epoch of training
+        Config: config of the model
+        rss_monitor: optional RSSMonitor to record memory usage
     """
     attack_recipe, query_budget = _get_recipe_and_budget(Config)
-    if attack_recipe == "textfooler":
-        attack = TextFoolerJin2019.build(model_wrapper)
-    elif attack_recipe == "a2t":
-        attack = A2TYoo2021.build(model_wrapper)
-    elif attack_recipe == "deepwordbug":
-        attack = DeepWordBugGao2018.build(model_wrapper)
-    elif attack_recipe == "pwws":
-        attack = PWWSRen2019.build(model_wrapper)
-    else:
-        raise ValueError(f"Unknown attack recipe {attack_recipe}")
-    num_train_adv_examples = len(train_dataset)
-    # generate example for all of training data.
-    attack_args = AttackArgs(
-        num_examples=num_train_adv_examples,
-        num_examples_offset=0,
-        query_budget=query_budget,
-        shuffle=False,
-        parallel=False,
-        num_workers_per_device=1,
-        disable_stdout=True,
-        silent=True,
-    )
-    attack_args.attack_recipe = attack_recipe
-    attack_args.model_cache_size = 0
-    attack_args.constraint_cache_size = 0
-
-    attacker = Attacker(attack, train_dataset, attack_args=attack_args)
-    results = attacker.attack_dataset()
-
-    # atacked_texts is a list which might create reference which leads to memory leak
+    attack = build_attack_recipe(attack_recipe, model_wrapper)
+
+    # attacked_texts will be a list of attacked text,
+    # the original text if the attack failed or was skipped
     attacked_texts = []
-    # attacked_texts will be a list of attacked text
-    for r in results:
-        # a successful attack
-        if isinstance(r, (SuccessfulAttackResult, MaximizedAttackResult)):
-            attacked_texts.append(
-                tuple(r.perturbed_result.attacked_text._text_input.values())[0])
-        # a failed attack
-        elif isinstance(r, FailedAttackResult):
-            attacked_texts.append(
-                tuple(r.original_result.attacked_text._text_input.values())[0])
-        # a skipped attack
-        elif isinstance(r, SkippedAttackResult):
-            attacked_texts.append(
-                tuple(r.original_result.attacked_text._text_input.values())[0])
-        else:
-            raise ValueError(f"Unknown attack result type {type(r)}")
+    for record in stream_attack_records(attack, train_dataset, query_budget):
+        attacked_texts.append(record["text"])
+    if rss_monitor is not None:
+        rss_monitor.update(len(attacked_texts), get_rss_mb())
 
     attack.clear_cache()
     # Delete TextAttack related objects to free up memory
-    del attacker, results, attack, model_wrapper, train_dataset, attack_args
+    del attack, model_wrapper, train_dataset
     return attacked_texts
 
 
-def create_ta_dataset(text_lst, labels_lst, max_char_length=1500):
+def create_ta_dataset(text_lst, labels_lst, max_char_length=1500, model_tokenizer=None,
+                      truncation_stats=None):
     """
     Create a textattack dataset from a list of text and labels.
     Filter text that is too long. This prevents memory error.
     A review with over 1500 characters is overkill.
+    If model_tokenizer is given, also cut every text after the last token the model can see.
     """
+    if model_tokenizer is not None:
+        text_lst = truncate_texts(text_lst, model_tokenizer, truncation_stats)
     for i in range(len(text_lst)):
         if len(text_lst[i]) > max_char_length:
             text_lst[i] = text_lst[i][:max_char_length]
@@ -124,24 +91,42 @@ def create_ta_dataset(text_lst, labels_lst, max_char_length=1500):
     return train_dataset
 
 
-def text_to_adv_data(model, model_tokenizer, text, labels, Config):
+def text_to_adv_data(model, model_tokenizer, text, labels, Config, model_wrapper=None,
+                     truncation_stats=None, attack_worker=None, rss_monitor=None):
     """
     Prepare and generate adversarial examples for adversarial training.
+    If model_wrapper is given (e.g. a CachedModelWrapper), it must wrap the newest model.
+    If attack_worker is given, the attack runs in that RecyclingAttackWorker instead.
     """
-    # Update wrap model because we attack the newest model every batch
-    model_wrapper = PyTorchModelWrapper(
-        ModelWithSigmoid(model), model_tokenizer)
+    if model_wrapper is None and attack_worker is None:
+        # Update wrap model because we attack the newest model every batch
+        model_wrapper = PyTorchModelWrapper(
+            ModelWithSigmoid(model), model_tokenizer)
 
     # text is a tuple of size (batch_size), each element is a review
     text_lst = list(text)
     # labels is a batched tensor of size (batch_size)
     labels_lst = labels.tolist()
-    train_dataset = create_ta_dataset(text_lst, labels_lst, 1500)
+    # Truncate to MAX_SEQ_LENGTH tokens so the attack does not waste queries
+    # on words the model cannot see
+    if getattr(Config, 'ADV_TRAIN_TRUNCATE_TO_SEQ_LENGTH', True):
+        train_dataset = create_ta_dataset(
+            text_lst, labels_lst, 1500, model_tokenizer, truncation_stats)
+    else:
+        train_dataset = create_ta_dataset(text_lst, labels_lst, 1500)
 
     # Generate adversarial examples
-    with torch.no_grad():
-        attacked_texts = _generate_attacked_texts(
-            model_wrapper, train_dataset, Config)
+    if attack_worker is not None:
+        # send the newest trainable weights, the frozen embedding never changes
+        trainable_state = {name: param.detach().cpu()
+                           for name, param in model.named_parameters() if param.requires_grad}
+        records = attack_worker.attack(train_dataset._dataset, trainable_state)
+        attacked_texts = [record["text"] for record in records]
+        del records
+    else:
+        with torch.no_grad():
+            attacked_texts = _generate_attacked_texts(
+                model_wrapper, train_dataset, Config, rss_monitor)
 
     # need to convert attacked_texts to a tensor of size (batch_size, max_seq_length)
     # Convert text to ids
@@ -181,12 +166,32 @@ def adversarial_training(model, Config, device, args, train_loader, val_loader,
     # define binary cross entropy loss function and optimizer
     criterion = get_criterion()
     optimizer = get_optimizer(model, Config)
+    # Cache predictions keyed by token ids, 0 means no cache
+    model_cache_size = getattr(Config, 'ADV_TRAIN_MODEL_CACHE_SIZE', 2**15)
+    model_wrapper = None
+    if model_cache_size > 0:
+        model_wrapper = CachedModelWrapper(
+            ModelWithSigmoid(model), model_tokenizer, model_cache_size)
+        # the cached predictions are stale once the weights change
+        model_wrapper.invalidate_on_step(optimizer)
+    truncation_stats = TruncationStats()
+    rss_monitor = RSSMonitor()
+    # Optionally attack in a worker process that is recycled once its RSS
+    # crosses ADV_TRAIN_WORKER_MAX_RSS_MB, to bound the memory of long runs
+    attack_worker = None
+    if getattr(Config, 'ADV_TRAIN_ATTACK_WORKER', False):
+        attack_recipe, query_budget = _get_recipe_and_budget(Config)
+        attack_worker = RecyclingAttackWorker(
+            f'{args.output_dir}/config.py', os.environ["MODEL_CHOICE"], attack_recipe,
+            query_budget, getattr(Config, 'ADV_TRAIN_WORKER_MAX_RSS_MB', None),
+            model_path=args.load_trained, model_cache_size=max(model_cache_size, 0))
     val_losses, val_accuracy = [], []
     for i, (_, labels, text) in enumerate(tqdm(train_loader)):
         model.eval()
         # Generate adversarial examples
         data = text_to_adv_data(
-            model, model_tokenizer, text, labels, Config)
+            model, model_tokenizer, text, labels, Config, model_wrapper, truncation_stats,
+            attack_worker, rss_monitor)
         # Now do the real training
         data = data.to(device)
         labels = labels.unsqueeze(1).float()  # (batch_size, 1)
@@ -215,6 +220,15 @@ def adversarial_training(model, Config, device, args, train_loader, val_loader,
         del data, labels, outputs, _
         torch.cuda.empty_cache()
             
+    if model_wrapper is not None and attack_worker is None:
+        print(model_wrapper.report())
+    print(truncation_stats.report())
+    if attack_worker is not None:
+        print(attack_worker.report())
+        attack_worker.close()
+    else:
+        print(rss_monitor.report())
+
     # save model to at_model.pt
     # Note: in adv training we save the model at every 1/10 of each training
     # see example-train-adv.sh for more details 
@@ -226,7 +240,7 @@ def adversarial_training(model, Config, device, args, train_loader, val_loader,
     with torch.no_grad():
         total_loss = total = TP = TN = 0
         print(f"Validation...")
-        for data, labels, _ in tqdm(val_loader):
+        for data, labels, *_ in tqdm(val_loader):
             data = data.to(device)
             labels = labels.unsqueeze(1).float().to(device)
             outputs = model(data)
@@ -0,0 +1,336 @@
+# Embedding-space adversarial training (PGD, FreeLB and "free" AT).
+# Rather than searching for discrete word substitutions with TextAttack,
+# we perturb the output of model.embedding with a few gradient ascent steps
+# per batch. PGD and FreeLB cost about (EMB_ADV_STEPS + 1) times standard training
+# per epoch. "Free" AT replays every batch EMB_ADV_STEPS times with a parameter
+# update each time, so it runs ceil(NUM_EPOCHS / EMB_ADV_STEPS) epochs to cost
+# about as much as standard training.
+#
+# References:
+# PGD: https://arxiv.org/abs/1706.06083
+# FreeLB: https://arxiv.org/abs/1909.11764
+# Free AT: https://arxiv.org/abs/1904.12843
+# Neighbour projection (similar to ASCC/DNE): https://arxiv.org/abs/2006.11627
+
+import math
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+from tqdm import tqdm
+
+from training_scheme.standard import get_criterion, get_optimizer, load_largest_epoch
+from utils.data_pipeline import DataWaitTimer
+from utils.memory_budget import get_peak_rss_mb
+
+
+def _get_emb_adv_settings(Config) -> dict:
+    """
+    Return embedding adversarial training settings specified in Config,
+    or default to 3 steps of PGD.
+    """
+    settings = {
+        'method': getattr(Config, 'EMB_ADV_METHOD', 'pgd'),  # 'pgd', 'freelb' or 'free'
+        'steps': getattr(Config, 'EMB_ADV_STEPS', 3),
+        'step_size': getattr(Config, 'EMB_ADV_STEP_SIZE', 0.1),
+        # L2 norm bound of the perturbation of every token embedding
+        'epsilon': getattr(Config, 'EMB_ADV_EPSILON', 0.5),
+        'init_mag': getattr(Config, 'EMB_ADV_INIT_MAG', 0.05),
+        # Only used by pgd, train on (clean + adversarial) / 2 instead of adversarial loss
+        'mix_clean': getattr(Config, 'EMB_ADV_MIX_CLEAN', False),
+        'neighbour_projection': getattr(Config, 'EMB_ADV_NEIGHBOUR_PROJECTION', False),
+        'num_neighbours': getattr(Config, 'EMB_ADV_NUM_NEIGHBOURS', 8),
+    }
+    if settings['method'] not in ['pgd', 'freelb', 'free']:
+        raise ValueError(
+            f"Unknown embedding adversarial method {settings['method']}")
+    if settings['steps'] < 1:
+        raise ValueError("EMB_ADV_STEPS must be at least 1")
+    if settings['neighbour_projection'] and Config.WORD_EMBEDDING != 'paragramcf':
+        raise ValueError(
+            "EMB_ADV_NEIGHBOUR_PROJECTION requires Config.WORD_EMBEDDING = 'paragramcf'")
+    return settings
+
+
+class EmbeddingPerturbation:
+    """
+    Add a perturbation to the output of model.embedding with a forward hook,
+    so that MyTransformer and MyLSTM can be trained without changing their forward().
+    """
+
+    def __init__(self, model, Config, settings, device):
+        self.model = model
+        self.settings = settings
+        self.delta = None
+        self.neighbours = None
+        if settings['neighbour_projection']:
+            if getattr(Config, 'SYNONYM_INDEX_DIR', None):
+                # precomputed by utils/synonym_index.py
+                from utils.synonym_index import SynonymIndex
+                index = SynonymIndex(Config.SYNONYM_INDEX_DIR)
+                nn_matrix = index.neighbour_ids(
+                    np.arange(len(index)), settings['num_neighbours'])
+            else:
+                # nn.npy is the nearest neighbour matrix shipped with paragramcf,
+                # of shape (vocab_size, num_neighbours), sorted by distance
+                nn_matrix_file = os.path.join(Config.PARAGRAMCF_DIR, "nn.npy")
+                nn_matrix = np.load(nn_matrix_file)[:, :settings['num_neighbours']]
+            if getattr(Config, 'PRUNED_EMBEDDING_DIR', None):
+                # the neighbours are full vocab ids
+                from utils.prune_embeddings import load_old_ids, remap_neighbour_matrix
+                nn_matrix = remap_neighbour_matrix(nn_matrix, load_old_ids(Config))
+            print(f"Loading neighbour matrix of shape: {nn_matrix.shape}")
+            self.neighbours = torch.from_numpy(nn_matrix).long().to(device)
+        self._handle = model.embedding.register_forward_hook(self._hook)
+
+    def _hook(self, module, inputs, output):
+        if self.delta is None:
+            return None
+        if self.delta.shape != output.shape:
+            # every step initialises delta for its own batch
+            raise RuntimeError(f"Perturbation of shape {tuple(self.delta.shape)} "
+                               f"does not match the embeddings of shape {tuple(output.shape)}")
+        return output + self.delta
+
+    def remove(self):
+        self._handle.remove()
+
+    def init_delta(self, shape, device):
+        """
+        Random initialisation inside the epsilon ball, as in FreeLB
+        """
+        if self.settings['init_mag'] > 0:
+            delta = torch.zeros(shape, device=device).uniform_(-1, 1)
+            delta = delta * self.settings['init_mag'] / \
+                torch.sqrt(torch.tensor(float(shape[-1]), device=device))
+        else:
+            delta = torch.zeros(shape, device=device)
+        self.delta = delta.requires_grad_()
+
+    def clear_delta(self):
+        self.delta = None
+
+    def ascent_step(self, input_ids):
+        """
+        Move delta along its normalised gradient, then project back
+        to the epsilon ball (and the synonym hull if enabled).
+        """
+        grad = self.delta.grad.detach()
+        # normalise the gradient of each token embedding
+        grad_norm = grad.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+        delta = self.delta.detach() + self.settings['step_size'] * grad / grad_norm
+        if self.neighbours is not None:
+            delta = self._project_to_neighbours(delta, input_ids)
+        # project to the L2 ball of each token
+        delta_norm = delta.norm(dim=-1, keepdim=True).clamp_min(1e-12)
+        delta = delta * torch.clamp(self.settings['epsilon'] / delta_norm, max=1)
+        # padding tokens are never perturbed
+        delta = delta * (input_ids != 0).unsqueeze(-1)
+        self.delta = delta.requires_grad_()
+
+    def _project_to_neighbours(self, delta, input_ids):
+        """
+        Project delta onto the cone spanned by the directions from each word to its
+        counter-fitted neighbours, and keep the perturbed embedding inside the convex
+        hull of the word and its neighbours. This restricts the perturbation to
+        directions that correspond to synonym substitutions.
+        """
+        weight = self.model.embedding.weight
+        # (batch_size, seq_len, num_neighbours)
+        neighbour_ids = self.neighbours[input_ids]
+        # directions from the word to its neighbours
+        # (batch_size, seq_len, num_neighbours, embedding_size)
+        directions = weight[neighbour_ids] - weight[input_ids].unsqueeze(2)
+        sq_norms = (directions ** 2).sum(dim=-1).clamp_min(1e-12)
+        coefficients = torch.relu(
+            (directions * delta.unsqueeze(2)).sum(dim=-1)) / sq_norms
+        # convex combination: coefficients sum to at most 1
+        total = coefficients.sum(dim=-1, keepdim=True)
+        coefficients = coefficients / torch.clamp(total, min=1)
+        return (coefficients.unsqueeze(-1) * directions).sum(dim=2).detach()
+
+
+def _forward_loss(model, Config, criterion, data, labels):
+    outputs = model(data)
+    loss = criterion(outputs, labels)
+    # ReLU regularization if necessary
+    if hasattr(Config, 'RELU_REGULARIZATION') and Config.RELU_REGULARIZATION:
+        loss = model.relu_regularization(Config, loss)
+    return loss
+
+
+def _clip_and_step(model, Config, optimizer):
+    if Config.GRADIENT_CLIP:
+        # clip gradient norm
+        nn.utils.clip_grad_norm_(model.parameters(),
+                                 max_norm=Config.GRADIENT_CLIP_VALUE)
+    optimizer.step()
+
+
+def _pgd_step(model, Config, criterion, optimizer, perturbation, data, labels, settings):
+    """
+    K steps of ascent on delta only, then one update of the parameters
+    on the adversarial (optionally mixed with clean) loss.
+    """
+    perturbation.init_delta(
+        (data.shape[0], data.shape[1], model.embedding.embedding_dim), data.device)
+    for _ in range(settings['steps']):
+        loss = _forward_loss(model, Config, criterion, data, labels)
+        # only need the gradient of delta here
+        delta_grad, = torch.autograd.grad(loss, perturbation.delta)
+        perturbation.delta.grad = delta_grad
+        perturbation.ascent_step(data)
+
+    optimizer.zero_grad()
+    loss = _forward_loss(model, Config, criterion, data, labels)
+    if settings['mix_clean']:
+        perturbation.clear_delta()
+        loss = (loss + _forward_loss(model, Config, criterion, data, labels)) / 2
+    loss.backward()
+    _clip_and_step(model, Config, optimizer)
+    perturbation.clear_delta()
+    return loss.item()
+
+
+def _freelb_step(model, Config, criterion, optimizer, perturbation, data, labels, settings):
+    """
+    Accumulate the parameter gradients of all K ascent steps,
+    then do a single update, as in FreeLB.
+    """
+    optimizer.zero_grad()
+    perturbation.init_delta(
+        (data.shape[0], data.shape[1], model.embedding.embedding_dim), data.device)
+    total_loss = 0
+    for _ in range(settings['steps']):
+        loss = _forward_loss(model, Config, criterion, data, labels) / settings['steps']
+        loss.backward()
+        total_loss += loss.item()
+        perturbation.ascent_step(data)
+    _clip_and_step(model, Config, optimizer)
+    perturbation.clear_delta()
+    return total_loss
+
+
+def _free_step(model, Config, criterion, optimizer, perturbation, data, labels, settings):
+    """
+    Replay the batch K times, every backward updates both the parameters and delta.
+    delta is kept across batches as in "free" adversarial training.
+    """
+    shape = (data.shape[0], data.shape[1], model.embedding.embedding_dim)
+    if perturbation.delta is None or perturbation.delta.shape != shape:
+        perturbation.init_delta(shape, data.device)
+    total_loss = 0
+    for _ in range(settings['steps']):
+        optimizer.zero_grad()
+        loss = _forward_loss(model, Config, criterion, data, labels)
+        loss.backward()
+        total_loss += loss.item()
+        _clip_and_step(model, Config, optimizer)
+        perturbation.ascent_step(data)
+    return total_loss / settings['steps']
+
+
+def embedding_adversarial_training(model, Config, device, args, train_loader, val_loader):
+    print("Embedding Adversarial Training...")
+    settings = _get_emb_adv_settings(Config)
+    print(f"Using {settings['method']} with {settings['steps']} steps, "
+          f"step size {settings['step_size']} and epsilon {settings['epsilon']}")
+    num_epochs = Config.NUM_EPOCHS
+    if settings['method'] == 'free':
+        # every batch is replayed EMB_ADV_STEPS times, as many updates as NUM_EPOCHS of standard training
+        num_epochs = math.ceil(Config.NUM_EPOCHS / settings['steps'])
+        print(f"Free AT replays every batch {settings['steps']} times, "
+              f"training {num_epochs} epochs instead of {Config.NUM_EPOCHS}")
+    starting_epoch = 0
+    if args.resume_training:
+        # find the largest epoch and load that checkpoint
+        model, starting_epoch = load_largest_epoch(model, args)
+    # define binary cross entropy loss function and optimizer
+    criterion = get_criterion()
+    optimizer = get_optimizer(model, Config)
+    perturbation = EmbeddingPerturbation(model, Config, settings, device)
+    if settings['method'] == 'pgd':
+        train_step = _pgd_step
+    elif settings['method'] == 'freelb':
+        train_step = _freelb_step
+    else:
+        train_step = _free_step
+
+    # start training
+    train_losses, val_losses, val_accuracy = [], [], []
+    # records how long every step waits for its batch
+    timed_loader = DataWaitTimer(train_loader)
+    print(f"Start with epoch {starting_epoch + 1}")
+    for epoch in range(starting_epoch, num_epochs):
+        print(f"Epoch {epoch + 1}/{num_epochs}...")
+        total_loss = 0
+        # Note: the model stays in train mode during the ascent steps,
+        # cuDNN LSTM can only do backward in train mode
+        model.train()
+        for i, (data, labels, *_) in enumerate(tqdm(timed_loader)):
+            data = data.to(device, non_blocking=True)
+            labels = labels.unsqueeze(1).float()  # (batch_size, 1)
+            labels = labels.to(device, non_blocking=True)
+
+            # Apply label smoothing by changing labels from 0, 1 to 0.1, 0.9
+            if Config.LABEL_SMOOTHING:
+                labels = (1 - Config.LABEL_SMOOTHING_EPSILON) * labels + \
+                    Config.LABEL_SMOOTHING_EPSILON * (1 - labels)
+
+            loss = train_step(model, Config, criterion, optimizer,
+                              perturbation, data, labels, settings)
+            total_loss += loss
+
+            # update tqdm with loss value every a few batches
+            NUM_PRINT_PER_EPOCH = 2
+            if (i+1) % max(len(train_loader) // NUM_PRINT_PER_EPOCH, 1) == 0:
+                tqdm.write(f"Epoch {epoch + 1}/{num_epochs}, \
+                            Batch {i+1}/{len(train_loader)}, \
+                            Batch Adversarial Loss: {loss:.4f}, \
+                            Average Adversarial Loss: {total_loss / (i+1):.4f}")
+        perturbation.clear_delta()
+        print(f"Epoch {epoch + 1}/{num_epochs}, \
+              Average Adversarial Loss: {total_loss / len(train_loader):.4f}")
+        print(timed_loader.report())
+        print(f"Peak RSS: {get_peak_rss_mb():.0f}MB")
+        # save loss for plot
+        train_losses.append(total_loss / len(train_loader))
+        # save checkpoint
+        if args.checkpoints:
+            try:
+                checkpoint_path = f'{args.output_dir}/checkpoints/{os.environ["MODEL_CHOICE"]}_model_epoch{epoch+1}.pt'
+                torch.save(model.state_dict(), checkpoint_path)
+            except OSError as e:
+                print(
+                    f"Could not save checkpoint at epoch {epoch+1}, error: {e}")
+
+        # evaluate on validation set without perturbation
+        model.eval()
+        with torch.no_grad():
+            total_loss = total = TP = TN = 0
+            print(f"Validation at epoch {epoch + 1}...")
+            for data, labels, *_ in tqdm(val_loader):
+                data = data.to(device)
+                labels = labels.unsqueeze(1).float().to(device)
+                outputs = model(data)
+                loss = criterion(outputs, labels)
+                total_loss += loss.item()
+                predicted = torch.round(torch.sigmoid(outputs))
+                total += labels.size(0)
+
+                TP += ((predicted == 1) & (labels == 1)).sum().item()
+                TN += ((predicted == 0) & (labels == 0)).sum().item()
+            print(f"Validation Accuracy: {(TP + TN) / total:.4f}")
+            print(f"Validation Loss: {total_loss / len(val_loader):.4f}")
+            val_losses.append(total_loss / len(val_loader))
+            val_accuracy.append((TP + TN) / total)
+
+        # plot loss and accuracy values to file
+        if args.loss_values:
+            with open(f'{args.output_dir}/{os.environ["MODEL_CHOICE"]}_train_losses.txt', 'a') as f:
+                f.write(f'{train_losses[-1]}\n')
+            with open(f'{args.output_dir}/{os.environ["MODEL_CHOICE"]}_val_losses.txt', 'a') as f:
+                f.write(f'{val_losses[-1]}\n')
+            with open(f'{args.output_dir}/{os.environ["MODEL_CHOICE"]}_val_accuracy.txt', 'a') as f:
+                f.write(f'{val_accuracy[-1]}\n')
+    perturbation.remove()
@@ -3,6 +3,9 @@ import torch
 import torch.nn as nn
 from tqdm import tqdm
 
+from utils.data_pipeline import DataWaitTimer
+from utils.memory_budget import get_peak_rss_mb
+
 
 def get_criterion():
     criterion = nn.BCEWithLogitsLoss()
@@ -64,32 +67,42 @@ def standard_training(model, Config, device, args, train_loader, val_loader):
 
     # start training
     train_losses, val_losses, val_accuracy = [], [], []
+    # records how long every step waits for its batch
+    timed_loader = DataWaitTimer(train_loader)
+    # MICRO_BATCH_SIZE (or utils/memory_budget.py) bounds the activations kept for backward
+    micro_batch_size = getattr(Config, 'MICRO_BATCH_SIZE', None) or Config.BATCH_SIZE
     print(f"Start with epoch {starting_epoch + 1}")
     for epoch in range(starting_epoch, Config.NUM_EPOCHS):
         print(f"Epoch {epoch + 1}/{Config.NUM_EPOCHS}...")
         total_loss = 0
         model.train()
-        for i, (data, labels, text) in enumerate(tqdm(train_loader)):
-            data = data.to(device)
+        for i, (data, labels, *_) in enumerate(tqdm(timed_loader)):
+            data = data.to(device, non_blocking=True)
             labels = labels.unsqueeze(1).float()  # (batch_size, 1)
-            labels = labels.to(device)
+            labels = labels.to(device, non_blocking=True)
 
             # Apply label smoothing by changing labels from 0, 1 to 0.1, 0.9
             if Config.LABEL_SMOOTHING:
                 labels = (1 - Config.LABEL_SMOOTHING_EPSILON) * labels + \
                     Config.LABEL_SMOOTHING_EPSILON * (1 - labels)
 
-            # forward
-            outputs = model(data)
-            loss = criterion(outputs, labels)
-            # ReLU regularization if necessary
-            if hasattr(Config, 'RELU_REGULARIZATION') and Config.RELU_REGULARIZATION:
-                loss = model.relu_regularization(Config, loss)
-
-            total_loss += loss.item()
-            # backward
             optimizer.zero_grad()
-            loss.backward()
+            # the gradients of the micro-batches add up to those of the whole batch
+            batch_loss = 0.
+            for micro_data, micro_labels in zip(data.split(micro_batch_size), labels.split(micro_batch_size)):
+                # forward
+                outputs = model(micro_data)
+                # the criterion averages over the micro-batch, weight it by its share of the batch
+                loss = criterion(outputs, micro_labels) * (len(micro_data) / len(data))
+                # ReLU regularization if necessary, it is a sum over the reviews, so the
+                # unscaled terms of the micro-batches add up to the term of the whole batch
+                if hasattr(Config, 'RELU_REGULARIZATION') and Config.RELU_REGULARIZATION:
+                    loss = model.relu_regularization(Config, loss)
+                # backward
+                loss.backward()
+                batch_loss += loss.item()
+
+            total_loss += batch_loss
             if Config.GRADIENT_CLIP:
                 # clip gradient norm
                 nn.utils.clip_grad_norm_(model.parameters(),
@@ -102,10 +115,12 @@ def standard_training(model, Config, device, args, train_loader, val_loader):
                 # if (i+1) % (Config.BATCH_SIZE * 3) == 0:
                 tqdm.write(f"Epoch {epoch + 1}/{Config.NUM_EPOCHS}, \
                             Batch {i+1}/{len(train_loader)}, \
-                            Batch Loss: {loss.item():.4f}, \
+                            Batch Loss: {batch_loss:.4f}, \
                             Average Loss: {total_loss / (i+1):.4f}")
         print(f"Epoch {epoch + 1}/{Config.NUM_EPOCHS}, \
               Average Loss: {total_loss / len(train_loader):.4f}")
+        print(timed_loader.report())
+        print(f"Peak RSS: {get_peak_rss_mb():.0f}MB")
         # save loss for plot
         train_losses.append(total_loss / len(train_loader))
         # save checkpoint
@@ -122,7 +137,7 @@ def standard_training(model, Config, device, args, train_loader, val_loader):
         with torch.no_grad():
             total_loss = total = TP = TN = 0
             print(f"Validation at epoch {epoch + 1}...")
-            for data, labels, _ in tqdm(val_loader):
+            for data, labels, *_ in tqdm(val_loader):
                 data = data.to(device)
                 labels = labels.unsqueeze(1).float().to(device)
                 outputs = model(data)
@@ -1,20 +1,20 @@
-import os
-
-import numpy as np
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 from .encoder_layer import EncoderLayer
 from .positional_encoding import PositionalEncoding
 
 
 class MyTransformer(nn.Module):
-    def __init__(self, Config, vocab_size, output_dim, device):
+    def __init__(self, Config, vocab_size, output_dim, device, embedding_store=None):
         """
         :param vocab_size: int - The size of the vocabulary of the input sequence.
         :param ffn_hidden: int - The size of the feedforward layer in the encoder layers.
         :param output_dim: int - The size of the output layer.
         :param device: str - The device (e.g. 'cpu' or 'cuda') where the model will be run.
+        :param embedding_store: EmbeddingStore - Pretrained vectors for 'glove' and 'paragramcf',
+        loaded from Config if None.
         """
         super(MyTransformer, self).__init__()
         if hasattr(Config, 'POSITIONAL_ENCODING'):
@@ -32,23 +32,16 @@ class MyTransformer(nn.Module):
         if Config.WORD_EMBEDDING == 'custom':
             self.embedding = nn.Embedding(
                 vocab_size, self.d_model, padding_idx=0)
-        elif Config.WORD_EMBEDDING == 'glove':
-            # Use pretrained GloVe embeddings
-            import torchtext
-            glove = torchtext.vocab.GloVe(name='6B',
-                                          dim=Config.GLOVE_EMBEDDING_SIZE,
-                                          cache=Config.GLOVE_CACHE_DIR)
-            print(f"Loading GloVe embeddings of shape: {glove.vectors.shape}")
-            self.embedding = nn.Embedding.from_pretrained(
-                glove.vectors, freeze=True)
-        elif Config.WORD_EMBEDDING == 'paragramcf':
-            assert Config.D_MODEL == 300, f"D_MODEL must be 300 for Paragramcf embeddings. Got {Config.D_MODEL} instead."
-            word_embeddings_file = os.path.join(
-                Config.PARAGRAMCF_DIR, "paragram.npy")
-            paragramcf = torch.from_numpy(np.load(word_embeddings_file))
-            print(f"Loading Paragram embeddings of shape: {paragramcf.shape}")
+        elif Config.WORD_EMBEDDING in ['glove', 'paragramcf']:
+            if Config.WORD_EMBEDDING == 'paragramcf':
+                assert Config.D_MODEL == 300, f"D_MODEL must be 300 for Paragramcf embeddings. Got {Config.D_MODEL} instead."
+            # Use pretrained GloVe / Paragram embeddings, loaded once per process
+            if embedding_store is None:
+                from project.utils.embedding_store import load_embedding_store
+                embedding_store = load_embedding_store(Config)
+            print(f"Using {embedding_store.name} embeddings of shape: {tuple(embedding_store.vectors.shape)}")
             self.embedding = nn.Embedding.from_pretrained(
-                paragramcf, freeze=True)
+                embedding_store.vectors, freeze=True)
 
         if self.use_pe:
             self.positional_encoding = PositionalEncoding(
@@ -80,6 +73,25 @@ class MyTransformer(nn.Module):
             self.layers = nn.ModuleList(
                 [EncoderLayer(Config) for _ in range(self.n_layers)])
         self.fc = nn.Linear(self.d_model, output_dim)
+        self.relu_regularization_enabled = getattr(Config, 'RELU_REGULARIZATION', False)
+        self.set_checkpoint_layers(getattr(Config, 'CHECKPOINT_LAYERS', None))
+
+    def set_checkpoint_layers(self, layers):
+        """
+        Encoder layers whose activations are recomputed in backward instead of stored
+        (activation checkpointing), only while training.
+        :param layers: None for no layer, 'all', or a list of layer indices
+        """
+        if layers == 'all':
+            layers = range(self.n_layers)
+        layers = sorted(set(layers or []))
+        if layers and self.relu_regularization_enabled:
+            # the recomputed forward would add the ReLU regularization a second time
+            print("Activation checkpointing is disabled with RELU_REGULARIZATION")
+            layers = []
+        if any(not 0 <= i < self.n_layers for i in layers):
+            raise ValueError(f"Checkpoint layers {layers} out of range for {self.n_layers} layers")
+        self.checkpoint_layers = layers
 
     def forward(self, x):
         # For unbatched 1D input, we add a batch dimension of 1
@@ -93,8 +105,13 @@ class MyTransformer(nn.Module):
         if self.use_pe:
             x = x + self.positional_encoding(x)
         x = self.drop_out(x)
-        for layer in self.layers:
-            x = layer(x, None)  # (batch_size, seq_len, d_model)
+        checkpointing = self.training and torch.is_grad_enabled()
+        for i, layer in enumerate(self.layers):
+            if checkpointing and i in self.checkpoint_layers:
+                # only the layer input is kept, the dropout masks are replayed in the recomputation
+                x = checkpoint(layer, x, None, use_reentrant=False)
+            else:
+                x = layer(x, None)  # (batch_size, seq_len, d_model)
 
         # taking the mean across the sequence dimension
         x = torch.mean(x, dim=1)  # (batch_size, d_model)
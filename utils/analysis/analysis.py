@@ -2,6 +2,7 @@ import argparse
 import pandas as pd
 import matplotlib.pyplot as plt
 from tokenizer import MyTokenizer
+from synonym_index import SynonymIndex
 from tqdm import tqdm
 import numpy as np
 import os
@@ -97,15 +98,37 @@ def analyse_embeddings(args):
     print(f"Shape of nn_matrix: {nn_matrix.shape}")
 
 
+def analyse_synonym_index(args):
+    print("Analysing precomputed synonym index...")
+    # Only the word list is loaded, the neighbours are memmapped
+    synonym_index = SynonymIndex.from_paragramcf_dir(args.paragramcf, args.synonym_index)
+    print(f"Synonym index: vocab size {len(synonym_index)}, k {synonym_index.k}")
+    for word in args.query_words:
+        neighbours = synonym_index.neighbours(word, k=args.num_neighbours)
+        if not neighbours:
+            print(f"{word}: out of vocabulary")
+            continue
+        print(f"{word}: " + ", ".join(
+            [f"{neighbour} ({sim:.3f})" for neighbour, sim in neighbours]))
+
+
 if __name__ == "__main__":
     # load csv data
     parser = argparse.ArgumentParser()
     parser.add_argument('--csv', type=str)
     parser.add_argument('--plot-len-hist', action='store_true', default=False)
     parser.add_argument('--paragramcf', type=str)
+    parser.add_argument('--synonym-index', type=str,
+                        help='Output dir of utils/synonym_index.py, defaults to {paragramcf}/synonym_index')
+    parser.add_argument('--query-words', type=str, nargs='*', default=[],
+                        help='Print the precomputed neighbours of these words')
+    parser.add_argument('--num-neighbours', type=int, default=10)
     args = parser.parse_args()
 
     if args.csv:
         analyse_csv(args)
     if args.paragramcf:
-        analyse_embeddings(args)
+        if args.query_words:
+            analyse_synonym_index(args)
+        else:
+            analyse_embeddings(args)
@@ -4,51 +4,60 @@
 # percentage of model output samples that are robust to all 6 attacks.
 
 import argparse
-import csv
 import os
 
-ATTACKS = ['textbugger', 'textfooler', 'bae', 'deepwordbug', 'pwws', 'a2t']
+from result_store import (
+    ATTACKS,
+    ModelResults,
+    ResultStore,
+    import_attack_details,
+    overall_robustness,
+)
 
 
-def calculate_overall_robustness(output_dir: str, model_name: str):
+def calculate_overall_robustness(output_dir: str, model_name: str, store_root: str = None, store_key: str = None):
     epoch_name = model_name.split('_')[-1].split('.')[0]  # e.g. 'epoch44'
-    # first get the number of samples by counting the number of rows in
-    # one of the csv files
-    num_samples = 0
-    with open(f'{output_dir}/attack_details/{epoch_name}/textbugger.csv', 'r') as f:
-        reader = csv.reader(f)
-        for _ in reader:
-            num_samples += 1
+    # each row of attack_details/{epoch}/{attack}.csv is one of ['s', 'f', 'k'] where
+    # s indicates success, f indicates failure, and k indicates skipped.
+    # They are read once into a (num_attacks, num_samples) outcome matrix, optionally
+    # kept in a result store (utils/result_store.py) for later queries
+    if store_root is not None:
+        store = ResultStore(store_root)
+        store_key = store_key or f"{os.path.basename(output_dir)}/{epoch_name}"
+        if not store.exists(store_key):
+            import_attack_details(store, store_key, f'{output_dir}/attack_details/{epoch_name}')
+        results = store.load(store_key)
+    else:
+        results = ModelResults()
+        details_dir = f'{output_dir}/attack_details/{epoch_name}'
+        for attack in ATTACKS:
+            with open(f'{details_dir}/{attack}.csv', 'r') as f:
+                outcomes = [line.strip() for line in f if line.strip()]
+            results.set_recipe(attack, range(len(outcomes)), outcomes)
+    num_samples = len(results.example_ids)
     print(f'Number of testing samples: {num_samples}')
 
-    # initialize the accuracy across attacks to 1 (all samples are robust)
-    accuracy_across_attacks = [1] * num_samples
-
-    # read in the results from the 6 attacks
+    # the sample is robust only if all 6 attacks are failures
+    overall, cumulative = overall_robustness(results.outcome_matrix(ATTACKS))
     for i, attack in enumerate(ATTACKS):
-        csv_path = f'{output_dir}/attack_details/{epoch_name}/{attack}.csv'
-        # read in the results from each attack
-        # each row is one of ['s', 'f', 'k'] where s indicates success,
-        # f indicates failure, and k indicates skipped
-        with open(csv_path, 'r') as f:
-            reader = csv.reader(f)
-            for j, row in enumerate(reader):
-                # the sample is robust only if all 6 attacks are failures
-                if row[0] == 's' or row[0] == 'k':
-                    accuracy_across_attacks[j] = 0
         print(f"{i+1}/{len(ATTACKS)}: After {attack}, overall robustness accuracy: "
-              f"{sum(accuracy_across_attacks) / num_samples * 100:.2f}%")
+              f"{cumulative[i] * 100:.2f}%")
 
     # calculate the overall robustness accuracy
-    overall_robustness = sum(accuracy_across_attacks) / num_samples * 100
-    print(f'Overall robustness accuracy: {overall_robustness:.2f}%')
+    overall_robustness_accuracy = overall * 100
+    print(f'Overall robustness accuracy: {overall_robustness_accuracy:.2f}%')
+    return overall_robustness_accuracy
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--model-path', type=str, required=True)
+    parser.add_argument('--store', type=str, default=None,
+                        help='Result store directory to read from and import into (utils/result_store.py)')
+    parser.add_argument('--store-key', type=str, default=None,
+                        help='Model key in the store, defaults to {model dir name}/{epoch}')
     args = parser.parse_args()
     output_dir = os.path.dirname(args.model_path)
     model_name = args.model_path.split('/')[-1]
 
-    calculate_overall_robustness(output_dir, model_name)
+    calculate_overall_robustness(output_dir, model_name, args.store, args.store_key)
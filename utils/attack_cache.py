@@ -0,0 +1,136 @@
+# Content-addressed cache of attack outcomes.
+# An attack record (see utils/attack_stream.attack_result_to_record) only depends on
+# the weights, the attack recipe, the query budget, the example and the tokenizer, so
+# it is stored in a sqlite database under the key
+#   (checkpoint content hash, recipe, query budget, example id, vocab fingerprint)
+# where the example id is a hash of the (truncated) text and label. Re-running an
+# attack on a checkpoint that was already attacked only attacks the missing examples.
+
+import hashlib
+import json
+import os
+import sqlite3
+
+_file_hashes = {}  # (path, size, mtime) -> sha256, so a checkpoint is hashed once per process
+
+
+def file_hash(path: str) -> str:
+    """
+    sha256 of the content of a file, e.g. a checkpoint
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+    if key not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        _file_hashes[key] = sha.hexdigest()
+    return _file_hashes[key]
+
+
+def vocab_fingerprint(Config) -> str:
+    """
+    Fingerprint of everything that decides the token ids of a text, without loading the vocab
+    """
+    parts = {
+        "word_embedding": Config.WORD_EMBEDDING,
+        "max_seq_length": Config.MAX_SEQ_LENGTH,
+    }
+    if getattr(Config, 'PRUNED_EMBEDDING_DIR', None):
+        from project.utils.embedding_store import cache_prefix, WORD2ID_SUFFIX
+        parts["vocab"] = file_hash(cache_prefix(Config) + WORD2ID_SUFFIX)
+    elif Config.WORD_EMBEDDING == 'custom':
+        parts["vocab"] = file_hash(Config.CUSTOM_VOCAB_PATH)
+    elif Config.WORD_EMBEDDING == 'glove':
+        parts["vocab"] = f"glove.6B.{Config.GLOVE_EMBEDDING_SIZE}d"
+    elif Config.WORD_EMBEDDING == 'paragramcf':
+        parts["vocab"] = file_hash(os.path.join(Config.PARAGRAMCF_DIR, 'wordlist.pickle'))
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def example_id(text: str, label) -> str:
+    return hashlib.sha1(f"{int(label)}\t{text}".encode()).hexdigest()
+
+
+class AttackResultCache():
+    """
+    sqlite backed cache of attack records, safe to share between worker processes
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = None
+        self._pid = None
+        self.num_hits = 0
+        self.num_misses = 0
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS records (
+                    model_hash TEXT, recipe TEXT, query_budget INTEGER, fingerprint TEXT,
+                    example_id TEXT, record TEXT,
+                    PRIMARY KEY (model_hash, recipe, query_budget, fingerprint, example_id))
+            """)
+
+    def _connection(self) -> sqlite3.Connection:
+        # a connection cannot be shared with forked or spawned processes
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._pid = os.getpid()
+        return self._conn
+
+    def get_many(self, context: tuple, example_ids: list) -> dict:
+        """
+        :param context: (model_hash, recipe, query_budget, fingerprint)
+        Return {example id: record} of the cached examples
+        """
+        found = {}
+        conn = self._connection()
+        # stay below the sqlite limit of variables per statement
+        for start in range(0, len(example_ids), 500):
+            chunk = example_ids[start:start + 500]
+            rows = conn.execute(
+                f"SELECT example_id, record FROM records WHERE model_hash = ? AND recipe = ? "
+                f"AND query_budget = ? AND fingerprint = ? AND example_id IN ({','.join('?' * len(chunk))})",
+                (*context, *chunk)).fetchall()
+            for row_id, record in rows:
+                found[row_id] = json.loads(record)
+        return found
+
+    def put_many(self, context: tuple, example_ids: list, records: list):
+        with self._connection() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?, ?)",
+                [(*context, row_id, json.dumps(record)) for row_id, record in zip(example_ids, records)])
+
+    def attack_with_cache(self, context: tuple, examples: list, attack_fn) -> list:
+        """
+        Return the records of (text, label) examples, in order, only calling
+        attack_fn(missing examples) -> records for the examples that are not cached
+        """
+        ids = [example_id(text, label) for text, label in examples]
+        cached = self.get_many(context, ids)
+        missing = [i for i, row_id in enumerate(ids) if row_id not in cached]
+        self.num_hits += len(examples) - len(missing)
+        self.num_misses += len(missing)
+        if missing:
+            new_records = attack_fn([examples[i] for i in missing])
+            missing_ids = [ids[i] for i in missing]
+            self.put_many(context, missing_ids, new_records)
+            cached.update(zip(missing_ids, new_records))
+        return [cached[row_id] for row_id in ids]
+
+    def get_stats(self) -> dict:
+        total = self.num_hits + self.num_misses
+        return {
+            "hits": self.num_hits,
+            "misses": self.num_misses,
+            "hit_rate": self.num_hits / total if total else 0,
+        }
+
+    def report(self) -> str:
+        stats = self.get_stats()
+        return (f"Attack cache: {stats['hits']} examples from cache, {stats['misses']} attacked "
+                f"({stats['hit_rate'] * 100:.2f}% hit rate)")
@@ -0,0 +1,350 @@
+# Concurrent attack evaluation, replaces the sequential loop of example-attack.sh.
+# Every (attack recipe, example shard) pair is a job on a process pool. Each worker
+# builds the victim model once, pins its torch threads, and caches the recipes it
+# has built. Finished shards are saved as json lines, so a crashed run resumes
+# with only the unfinished shards. The run parameters are saved next to them
+# (manifest.json), shards of a run with other parameters are never reused, see
+# check_manifest. Once all shards of a recipe are done, they are
+# merged in shard order and written to ta_results_{epoch}.csv with write_to_csv.
+#
+# Usage: PYTHONPATH=.. MODEL_CHOICE=transformer python utils/attack_runner.py \
+# --model-path tran/baseline/15head/transformer_model_epoch50.pt --num-examples 5000
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+DEFAULT_RECIPES = ["textbugger", "textfooler", "bae", "deepwordbug", "pwws", "a2t"]
+
+# state of a pool worker, set by _init_worker
+_worker_state = {}
+
+
+def epoch_from_model_path(model_path: str) -> str:
+    """
+    Same epoch name as example-attack.sh, e.g. transformer_model_epoch50.pt -> epoch50
+    """
+    name = os.path.basename(model_path)
+    parts = name.split('_')
+    if len(parts) >= 3:
+        name = parts[2]
+    return name[:-len(".pt")] if name.endswith(".pt") else name
+
+
+def shard_path(shard_dir: str, recipe: str, shard_idx: int) -> str:
+    return os.path.join(shard_dir, f"{recipe}_{shard_idx:04d}.jsonl")
+
+
+def run_manifest(model_path: str, data_path: str, num_examples: int, subset_seed: int, shard_size: int,
+                 query_budget: int, truncate: bool) -> dict:
+    """
+    Everything that decides the content of a shard, besides its recipe and index
+    """
+    model_stat = os.stat(model_path)
+    return {"model_path": os.path.abspath(model_path), "model_size": model_stat.st_size,
+            "model_mtime": model_stat.st_mtime, "data_path": os.path.abspath(data_path),
+            "num_examples": num_examples, "subset_seed": subset_seed, "shard_size": shard_size,
+            "query_budget": query_budget or 0, "truncate": truncate}
+
+
+def check_manifest(shard_dir: str, manifest: dict, fresh: bool = False):
+    """
+    Compare the parameters of this run with the manifest.json of shard_dir.
+    On a mismatch, raise unless fresh, which deletes the stale shards instead.
+    Write the manifest of this run, return whether stale shards were deleted.
+    """
+    manifest_file = os.path.join(shard_dir, "manifest.json")
+    shard_files = [name for name in os.listdir(shard_dir) if name.endswith(".jsonl")]
+    previous = None
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            previous = json.load(f)
+    if shard_files and previous != manifest:
+        if previous is None:
+            differences = "shards without manifest.json"
+        else:
+            differences = ", ".join(f"{key} {previous.get(key)} -> {value}" for key, value in manifest.items()
+                                    if previous.get(key) != value)
+        if not fresh:
+            raise ValueError(f"{shard_dir} holds shards of a different run ({differences}), "
+                             f"rerun with --fresh to delete them or use another --output-dir / --epoch")
+        print(f"Deleting {len(shard_files)} stale shards of {shard_dir} ({differences})")
+        for name in shard_files:
+            os.remove(os.path.join(shard_dir, name))
+        stale = True
+    else:
+        stale = False
+    with open(manifest_file, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return stale
+
+
+def make_jobs(recipes: list, num_examples: int, shard_size: int) -> list:
+    """
+    Return (recipe, shard_idx, start, end) jobs, recipe by recipe
+    """
+    jobs = []
+    for recipe in recipes:
+        for shard_idx, start in enumerate(range(0, num_examples, shard_size)):
+            jobs.append((recipe, shard_idx, start, min(start + shard_size, num_examples)))
+    return jobs
+
+
+def _init_worker(config_path, model_choice, model_path, num_threads, truncate, model_cache_size,
+                 inference_server=None, attack_cache_path=None, model_hash=None):
+    """
+    Build the victim model once per worker process,
+    or connect to an inference server that already serves it
+    """
+    import torch
+    from project.utils.cached_model_wrapper import CachedModelWrapper
+    from project.utils.model_factory import construct_model_from_config, load_config, ModelWithSigmoid
+    from project.utils.tokenizer import MyTokenizer
+
+    # OMP_NUM_THREADS is already set by the parent, torch also needs to be told
+    torch.set_num_threads(num_threads)
+    torch.set_num_interop_threads(1)
+    os.environ['MODEL_CHOICE'] = model_choice
+    _worker_state["attacks"] = {}
+    _worker_state["attack_cache"] = None
+    if attack_cache_path:
+        from project.utils.attack_cache import AttackResultCache, vocab_fingerprint
+        _worker_state["attack_cache"] = AttackResultCache(attack_cache_path)
+        _worker_state["cache_context"] = (model_hash, vocab_fingerprint(load_config(config_path)))
+    if inference_server:
+        from project.utils.inference_server import RemoteModelWrapper
+        Config = load_config(config_path)
+        _worker_state["model_wrapper"] = RemoteModelWrapper(inference_server)
+        _worker_state["model_tokenizer"] = \
+            MyTokenizer(None, Config.MAX_SEQ_LENGTH, remove_stopwords=False) if truncate else None
+        return
+    model, Config, vocab, device = construct_model_from_config(config_path)
+    model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+    model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    _worker_state["model_wrapper"] = CachedModelWrapper(
+        ModelWithSigmoid(model), model_tokenizer, model_cache_size)
+    _worker_state["model_tokenizer"] = model_tokenizer if truncate else None
+
+
+def _run_shard(recipe, shard_idx, examples, query_budget, output_file) -> tuple:
+    """
+    Attack one shard in a worker and save its records to output_file
+    """
+    import torch
+    from project.utils.attack_stream import build_attack_recipe, stream_attack_records
+
+    attacks = _worker_state["attacks"]
+    if recipe not in attacks:
+        attacks[recipe] = build_attack_recipe(recipe, _worker_state["model_wrapper"])
+    model_tokenizer = _worker_state["model_tokenizer"]
+    if model_tokenizer is not None:
+        # same truncation as ta_data_loader.py
+        examples = [(model_tokenizer.truncate(text), label) for text, label in examples]
+
+    def attack_fn(examples_to_attack):
+        with torch.no_grad():
+            return list(stream_attack_records(attacks[recipe], examples_to_attack, query_budget))
+
+    start_time = time.time()
+    attack_cache = _worker_state["attack_cache"]
+    if attack_cache is not None:
+        model_hash, fingerprint = _worker_state["cache_context"]
+        num_hits = attack_cache.num_hits
+        records = attack_cache.attack_with_cache(
+            (model_hash, recipe, query_budget or 0, fingerprint), examples, attack_fn)
+        num_hits = attack_cache.num_hits - num_hits
+    else:
+        records = attack_fn(examples)
+        num_hits = 0
+    # write to a temporary file first, a shard file only exists once it is complete
+    tmp_file = f"{output_file}.tmp{os.getpid()}"
+    with open(tmp_file, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    os.replace(tmp_file, output_file)
+    return recipe, shard_idx, len(records), num_hits, time.time() - start_time
+
+
+def load_shard_records(shard_file: str) -> list:
+    with open(shard_file, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def merge_recipe(shard_dir: str, recipe: str, num_shards: int) -> dict:
+    """
+    Summarize all shards of a recipe, in shard order
+    """
+    from project.utils.id_attack import summarize_results
+    records = []
+    for shard_idx in range(num_shards):
+        records.extend(load_shard_records(shard_path(shard_dir, recipe, shard_idx)))
+    return summarize_results(records)
+
+
+def recipes_in_results_csv(csv_filename: str) -> set:
+    if not os.path.exists(csv_filename):
+        return set()
+    return set(pd.read_csv(csv_filename)["Attack Recipe"].tolist())
+
+
+def drop_recipes_from_results_csv(csv_filename: str, recipes: list):
+    if not os.path.exists(csv_filename):
+        return
+    df = pd.read_csv(csv_filename)
+    df[~df["Attack Recipe"].isin(recipes)].to_csv(csv_filename, index=False)
+
+
+def default_num_workers(threads_per_worker: int) -> int:
+    return max(1, (os.cpu_count() or 1) // threads_per_worker)
+
+
+def run_attack_evaluation(model_path: str, recipes: list, data_path: str, num_examples: int,
+                          query_budget: int, shard_size: int = 250, num_workers: int = None,
+                          threads_per_worker: int = 1, output_dir: str = None, epoch: str = None,
+                          ta_results_file_prefix: str = "ta_results", truncate: bool = True,
+                          model_cache_size: int = 2**15, inference_server: str = None,
+                          attack_cache_path: str = None, subset_seed: int = None, fresh: bool = False) -> dict:
+    """
+    Attack the seeded, stratified num_examples of data_path with every recipe
+    and write one row per recipe to {output_dir}/{ta_results_file_prefix}_{epoch}.csv.
+    With inference_server, the workers share the model of utils/inference_server.py,
+    which cannot run gradient based recipes (GRADIENT_RECIPES of utils/attack_stream.py).
+    With attack_cache_path, examples already attacked on the same checkpoint
+    are taken from the cache (utils/attack_cache.py).
+    Finished shards of an earlier run are only reused with the same parameters,
+    with fresh the shards of a run with other parameters are deleted instead of raising.
+    Return a dict of recipe -> summary
+    """
+    from project.utils.attack_stream import GRADIENT_RECIPES
+    from project.utils.attack_subset import AttackSubset, env_seed
+    from project.utils.ta_output_parser import write_to_csv
+
+    if inference_server and set(recipes) & set(GRADIENT_RECIPES):
+        # the server only returns probabilities
+        raise ValueError(f"{sorted(set(recipes) & set(GRADIENT_RECIPES))} need gradients and cannot attack "
+                         f"an inference server, leave them out of --recipes or drop --inference-server")
+    output_dir = output_dir or os.path.dirname(model_path)
+    epoch = epoch or epoch_from_model_path(model_path)
+    config_path = f"{os.path.dirname(model_path)}/config.py"
+    num_workers = num_workers or default_num_workers(threads_per_worker)
+    shard_dir = os.path.join(output_dir, f"{ta_results_file_prefix}_{epoch}_shards")
+    os.makedirs(shard_dir, exist_ok=True)
+
+    # same seeded, stratified examples as ta_data_loader.py (utils/attack_subset.py)
+    data_folder, split = os.path.dirname(data_path), os.path.basename(data_path)[:-len('.csv')]
+    subset_seed = env_seed() if subset_seed is None else subset_seed
+    subset = AttackSubset(data_folder, split, num_examples, subset_seed)
+    examples = list(subset)
+    num_examples = len(examples)
+    num_shards = (num_examples + shard_size - 1) // shard_size
+    stale = check_manifest(shard_dir, run_manifest(model_path, data_path, num_examples, subset_seed, shard_size,
+                                           query_budget, truncate), fresh)
+
+    jobs = make_jobs(recipes, num_examples, shard_size)
+    pending = [job for job in jobs if not os.path.exists(shard_path(shard_dir, job[0], job[1]))]
+    print(f"{len(jobs)} jobs ({len(recipes)} recipes x {num_shards} shards), "
+          f"{len(jobs) - len(pending)} already done, {len(pending)} to run "
+          f"on {num_workers} workers x {threads_per_worker} threads")
+
+    if pending:
+        # children inherit the environment, so their BLAS pools are pinned from the start
+        for var in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "TF_NUM_INTRAOP_THREADS"]:
+            os.environ[var] = str(threads_per_worker)
+        os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+        model_hash = None
+        if attack_cache_path:
+            from project.utils.attack_cache import file_hash
+            model_hash = file_hash(model_path)
+        num_hits = 0
+        num_attacked = 0
+        start_time = time.time()
+        # CUDA cannot be re-initialised in a forked child
+        with ProcessPoolExecutor(
+                max_workers=min(num_workers, len(pending)),
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_init_worker,
+                initargs=(config_path, os.environ["MODEL_CHOICE"], model_path,
+                          threads_per_worker, truncate, model_cache_size, inference_server,
+                          attack_cache_path, model_hash)) as executor:
+            futures = [
+                executor.submit(_run_shard, recipe, shard_idx, examples[start:end], query_budget,
+                                shard_path(shard_dir, recipe, shard_idx))
+                for recipe, shard_idx, start, end in pending
+            ]
+            for num_done, future in enumerate(as_completed(futures), 1):
+                recipe, shard_idx, num_records, shard_hits, seconds = future.result()
+                num_hits += shard_hits
+                num_attacked += num_records - shard_hits
+                print(f"[{num_done}/{len(pending)}] {recipe} shard {shard_idx}: "
+                      f"{num_records} examples ({shard_hits} cached) in {seconds:.1f}s")
+        print(f"Ran {len(pending)} jobs in {time.time() - start_time:.1f}s")
+        if attack_cache_path:
+            print(f"Attack cache: {num_hits} examples from cache, {num_attacked} attacked "
+                  f"({num_hits / max(num_hits + num_attacked, 1) * 100:.2f}% hit rate)")
+
+    # merge in the order of recipes, so that the csv does not depend on the scheduling
+    csv_filename = f"{output_dir}/{ta_results_file_prefix}_{epoch}.csv"
+    if stale:
+        # the rows merged from the deleted shards are stale too
+        drop_recipes_from_results_csv(csv_filename, recipes)
+    written = recipes_in_results_csv(csv_filename)
+    results = {}
+    for recipe in recipes:
+        data = merge_recipe(shard_dir, recipe, num_shards)
+        results[recipe] = data
+        print(f"{recipe}: {data}")
+        if recipe in written:
+            print(f"{recipe} is already in {csv_filename}, not writing it again")
+            continue
+        write_to_csv(data, output_dir, epoch, recipe, ta_results_file_prefix)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='Victim model, config.py must be in the same folder')
+    parser.add_argument('--recipes', type=str, nargs='+', default=DEFAULT_RECIPES)
+    parser.add_argument('--data-path', type=str, default='data/yelp-polarity/test.csv')
+    parser.add_argument('--num-examples', type=int, default=5000)
+    parser.add_argument('--subset-seed', type=int, default=None,
+                        help='Seed of the attacked subset, defaults to TA_SUBSET_SEED or 0')
+    parser.add_argument('--query-budget', type=int, default=300,
+                        help='0 means unlimited')
+    parser.add_argument('--shard-size', type=int, default=250)
+    parser.add_argument('--num-workers', type=int, default=None,
+                        help='Defaults to the number of cpus / threads per worker')
+    parser.add_argument('--threads-per-worker', type=int, default=1)
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='Defaults to the folder of the model')
+    parser.add_argument('--epoch', type=str, default=None,
+                        help='Defaults to the epoch in the model file name, e.g. epoch50')
+    parser.add_argument('--no-truncation', action='store_true', default=False,
+                        help='Attack the full reviews instead of the MAX_SEQ_LENGTH tokens the model sees')
+    parser.add_argument('--inference-server', type=str, default=os.environ.get("TA_INFERENCE_SERVER"),
+                        help='Address of utils/inference_server.py serving --model-path, \
+                        instead of one model copy per worker (not for gradient based recipes, e.g. a2t)')
+    parser.add_argument('--attack-cache', type=str, default=None,
+                        help='sqlite file of cached attack records, defaults to {output dir}/attack_cache.sqlite')
+    parser.add_argument('--no-attack-cache', action='store_true', default=False,
+                        help='Attack every example again instead of using cached records')
+    parser.add_argument('--fresh', action='store_true', default=False,
+                        help='Delete finished shards of a run with other parameters instead of failing')
+    args = parser.parse_args()
+
+    assert os.environ.get("MODEL_CHOICE") in [
+        "lstm", "transformer"], "env var MODEL_CHOICE must be either lstm or transformer"
+    run_attack_evaluation(
+        args.model_path, args.recipes, args.data_path, args.num_examples, args.query_budget,
+        args.shard_size, args.num_workers, args.threads_per_worker, args.output_dir, args.epoch,
+        os.environ.get("TA_RESULTS_FILE_PREFIX", "ta_results"), not args.no_truncation,
+        inference_server=args.inference_server,
+        attack_cache_path=None if args.no_attack_cache else
+        (args.attack_cache or f"{args.output_dir or os.path.dirname(args.model_path)}/attack_cache.sqlite"),
+        subset_seed=args.subset_seed, fresh=args.fresh)
@@ -0,0 +1,248 @@
+# Bounded-memory attack result handling.
+# Attacker.attack_dataset() keeps every AttackResult (and its AttackedTexts)
+# alive in its log manager until the whole dataset is attacked. Instead we call
+# attack.attack() per example and turn each result into a compact record right
+# away. For long runs the attack can also live in a worker process that is
+# recycled once its RSS crosses a threshold.
+
+import multiprocessing
+import os
+
+import textattack
+from textattack.attack_recipes import (
+    TextFoolerJin2019,
+    A2TYoo2021,
+    BAEGarg2019,
+    DeepWordBugGao2018,
+    PWWSRen2019,
+    TextBuggerLi2018,
+)
+from textattack.attack_results import (
+    FailedAttackResult,
+    MaximizedAttackResult,
+    SkippedAttackResult,
+    SuccessfulAttackResult,
+)
+
+from project.utils.memory_budget import get_rss_mb
+
+OUTCOME_SUCCESS = 's'
+OUTCOME_FAILED = 'f'
+OUTCOME_SKIPPED = 'k'
+
+# recipes whose word importance ranking calls model_wrapper.get_grad
+GRADIENT_RECIPES = ["a2t"]
+
+
+def supports_gradients(model_wrapper) -> bool:
+    return type(model_wrapper).get_grad is not textattack.models.wrappers.ModelWrapper.get_grad
+
+
+def check_recipe_supported(attack_recipe: str, model_wrapper):
+    """
+    Fail before attacking if the recipe needs gradients that model_wrapper cannot compute,
+    e.g. RemoteModelWrapper of utils/inference_server.py
+    """
+    if attack_recipe in GRADIENT_RECIPES and not supports_gradients(model_wrapper):
+        raise ValueError(f"Attack recipe {attack_recipe} needs gradients, which {type(model_wrapper).__name__} "
+                         f"cannot compute, attack the PyTorch checkpoint instead")
+
+
+def build_attack_recipe(attack_recipe: str, model_wrapper):
+    """
+    Build one of the attack recipes used in adversarial training and evaluation
+    """
+    check_recipe_supported(attack_recipe, model_wrapper)
+    if attack_recipe == "textfooler":
+        attack = TextFoolerJin2019.build(model_wrapper)
+    elif attack_recipe == "a2t":
+        attack = A2TYoo2021.build(model_wrapper)
+    elif attack_recipe == "deepwordbug":
+        attack = DeepWordBugGao2018.build(model_wrapper)
+    elif attack_recipe == "pwws":
+        attack = PWWSRen2019.build(model_wrapper)
+    elif attack_recipe == "textbugger":
+        attack = TextBuggerLi2018.build(model_wrapper)
+    elif attack_recipe == "bae":
+        attack = BAEGarg2019.build(model_wrapper)
+    else:
+        raise ValueError(f"Unknown attack recipe {attack_recipe}")
+    return attack
+
+
+def attack_result_to_record(result, label) -> dict:
+    """
+    Turn an AttackResult into a compact record, so the heavyweight
+    AttackedText objects can be dropped immediately
+    """
+    original_text = result.original_result.attacked_text
+    if isinstance(result, (SuccessfulAttackResult, MaximizedAttackResult)):
+        outcome = OUTCOME_SUCCESS
+        attacked_text = result.perturbed_result.attacked_text
+    elif isinstance(result, FailedAttackResult):
+        outcome = OUTCOME_FAILED
+        attacked_text = original_text
+    elif isinstance(result, SkippedAttackResult):
+        outcome = OUTCOME_SKIPPED
+        attacked_text = original_text
+    else:
+        raise ValueError(f"Unknown attack result type {type(result)}")
+    num_words = max(len(original_text.words), 1)
+    if outcome == OUTCOME_SUCCESS:
+        perturbed_word_ratio = len(original_text.all_words_diff(attacked_text)) / num_words
+    else:
+        perturbed_word_ratio = 0.
+    return {
+        "text": tuple(attacked_text._text_input.values())[0],
+        "label": label,
+        "outcome": outcome,
+        "queries": result.perturbed_result.num_queries,
+        "perturbed_word_ratio": perturbed_word_ratio,
+    }
+
+
+def stream_attack_records(attack, examples, query_budget=None):
+    """
+    Attack (text, label) examples one by one and yield a compact record for each
+    :param examples: iterable of (text, label) or a textattack.datasets.Dataset
+    :param query_budget: maximum number of queries per example, None for unlimited
+    """
+    attack.goal_function.query_budget = query_budget if query_budget else float("inf")
+    if isinstance(examples, textattack.datasets.Dataset):
+        examples = (examples[i] for i in range(len(examples)))
+    for text, label in examples:
+        # text is a string, or an OrderedDict from textattack.datasets.Dataset
+        attacked_text = textattack.shared.AttackedText(text)
+        result = attack.attack(attacked_text, label)
+        record = attack_result_to_record(result, label)
+        # drop the AttackedTexts and the caches of this example
+        del result, attacked_text
+        attack.clear_cache()
+        yield record
+
+
+class RSSMonitor():
+    """
+    Record the peak RSS of every window of 1k attacked examples
+    """
+
+    def __init__(self, window=1000):
+        self.window = window
+        self.num_examples = 0
+        self.window_peak = 0.
+        self.peaks = []  # peak RSS (MB) of each finished window
+        self.num_recycles = 0
+
+    def update(self, num_examples: int, rss_mb: float):
+        self.window_peak = max(self.window_peak, rss_mb)
+        self.num_examples += num_examples
+        while self.num_examples >= (len(self.peaks) + 1) * self.window:
+            self.peaks.append(self.window_peak)
+            self.window_peak = rss_mb
+
+    def report(self) -> str:
+        peaks = self.peaks + ([self.window_peak] if self.num_examples % self.window else [])
+        peaks_str = ", ".join([f"{peak:.0f}" for peak in peaks])
+        return (f"Attacked {self.num_examples} examples, worker recycled {self.num_recycles} times, "
+                f"peak RSS (MB) per {self.window} examples: [{peaks_str}]")
+
+
+def _worker_main(conn, config_path, model_choice, model_path, attack_recipe,
+                 query_budget, max_rss_mb, model_cache_size):
+    """
+    Worker process: build the model and the attack once, then attack the
+    examples it receives until its RSS crosses max_rss_mb
+    """
+    import torch
+    from project.utils.cached_model_wrapper import CachedModelWrapper
+    from project.utils.model_factory import construct_model_from_config, ModelWithSigmoid
+    from project.utils.tokenizer import MyTokenizer
+
+    os.environ['MODEL_CHOICE'] = model_choice
+    model, Config, vocab, device = construct_model_from_config(config_path)
+    if model_path:
+        model.load_state_dict(torch.load(model_path, map_location=device))
+    model.eval()
+    model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    model_wrapper = CachedModelWrapper(ModelWithSigmoid(model), model_tokenizer, model_cache_size)
+    attack = build_attack_recipe(attack_recipe, model_wrapper)
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        examples, state_dict = message
+        if state_dict is not None:
+            # only the weights that changed are sent
+            model.load_state_dict(state_dict, strict=False)
+            model_wrapper.clear_cache()
+        model.eval()
+        with torch.no_grad():
+            records = list(stream_attack_records(attack, examples, query_budget))
+        rss_mb = get_rss_mb()
+        conn.send((records, rss_mb))
+        if max_rss_mb and rss_mb > max_rss_mb:
+            # the parent starts a fresh worker for the next examples
+            break
+    conn.close()
+
+
+class RecyclingAttackWorker():
+    """
+    Run attacks in a child process that is restarted (with a fresh heap) once its
+    RSS crosses max_rss_mb, instead of splitting the data over separate runs.
+    """
+
+    def __init__(self, config_path, model_choice, attack_recipe, query_budget=None,
+                 max_rss_mb=None, model_path=None, model_cache_size=2**15):
+        """
+        :param config_path: config.py of the victim model
+        :param model_path: optional checkpoint to load when the worker starts
+        :param max_rss_mb: recycle the worker once its RSS is above this, None for never
+        """
+        self.worker_args = (config_path, model_choice, model_path, attack_recipe,
+                            query_budget, max_rss_mb, model_cache_size)
+        self.max_rss_mb = max_rss_mb
+        self.monitor = RSSMonitor()
+        self.process = None
+        self.conn = None
+        # CUDA cannot be re-initialised in a forked child
+        self.context = multiprocessing.get_context('spawn')
+
+    def _start(self):
+        self.conn, child_conn = self.context.Pipe()
+        self.process = self.context.Process(
+            target=_worker_main, args=(child_conn,) + self.worker_args, daemon=True)
+        self.process.start()
+        child_conn.close()
+
+    def _stop(self):
+        if self.process is not None:
+            self.process.join()
+            self.conn.close()
+        self.process = None
+
+    def attack(self, examples: list, state_dict=None) -> list:
+        """
+        Attack a list of (text, label) and return their records.
+        :param state_dict: weights to load before attacking, e.g. the trainable
+        parameters of the model being trained. A restarted worker only has the
+        weights of model_path, so pass the weights every time they change.
+        """
+        if self.process is None:
+            self._start()
+        self.conn.send((examples, state_dict))
+        records, rss_mb = self.conn.recv()
+        self.monitor.update(len(examples), rss_mb)
+        if self.max_rss_mb and rss_mb > self.max_rss_mb:
+            print(f"Attack worker RSS {rss_mb:.0f}MB > {self.max_rss_mb}MB, recycling worker")
+            self.monitor.num_recycles += 1
+            self._stop()
+        return records
+
+    def close(self):
+        if self.process is not None:
+            self.conn.send(None)
+            self._stop()
+
+    def report(self) -> str:
+        return self.monitor.report()
@@ -0,0 +1,190 @@
+# Seeded, stratified attack examples, loaded lazily.
+# The TextAttack dataset loaders used to read the whole test / val csv into a list of tuples at
+# import time, from a hardcoded data/yelp-polarity, and attacks then took the first --num-examples
+# rows. AttackSubset picks num_examples rows with the label proportions of the split, in a seeded
+# random order (so that any prefix is also close to stratified), and persists them as
+#   {subset_dir}/{split}_n{num_examples}_seed{seed}.rows.npy  row numbers of the split
+#   {subset_dir}/{split}_n{num_examples}_seed{seed}.csv       their text and label, for csv splits
+#   {subset_dir}/{split}_n{num_examples}_seed{seed}.source.json  size and mtime of the split they
+#                                                                were built from
+# (subset_dir defaults to {data_folder}/attack_subsets). Building the rows only reads the labels,
+# and the reviews are only read on first access: from the shards of an ingested split
+# (utils/review_shards.py), else from the small subset csv, written once from a streamed pass
+# over {split}.csv. Every recipe, checkpoint and process then attacks exactly the same examples.
+# When {split}.csv (or meta.json of its shards) changes, the rows and the csv are built again.
+#
+# The TextAttack loaders are configured by environment variables:
+#   TA_DATA_FOLDER    folder of the splits, defaults to data/yelp-polarity
+#   TA_NUM_EXAMPLES   number of examples, should match textattack --num-examples
+#   TA_SUBSET_SEED    seed of the subset, defaults to 0
+#   TA_SUBSET_DIR     folder of the persisted subsets
+#
+# Usage (build a subset ahead of a sweep):
+# PYTHONPATH=.. python utils/attack_subset.py --data-folder data/yelp-polarity --split test --num-examples 5000
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from project.utils.review_shards import has_shards, META_FILE, ReviewShards
+
+DEFAULT_DATA_FOLDER = "data/yelp-polarity"
+ROWS_SUFFIX = ".rows.npy"
+SOURCE_SUFFIX = ".source.json"
+
+
+def stratified_index(labels, num_examples: int, seed: int = 0) -> np.ndarray:
+    """
+    Rows of num_examples reviews with the label proportions of labels, in a seeded random order
+    """
+    labels = np.asarray(labels)
+    rng = np.random.default_rng(seed)
+    if num_examples >= len(labels):
+        return rng.permutation(len(labels))
+    classes, counts = np.unique(labels, return_counts=True)
+    quotas = counts * num_examples / len(labels)
+    num_taken = np.floor(quotas).astype(np.int64)
+    # the rows left over go to the classes with the largest remainders
+    num_left = num_examples - int(num_taken.sum())
+    num_taken[np.argsort(-(quotas - num_taken), kind='stable')[:num_left]] += 1
+    rows = np.concatenate([rng.choice(np.nonzero(labels == label)[0], count, replace=False)
+                           for label, count in zip(classes, num_taken)])
+    return rng.permutation(rows)
+
+
+def env_seed() -> int:
+    return int(os.environ.get("TA_SUBSET_SEED", 0))
+
+
+def attack_dataframe(df: pd.DataFrame, num_examples: int, seed: int = None) -> pd.DataFrame:
+    """
+    Same examples as AttackSubset, of a split already loaded as a DataFrame
+    :param seed: defaults to TA_SUBSET_SEED, as for the TextAttack loaders
+    """
+    seed = env_seed() if seed is None else seed
+    return df.iloc[stratified_index(df['label'].to_numpy(), num_examples, seed)].reset_index(drop=True)
+
+
+def read_split_labels(data_folder: str, split: str) -> np.ndarray:
+    if has_shards(data_folder, split):
+        return ReviewShards(os.path.join(data_folder, split)).labels
+    return pd.read_csv(os.path.join(data_folder, f"{split}.csv"), usecols=['label'])['label'].to_numpy()
+
+
+def split_source(data_folder: str, split: str) -> dict:
+    """
+    Size and mtime of the file the split is read from, meta.json of ingested shards else {split}.csv
+    """
+    if has_shards(data_folder, split):
+        path = os.path.join(data_folder, split, META_FILE)
+    else:
+        path = os.path.join(data_folder, f"{split}.csv")
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def read_csv_rows(csv_path: str, rows: np.ndarray, chunk_size: int = 50000) -> pd.DataFrame:
+    """
+    Rows of csv_path in the order of rows, streaming the file chunk by chunk
+    """
+    wanted = np.sort(rows)
+    chunks = []
+    for chunk in pd.read_csv(csv_path, chunksize=chunk_size):
+        start = chunk.index[0]
+        selected = wanted[(wanted >= start) & (wanted < start + len(chunk))]
+        chunks.append(chunk.loc[selected, ['text', 'label']])
+    df = pd.concat(chunks)
+    return df.loc[rows].reset_index(drop=True)
+
+
+def _save_atomic(path: str, save_fn):
+    # concurrent recipes may build the same subset, they write the same content
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, 'wb') as f:
+        save_fn(f)
+    os.replace(tmp_path, path)
+
+
+class AttackSubset():
+    """
+    Lazy sequence of the (text, label) attack examples of a split
+    """
+
+    def __init__(self, data_folder: str, split: str, num_examples: int, seed: int = 0,
+                 subset_dir: str = None):
+        self.data_folder = data_folder
+        self.split = split
+        self.prefix = os.path.join(subset_dir or os.path.join(data_folder, "attack_subsets"),
+                                   f"{split}_n{num_examples}_seed{seed}")
+        source = split_source(data_folder, split)
+        if os.path.exists(self.prefix + ROWS_SUFFIX) and self._saved_source() == source:
+            self.rows = np.load(self.prefix + ROWS_SUFFIX)
+        else:
+            if os.path.exists(self.prefix + ROWS_SUFFIX):
+                print(f"{data_folder}/{split} changed since {self.prefix} was built, building it again")
+            self.rows = stratified_index(read_split_labels(data_folder, split), num_examples, seed)
+            os.makedirs(os.path.dirname(self.prefix), exist_ok=True)
+            _save_atomic(self.prefix + ROWS_SUFFIX, lambda f: np.save(f, self.rows))
+            # the texts of the old rows
+            try:
+                os.remove(self.prefix + ".csv")
+            except FileNotFoundError:
+                pass
+            # written last, it marks the rows as built from source
+            _save_atomic(self.prefix + SOURCE_SUFFIX, lambda f: f.write(json.dumps(source).encode()))
+        self._examples = None  # read on first access
+
+    def _saved_source(self):
+        if not os.path.exists(self.prefix + SOURCE_SUFFIX):
+            return None
+        with open(self.prefix + SOURCE_SUFFIX, 'r') as f:
+            return json.load(f)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _load(self):
+        if has_shards(self.data_folder, self.split):
+            return ReviewShards(os.path.join(self.data_folder, self.split)).select(self.rows)
+        csv_path = self.prefix + ".csv"
+        if not os.path.exists(csv_path):
+            df = read_csv_rows(os.path.join(self.data_folder, f"{self.split}.csv"), self.rows)
+            _save_atomic(csv_path, lambda f: df.to_csv(f, index=False))
+        df = pd.read_csv(csv_path)
+        return list(zip(df['text'].tolist(), df['label'].tolist()))
+
+    def __getitem__(self, i):
+        if self._examples is None:
+            self._examples = self._load()
+        return self._examples[i]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+def subset_from_env(split: str, default_num_examples: int) -> AttackSubset:
+    """
+    AttackSubset of the TextAttack dataset loaders, from the TA_* environment variables
+    """
+    return AttackSubset(os.environ.get("TA_DATA_FOLDER", DEFAULT_DATA_FOLDER), split,
+                        int(os.environ.get("TA_NUM_EXAMPLES", default_num_examples)),
+                        env_seed(), os.environ.get("TA_SUBSET_DIR"))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--data-folder', type=str, default=DEFAULT_DATA_FOLDER)
+    parser.add_argument('--split', type=str, default='test')
+    parser.add_argument('--num-examples', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--subset-dir', type=str, default=None)
+    args = parser.parse_args()
+
+    subset = AttackSubset(args.data_folder, args.split, args.num_examples, args.seed, args.subset_dir)
+    labels = np.array([label for _, label in subset])
+    print(f"{len(subset)} examples of {args.data_folder}/{args.split}, "
+          f"label counts {np.bincount(labels).tolist()}, saved to {subset.prefix}")
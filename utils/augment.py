@@ -8,85 +8,50 @@ import torch
 import os
 
 from tqdm import tqdm
-from textattack import Attacker
-from textattack import AttackArgs
-from textattack.attack_recipes import TextFoolerJin2019
-from textattack.attack_results import (
-    FailedAttackResult,
-    MaximizedAttackResult,
-    SkippedAttackResult,
-    SuccessfulAttackResult,
-)
-from textattack.models.wrappers import PyTorchModelWrapper
-from torch.utils.data import DataLoader
 
+from attack_stream import (
+    RecyclingAttackWorker,
+    RSSMonitor,
+    build_attack_recipe,
+    stream_attack_records,
+)
+from cached_model_wrapper import CachedModelWrapper
+from data_pipeline import make_dataloader
+from memory_budget import get_rss_mb
 from model_factory import construct_model_from_config, ModelWithSigmoid
-from yelp_review_dataset import YelpReviewDataset
+from review_shards import has_shards, open_split, review_dataset, ReviewShards
 from tokenizer import MyTokenizer
+from truncation import TruncationStats, truncate_texts
 
 
-def _generate_attacked_texts(model_wrapper, train_dataset):
+def _generate_attacked_texts(attack, train_dataset, rss_monitor=None):
     """
     Adapted from https://github.com/Falanke21/TextAttack/blob/master/textattack/trainer.py
-    Generate adversarial examples using attacker.
+    Generate adversarial examples using a textfooler attack,
+    each AttackResult is turned into a compact record as soon as it is produced.
     params:
-        args: command line arguments from train.py
-        model_wrapper: PyTorchModelWrapper from TextAttack
+        attack: textfooler attack built from a model wrapper
         train_dataset: training dataset wrapped by textattack.datasets.Dataset
-        epoch: current epoch of training
+        rss_monitor: optional RSSMonitor to record memory usage
     """
-
-    attack = TextFoolerJin2019.build(model_wrapper)
-    num_train_adv_examples = len(train_dataset)
-    # generate example for all of training data.
-    attack_args = AttackArgs(
-        num_examples=num_train_adv_examples,
-        num_examples_offset=0,
-        query_budget=100,
-        shuffle=False,
-        parallel=False,
-        num_workers_per_device=1,
-        disable_stdout=True,
-        silent=True,
-    )
-    attack_args.attack_recipe = "textfooler"
-    attack_args.model_cache_size = 0
-    attack_args.constraint_cache_size = 0
-
-    attacker = Attacker(attack, train_dataset, attack_args=attack_args)
-    results = attacker.attack_dataset()
-
-    # atacked_texts is a list which might create reference which leads to memory leak
     attacked_texts = []
-    # attacked_texts will be a list of attacked text
-    for r in results:
-        # a successful attack
-        if isinstance(r, (SuccessfulAttackResult, MaximizedAttackResult)):
-            attacked_texts.append(
-                tuple(r.perturbed_result.attacked_text._text_input.values())[0])
-        # a failed attack
-        elif isinstance(r, FailedAttackResult):
-            attacked_texts.append(
-                tuple(r.original_result.attacked_text._text_input.values())[0])
-        # a skipped attack
-        elif isinstance(r, SkippedAttackResult):
-            attacked_texts.append(
-                tuple(r.original_result.attacked_text._text_input.values())[0])
-        else:
-            raise ValueError(f"Unknown attack result type {type(r)}")
-
-    attack.clear_cache()
-    # Delete TextAttack related objects to free up memory
-    del attacker, results, attack, model_wrapper, train_dataset, attack_args
+    for record in stream_attack_records(attack, train_dataset, query_budget=100):
+        attacked_texts.append(record["text"])
+    if rss_monitor is not None:
+        rss_monitor.update(len(attacked_texts), get_rss_mb())
     return attacked_texts
 
 
-def create_ta_dataset(text_lst, labels_lst, max_char_length=1500):
+def create_ta_dataset(text_lst, labels_lst, max_char_length=1500, model_tokenizer=None,
+                      truncation_stats=None):
     """
     Create a textattack dataset from a list of text and labels.
     Filter text that is too long. This prevents memory error.
     A review with over 1500 characters is overkill.
+    If model_tokenizer is given, also cut every text after the last token the model can see.
     """
+    if model_tokenizer is not None:
+        text_lst = truncate_texts(text_lst, model_tokenizer, truncation_stats)
     for i in range(len(text_lst)):
         if len(text_lst[i]) > max_char_length:
             text_lst[i] = text_lst[i][:max_char_length]
@@ -101,8 +66,19 @@ def attack_and_save(train_dataset, output_csv_path):
     # Generate adversarial examples
     model_tokenizer = MyTokenizer(
         vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
-    model_wrapper = PyTorchModelWrapper(
-        ModelWithSigmoid(model), model_tokenizer)
+    truncation_stats = TruncationStats()
+    rss_monitor = RSSMonitor()
+    attack_worker = None
+    if args.max_worker_rss_mb:
+        # attack in a worker process that is recycled once its RSS is too large
+        attack_worker = RecyclingAttackWorker(
+            config_path, os.environ["MODEL_CHOICE"], "textfooler", query_budget=100,
+            max_rss_mb=args.max_worker_rss_mb, model_path=args.load_trained)
+    else:
+        # the model is fixed, so predictions can be cached for the whole run
+        model_wrapper = CachedModelWrapper(
+            ModelWithSigmoid(model), model_tokenizer)
+        attack = build_attack_recipe("textfooler", model_wrapper)
 
     print(f"Saving adversarial examples to {output_csv_path}...")
     # write header to csv file if it doesn't exist
@@ -115,12 +91,22 @@ def attack_and_save(train_dataset, output_csv_path):
         text_lst = list(text)
         # labels is a batched tensor of size (batch_size)
         labels_lst = labels.tolist()
-        train_dataset = create_ta_dataset(text_lst, labels_lst, 1500)
+        if args.no_truncation:
+            train_dataset = create_ta_dataset(text_lst, labels_lst, 1500)
+        else:
+            # Truncate to MAX_SEQ_LENGTH tokens so the attack does not waste queries
+            train_dataset = create_ta_dataset(
+                text_lst, labels_lst, 1500, model_tokenizer, truncation_stats)
 
         # Generate adversarial examples
-        with torch.no_grad():
-            attacked_texts = _generate_attacked_texts(
-                model_wrapper, train_dataset)
+        if attack_worker is not None:
+            records = attack_worker.attack(train_dataset._dataset)
+            attacked_texts = [record["text"] for record in records]
+            del records
+        else:
+            with torch.no_grad():
+                attacked_texts = _generate_attacked_texts(
+                    attack, train_dataset, rss_monitor)
 
         # Save and append to a csv file in the same folder as the trained model,
         # with the same format as the original csv file
@@ -128,6 +114,13 @@ def attack_and_save(train_dataset, output_csv_path):
         df = pd.DataFrame({'text': attacked_texts, 'label': labels_lst})
         df.to_csv(output_csv_path, mode='a', header=False, index=False)
         del attacked_texts
+    print(truncation_stats.report())
+    if attack_worker is not None:
+        print(attack_worker.report())
+        attack_worker.close()
+    else:
+        print(model_wrapper.report())
+        print(rss_monitor.report())
 
 
 if __name__ == '__main__':
@@ -145,6 +138,12 @@ if __name__ == '__main__':
     parser.add_argument('--concat-with-original', action='store_true',
                         help='Concatenate original training data with \
                               adversarial examples in output csv file')
+    parser.add_argument('--max-worker-rss-mb', type=float, default=None,
+                        help='Attack in a worker process that is recycled once \
+                              its RSS crosses this many MB')
+    parser.add_argument('--no-truncation', action='store_true',
+                        help='Attack full reviews instead of only the \
+                              MAX_SEQ_LENGTH tokens the model can see')
     args = parser.parse_args()
 
     # default config file to output_dir/config.py
@@ -160,27 +159,30 @@ if __name__ == '__main__':
     model.eval()
 
     # Load data
-    train_data = pd.read_csv(f'{args.csv_folder}/train.csv')
-    # Use only a proportion of training data for adversarial training
+    # ingested split (utils/review_shards.py) or train.csv
+    train_data = open_split(args.csv_folder, 'train')
+    # Use only a proportion of training data for adversarial training,
+    # a ReviewShards sample is a view, only the sampled reviews are read
     train_data = train_data.sample(frac=args.data_proportion)
-    # reset index
-    train_data = train_data.reset_index(drop=True)
     print(
         f"Using {args.data_proportion} of training data for adversarial training")
 
-    train_dataset = YelpReviewDataset(
+    train_dataset = review_dataset(
         train_data, vocab, Config.MAX_SEQ_LENGTH)
     # get dataloader from dataset
-    train_loader = DataLoader(
-        train_dataset, batch_size=args.attack_batch_size, shuffle=False)
+    train_loader = make_dataloader(
+        train_dataset, Config, batch_size=args.attack_batch_size, with_text=True)
 
     new_data_dir = f'{output_dir}/augment_csv_concat' if args.concat_with_original \
         else f'{output_dir}/augment_csv'
     os.makedirs(new_data_dir, exist_ok=True)
     # copy original test.csv and val.csv to new_data_dir
     print(f"Copying original test.csv and val.csv to {output_dir}...")
-    os.system(f"cp {args.csv_folder}/test.csv {new_data_dir}")
-    os.system(f"cp {args.csv_folder}/val.csv {new_data_dir}")
+    for split in ['test', 'val']:
+        if has_shards(args.csv_folder, split):
+            os.system(f"cp -r {args.csv_folder}/{split} {new_data_dir}")
+        else:
+            os.system(f"cp {args.csv_folder}/{split}.csv {new_data_dir}")
     output_csv_path = f'{new_data_dir}/train.csv'
     attack_and_save(train_dataset, output_csv_path)
 
@@ -188,7 +190,9 @@ if __name__ == '__main__':
         # Concatenate original training data with adversarial examples
         # in output csv file
         # Load original training data
-        original_train_data = pd.read_csv(f'{args.csv_folder}/train.csv')
+        original_train_data = open_split(args.csv_folder, 'train')
+        if isinstance(original_train_data, ReviewShards):
+            original_train_data = original_train_data.to_dataframe()
         # Load adversarial examples
         adv_train_data = pd.read_csv(output_csv_path)
         # Concatenate
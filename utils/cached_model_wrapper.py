@@ -0,0 +1,119 @@
+# TextAttack model wrapper with a bounded LRU cache of predictions.
+# Greedy and beam searches query the same perturbed texts over and over.
+# The cache is keyed by the token id tuple from MyTokenizer, so different
+# strings that tokenize identically (e.g. differ only in punctuation or case)
+# share one entry. Repeats within a batch are deduplicated before the forward.
+
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from textattack.models.wrappers import PyTorchModelWrapper
+
+
+class CachedModelWrapper(PyTorchModelWrapper):
+    """
+    Drop-in replacement of PyTorchModelWrapper(ModelWithSigmoid(model), MyTokenizer).
+    Call clear_cache() whenever the weights of the model change,
+    or use invalidate_on_step(optimizer) during training.
+    """
+
+    def __init__(self, model, tokenizer, cache_size: int = 2**15):
+        """
+        :param model: ModelWithSigmoid
+        :param tokenizer: MyTokenizer
+        :param cache_size: maximum number of cached predictions (and tokenized texts)
+        """
+        super(CachedModelWrapper, self).__init__(model, tokenizer)
+        self.cache_size = cache_size
+        # token id tuple -> model output (numpy)
+        self._cache = OrderedDict()
+        # text -> token id tuple, tokenization does not depend on the weights
+        self._text_cache = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.num_queries = 0  # texts asked by TextAttack
+        self.num_hits = 0  # answered by the cache
+        self.num_batch_duplicates = 0  # repeats within a batch
+        self.num_forwarded = 0  # texts that went through the model
+
+    def clear_cache(self):
+        """
+        Invalidate all cached predictions, the tokenized texts are kept
+        """
+        self._cache.clear()
+
+    def invalidate_on_step(self, optimizer):
+        """
+        Clear the cache after every optimizer.step(), e.g. in adversarial training
+        """
+        return optimizer.register_step_post_hook(lambda *args: self.clear_cache())
+
+    def _text_to_key(self, text: str) -> tuple:
+        key = self._text_cache.get(text)
+        if key is not None:
+            self._text_cache.move_to_end(text)
+            return key
+        key = tuple(self.tokenizer(text))
+        self._text_cache[text] = key
+        if len(self._text_cache) > self.cache_size:
+            self._text_cache.popitem(last=False)
+        return key
+
+    def __call__(self, text_input_list, batch_size=32):
+        self.num_queries += len(text_input_list)
+        keys = [self._text_to_key(text) for text in text_input_list]
+
+        # deduplicate misses within the batch
+        missing = OrderedDict()
+        for key in keys:
+            if key in self._cache:
+                continue
+            if key in missing:
+                self.num_batch_duplicates += 1
+            else:
+                missing[key] = None
+        if missing:
+            model_device = next(self.model.parameters()).device
+            missing_keys = list(missing.keys())
+            outputs = []
+            with torch.no_grad():
+                for start in range(0, len(missing_keys), batch_size):
+                    ids = torch.tensor(missing_keys[start:start + batch_size]).to(model_device)
+                    outputs.append(self.model(ids).cpu().numpy())
+            outputs = np.concatenate(outputs, axis=0)
+            self.num_forwarded += len(missing_keys)
+            for key, output in zip(missing_keys, outputs):
+                missing[key] = output
+
+        result = []
+        for key in keys:
+            if key in missing:
+                result.append(missing[key])
+            else:
+                self.num_hits += 1
+                self._cache.move_to_end(key)
+                result.append(self._cache[key])
+        # only insert after the lookups, so that evicting cannot drop a key of this batch
+        for key, output in missing.items():
+            self._cache[key] = output
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return np.stack(result, axis=0)
+
+    def get_stats(self) -> dict:
+        return {
+            "queries": self.num_queries,
+            "cache_hits": self.num_hits,
+            "batch_duplicates": self.num_batch_duplicates,
+            "forwarded": self.num_forwarded,
+            "hit_rate": self.num_hits / self.num_queries if self.num_queries else 0,
+            "saved_forwards": self.num_queries - self.num_forwarded,
+        }
+
+    def report(self) -> str:
+        stats = self.get_stats()
+        return (f"Model cache: {stats['queries']} queries, {stats['cache_hits']} cache hits "
+                f"({stats['hit_rate'] * 100:.2f}%), {stats['batch_duplicates']} batch duplicates, "
+                f"{stats['saved_forwards']} forwards saved")
@@ -96,6 +96,18 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("arch", help="Architecture of the model")
     parser.add_argument("best_head", help="Best head of the model")
+    parser.add_argument("--store", default=None,
+                        help="Read the ta_results from a result store (utils/result_store.py) \
+                        of vol_folder/model_zoo instead of the csv files")
     args = parser.parse_args()
 
-    find_ci_from_rootdir(args.arch, args.best_head)
+    if args.store:
+        from result_store import ResultStore, ci_over_trials
+        std_acc_mean, std_acc_ci, acc_under_attack_mean, acc_under_attack_ci = ci_over_trials(
+            ResultStore(args.store), "continue/4-layer", args.arch, args.best_head)
+        print(f"Architecture: {args.arch}, best_head: {args.best_head}")
+        print(f"Standard accuracy: {std_acc_mean:.2f}% ± {std_acc_ci:.2f}%")
+        print(
+            f"Accuracy under attack: {acc_under_attack_mean:.2f}% ± {acc_under_attack_ci:.2f}%")
+    else:
+        find_ci_from_rootdir(args.arch, args.best_head)
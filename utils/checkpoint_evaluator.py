@@ -0,0 +1,202 @@
+# Evaluate many checkpoints of the same model together.
+# The validation set is tokenized once, and the weights of a group of checkpoints
+# are stacked so that one torch.func.vmap pass over the data evaluates all of them.
+# Weights that are the same in every checkpoint (e.g. frozen GloVe / paragramcf
+# embeddings) are not stacked, they are shared by the whole group.
+# If a group does not fit in memory it is split in halves, and models that vmap
+# does not support (nn.LSTM, attentions with in-place ops such as diag) fall back
+# to loading one checkpoint at a time, still without re-tokenizing.
+#
+# Usage: PYTHONPATH=.. MODEL_CHOICE=transformer python utils/checkpoint_evaluator.py \
+# --csv-folder data/yelp-polarity --output-dir tran/baseline/15head <--adversarial>
+
+import argparse
+import os
+import time
+
+import pandas as pd
+import torch
+import torch.nn as nn
+from torch.func import functional_call, vmap
+from tqdm import tqdm
+
+
+def tokenize_dataframe(df: pd.DataFrame, vocab, seq_length: int) -> tuple:
+    """
+    Tokenize every review once, return (ids (N, seq_length) long tensor, labels (N,) float tensor)
+    """
+    from project.utils.tokenizer import MyTokenizer
+    model_tokenizer = MyTokenizer(vocab, seq_length, remove_stopwords=False)
+    ids = torch.tensor(model_tokenizer(df['text'].tolist()), dtype=torch.long)
+    labels = torch.tensor(df['label'].tolist(), dtype=torch.float)
+    return ids, labels
+
+
+def find_epoch_checkpoints(checkpoint_dir: str, epochs, adversarial: bool = False) -> dict:
+    """
+    Return {epoch: model path} of the epochs that exist in checkpoint_dir,
+    with the same file names as validation.find_model_path_for_current_epoch
+    """
+    checkpoints = {}
+    for epoch in epochs:
+        if adversarial:
+            model_path = f'{checkpoint_dir}/at_model_{epoch}.pt'
+        else:
+            model_path = f'{checkpoint_dir}/{os.environ["MODEL_CHOICE"]}_model_epoch{epoch}.pt'
+        if os.path.exists(model_path):
+            checkpoints[epoch] = model_path
+        else:
+            print(f"Could not find {model_path}, skipping epoch {epoch}")
+    return checkpoints
+
+
+def _is_out_of_memory(error: Exception) -> bool:
+    return isinstance(error, torch.cuda.OutOfMemoryError) or "out of memory" in str(error)
+
+
+class MultiCheckpointEvaluator():
+    """
+    Standard accuracy and loss of a list of checkpoints on pre-tokenized data
+    """
+
+    def __init__(self, model, ids, labels, device, batch_size: int = 200, group_size: int = None):
+        """
+        :param model: model object, its weights are only used for what is missing in the checkpoints
+        :param ids: (N, seq_length) token ids from tokenize_dataframe
+        :param group_size: maximum number of checkpoints per vmap pass, None for all of them
+        """
+        self.model = model
+        self.ids = ids
+        self.labels = labels
+        self.device = device
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.use_vmap = True
+        self.num_passes = 0
+
+    def _batches(self):
+        for start in range(0, len(self.ids), self.batch_size):
+            yield (self.ids[start:start + self.batch_size].to(self.device),
+                   self.labels[start:start + self.batch_size].to(self.device))
+
+    @staticmethod
+    def _accumulate(outputs, labels, correct, total_loss):
+        """
+        outputs: (num_models, batch, 1) logits, same accuracy and loss as get_standard_val_acc
+        """
+        outputs = outputs.squeeze(-1)
+        predicted = (outputs > 0).float()  # == torch.round(torch.sigmoid(outputs))
+        correct += (predicted == labels).sum(dim=1)
+        total_loss += nn.functional.binary_cross_entropy_with_logits(
+            outputs, labels.expand_as(outputs), reduction='none').mean(dim=1)
+        return correct, total_loss
+
+    def _evaluate_group_vmap(self, state_dicts: list) -> list:
+        """
+        Evaluate a group of state dicts in a single vmap pass over the data
+        """
+        # only stack the weights that differ between checkpoints
+        batched, shared = {}, {}
+        for key, value in state_dicts[0].items():
+            if all(torch.equal(value, state_dict[key]) for state_dict in state_dicts[1:]):
+                shared[key] = value.to(self.device)
+            else:
+                batched[key] = torch.stack([state_dict[key] for state_dict in state_dicts]).to(self.device)
+
+        def forward(batched_weights, shared_weights, x):
+            return functional_call(self.model, {**shared_weights, **batched_weights}, (x,))
+
+        batched_forward = vmap(forward, in_dims=(0, None, None))
+        correct = torch.zeros(len(state_dicts), device=self.device)
+        total_loss = torch.zeros(len(state_dicts), device=self.device)
+        num_batches = 0
+        with torch.no_grad():
+            for data, labels in self._batches():
+                outputs = batched_forward(batched, shared, data)
+                correct, total_loss = self._accumulate(outputs, labels, correct, total_loss)
+                num_batches += 1
+        self.num_passes += 1
+        return [(c / len(self.ids), loss / num_batches)
+                for c, loss in zip(correct.tolist(), total_loss.tolist())]
+
+    def _evaluate_sequential(self, state_dict) -> tuple:
+        self.model.load_state_dict(state_dict)
+        correct = torch.zeros(1, device=self.device)
+        total_loss = torch.zeros(1, device=self.device)
+        num_batches = 0
+        with torch.no_grad():
+            for data, labels in self._batches():
+                outputs = self.model(data).unsqueeze(0)
+                correct, total_loss = self._accumulate(outputs, labels, correct, total_loss)
+                num_batches += 1
+        self.num_passes += 1
+        return correct.item() / len(self.ids), total_loss.item() / num_batches
+
+    def _evaluate_group(self, state_dicts: list) -> list:
+        if self.use_vmap and len(state_dicts) > 1:
+            try:
+                return self._evaluate_group_vmap(state_dicts)
+            except RuntimeError as e:
+                if _is_out_of_memory(e):
+                    if self.device.type == 'cuda':
+                        torch.cuda.empty_cache()
+                    half = len(state_dicts) // 2
+                    print(f"Out of memory with {len(state_dicts)} checkpoints per pass, trying {half}")
+                    self.group_size = half
+                    return self._evaluate_group(state_dicts[:half]) + self._evaluate_group(state_dicts[half:])
+                print(f"vmap is not supported by this model ({str(e).splitlines()[0]}), "
+                      f"evaluating one checkpoint at a time")
+                self.use_vmap = False
+        return [self._evaluate_sequential(state_dict) for state_dict in state_dicts]
+
+    def evaluate(self, checkpoints: dict) -> dict:
+        """
+        :param checkpoints: {epoch: model path}, e.g. from find_epoch_checkpoints
+        Return {epoch: (standard accuracy, loss)}
+        """
+        self.model.eval()
+        epochs = sorted(checkpoints.keys())
+        results = {}
+        start_time = time.time()
+        with tqdm(total=len(epochs)) as progress:
+            while len(results) < len(epochs):
+                remaining = [epoch for epoch in epochs if epoch not in results]
+                group = remaining[:self.group_size or len(remaining)]
+                state_dicts = [torch.load(checkpoints[epoch], map_location='cpu') for epoch in group]
+                for epoch, result in zip(group, self._evaluate_group(state_dicts)):
+                    results[epoch] = result
+                del state_dicts
+                progress.update(len(group))
+        print(f"Evaluated {len(epochs)} checkpoints in {self.num_passes} passes "
+              f"over {len(self.ids)} examples, {time.time() - start_time:.1f}s")
+        return results
+
+
+if __name__ == "__main__":
+    from project.utils.model_factory import construct_model_from_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv-folder', type=str, required=True)
+    parser.add_argument('--output-dir', type=str, default='tmp')
+    parser.add_argument('--adversarial', action='store_true', default=False,
+                        help='Evaluate at_model_{n}.pt instead of {model}_model_epoch{n}.pt')
+    parser.add_argument('--group-size', type=int, default=None,
+                        help='Maximum number of checkpoints per pass, defaults to all of them')
+    args = parser.parse_args()
+
+    assert os.environ.get("MODEL_CHOICE") in [
+        "lstm", "transformer"], "env var MODEL_CHOICE must be either lstm or transformer"
+    model, Config, vocab, device = construct_model_from_config(f'{args.output_dir}/config.py')
+    if args.adversarial:
+        total_epochs = getattr(Config, 'NUM_ADV_EPOCHS', 1) * 10
+    else:
+        total_epochs = Config.NUM_EPOCHS
+    checkpoints = find_epoch_checkpoints(
+        f'{args.output_dir}/checkpoints', range(1, total_epochs + 1), args.adversarial)
+
+    val_data = pd.read_csv(f'{args.csv_folder}/val.csv').reset_index(drop=True)
+    ids, labels = tokenize_dataframe(val_data, vocab, Config.MAX_SEQ_LENGTH)
+    evaluator = MultiCheckpointEvaluator(model, ids, labels, device, Config.BATCH_SIZE, args.group_size)
+    results = evaluator.evaluate(checkpoints)
+    for epoch, (accuracy, loss) in results.items():
+        print(f"Epoch {epoch}: Validation Accuracy: {accuracy:.4f}, Validation Loss: {loss:.4f}")
@@ -0,0 +1,76 @@
+# Config-driven DataLoader settings shared by train.py, validation.py, test.py and utils/augment.py.
+# The reviews are tokenized in __getitem__, so with the default single process loader the
+# model waits for every batch to be tokenized. make_dataloader reads
+#   NUM_WORKERS         worker processes that tokenize ahead of the model, 0 for the main process
+#   PREFETCH_FACTOR     batches prefetched by each worker
+#   PERSISTENT_WORKERS  keep the workers alive between epochs instead of forking them again
+#   PIN_MEMORY          page-locked batches, so that .to(device, non_blocking=True) is asynchronous
+# from Config (older configs without them keep the single process loader), and only returns
+# the raw review texts when the caller needs them (adversarial training and augmentation),
+# otherwise the workers would pickle every review back to the main process.
+# DataWaitTimer wraps a loader and reports how long the training steps waited for their batches.
+
+import time
+
+import numpy as np
+from torch.utils.data import DataLoader
+
+from project.utils.yelp_review_dataset import collate_without_text
+
+
+def make_dataloader(dataset, Config, batch_size: int = None, shuffle: bool = False, sampler=None,
+                    with_text: bool = True, device=None, num_workers: int = None,
+                    prefetch_factor: int = None) -> DataLoader:
+    """
+    DataLoader of a YelpReviewDataset with the loader settings of Config
+    :param with_text: batches are (indices, labels, texts) if True, else (indices, labels)
+    :param device: device of the model, memory is only pinned for CUDA
+    :param num_workers: overrides Config.NUM_WORKERS, e.g. from a command line flag
+    """
+    if num_workers is None:
+        num_workers = getattr(Config, 'NUM_WORKERS', 0)
+    kwargs = {}
+    if num_workers > 0:
+        kwargs["prefetch_factor"] = prefetch_factor or getattr(Config, 'PREFETCH_FACTOR', 2)
+        kwargs["persistent_workers"] = getattr(Config, 'PERSISTENT_WORKERS', False)
+    pin_memory = getattr(Config, 'PIN_MEMORY', False) and device is not None and device.type == 'cuda'
+    return DataLoader(dataset, batch_size=batch_size or Config.BATCH_SIZE, shuffle=shuffle,
+                      sampler=sampler, num_workers=num_workers, pin_memory=pin_memory,
+                      collate_fn=None if with_text else collate_without_text, **kwargs)
+
+
+class DataWaitTimer():
+    """
+    Iterate a DataLoader and record, for every step, the seconds spent waiting
+    for the batch and the seconds spent on the step itself
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.wait_times = []
+        self.step_times = []
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        self.wait_times, self.step_times = [], []
+        step_end = time.perf_counter()
+        for batch in self.loader:
+            step_start = time.perf_counter()
+            self.wait_times.append(step_start - step_end)
+            yield batch
+            step_end = time.perf_counter()
+            self.step_times.append(step_end - step_start)
+
+    def report(self) -> str:
+        if not self.wait_times:
+            return "Data wait: no steps"
+        wait_ms = np.array(self.wait_times) * 1000
+        total_s = sum(self.wait_times) + sum(self.step_times)
+        # the first wait includes starting the workers
+        return (f"Data wait: {wait_ms.sum() / 1000:.2f}s of {total_s:.2f}s "
+                f"({wait_ms.sum() / 1000 / total_s * 100:.1f}%), per step mean {wait_ms.mean():.1f}ms, "
+                f"p50 {np.percentile(wait_ms, 50):.1f}ms, p99 {np.percentile(wait_ms, 99):.1f}ms, "
+                f"first {wait_ms[0]:.1f}ms, {len(wait_ms)} steps, "
+                f"{getattr(self.loader, 'num_workers', 0)} workers")
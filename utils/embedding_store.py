@@ -0,0 +1,162 @@
+# Single shared load of the pretrained GloVe / paragramcf embeddings.
+# Before, construct_model_from_config loaded GloVe for the vocab and MyTransformer /
+# MyLSTM loaded it a second time for the vectors (paragramcf: wordlist.pickle and
+# paragram.npy, both with full reads). The first load now writes a binary cache
+#   {name}.vectors.npy  the embedding matrix, opened as a copy-on-write memmap
+#   {name}.word2id.pkl  word -> row of the matrix
+# in Config.EMBEDDING_CACHE_DIR (defaults to the folder of the embeddings), and the
+# EmbeddingStore is memoized per process, so the vocab and the model constructors
+# share one copy of the vectors.
+# The ids are the same as with torchtext.vocab.GloVe.stoi and wordlist.pickle,
+# so existing checkpoints and vocab fingerprints are unchanged.
+# With Config.PRUNED_EMBEDDING_DIR set, the store is the compact vocabulary written by
+# utils/prune_embeddings.py instead, in the same format but with its own ids.
+#
+# Usage (build the cache and compare with the original loading):
+# PYTHONPATH=.. MODEL_CHOICE=transformer python utils/embedding_store.py --config-file tran/config.py
+
+import argparse
+import os
+import pickle
+import time
+
+import numpy as np
+import torch
+
+VECTORS_SUFFIX = ".vectors.npy"
+WORD2ID_SUFFIX = ".word2id.pkl"
+
+_stores = {}  # cache path prefix -> EmbeddingStore, loaded once per process
+
+
+class EmbeddingStore():
+    """
+    word2id and the (vocab_size, dim) embedding matrix of a pretrained embedding
+    """
+
+    def __init__(self, name: str, word2id: dict, vectors: torch.Tensor):
+        self.name = name
+        self.word2id = word2id
+        self.vectors = vectors
+
+    def __len__(self):
+        return len(self.word2id)
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+
+def embedding_name(Config) -> str:
+    if Config.WORD_EMBEDDING == 'glove':
+        return f"glove.6B.{Config.GLOVE_EMBEDDING_SIZE}d"
+    elif Config.WORD_EMBEDDING == 'paragramcf':
+        return "paragramcf"
+    raise ValueError(f"No pretrained embedding for Config.WORD_EMBEDDING = {Config.WORD_EMBEDDING}")
+
+
+def cache_prefix(Config) -> str:
+    pruned_dir = getattr(Config, 'PRUNED_EMBEDDING_DIR', None)
+    if pruned_dir:
+        return os.path.join(pruned_dir, embedding_name(Config))
+    if Config.WORD_EMBEDDING == 'glove':
+        default_dir = Config.GLOVE_CACHE_DIR
+    else:
+        default_dir = Config.PARAGRAMCF_DIR
+    cache_dir = getattr(Config, 'EMBEDDING_CACHE_DIR', None) or default_dir
+    return os.path.join(cache_dir, embedding_name(Config))
+
+
+def load_original_embeddings(Config) -> tuple:
+    """
+    Return (word2id, vectors as numpy array) with the original loaders
+    """
+    if Config.WORD_EMBEDDING == 'glove':
+        import torchtext
+        glove = torchtext.vocab.GloVe(
+            name='6B', dim=Config.GLOVE_EMBEDDING_SIZE, cache=Config.GLOVE_CACHE_DIR)
+        return dict(glove.stoi), glove.vectors.numpy()
+    elif Config.WORD_EMBEDDING == 'paragramcf':
+        word2id = np.load(os.path.join(Config.PARAGRAMCF_DIR, 'wordlist.pickle'), allow_pickle=True)
+        vectors = np.load(os.path.join(Config.PARAGRAMCF_DIR, "paragram.npy"))
+        return word2id, vectors
+    raise ValueError(f"No pretrained embedding for Config.WORD_EMBEDDING = {Config.WORD_EMBEDDING}")
+
+
+def write_cache(prefix: str, word2id: dict, vectors: np.ndarray):
+    """
+    Write the cache files next to each other, through temporary files so that
+    concurrent jobs never read a partial cache
+    """
+    os.makedirs(os.path.dirname(prefix), exist_ok=True)
+    tmp_suffix = f".tmp{os.getpid()}"
+    with open(prefix + WORD2ID_SUFFIX + tmp_suffix, 'wb') as f:
+        pickle.dump(word2id, f, protocol=pickle.HIGHEST_PROTOCOL)
+    with open(prefix + VECTORS_SUFFIX + tmp_suffix, 'wb') as f:
+        np.save(f, np.ascontiguousarray(vectors))
+    # the vectors are renamed last, they mark a complete cache
+    os.replace(prefix + WORD2ID_SUFFIX + tmp_suffix, prefix + WORD2ID_SUFFIX)
+    os.replace(prefix + VECTORS_SUFFIX + tmp_suffix, prefix + VECTORS_SUFFIX)
+
+
+def read_cache(prefix: str) -> tuple:
+    with open(prefix + WORD2ID_SUFFIX, 'rb') as f:
+        word2id = pickle.load(f)
+    # copy-on-write: pages are read on demand and shared with the page cache until written
+    vectors = np.load(prefix + VECTORS_SUFFIX, mmap_mode='c')
+    return word2id, vectors
+
+
+def load_embedding_store(Config) -> EmbeddingStore:
+    """
+    Return the EmbeddingStore of Config.WORD_EMBEDDING, building the cache on first use
+    """
+    prefix = cache_prefix(Config)
+    if prefix not in _stores:
+        if not os.path.exists(prefix + VECTORS_SUFFIX):
+            if getattr(Config, 'PRUNED_EMBEDDING_DIR', None):
+                raise FileNotFoundError(
+                    f"Could not find pruned embeddings {prefix}, run utils/prune_embeddings.py first")
+            print(f"Building embedding cache {prefix}")
+            word2id, vectors = load_original_embeddings(Config)
+            try:
+                write_cache(prefix, word2id, vectors)
+            except OSError as e:
+                # e.g. read-only shared folder, use the embeddings without a cache
+                print(f"Could not write embedding cache {prefix}: {e}")
+                _stores[prefix] = EmbeddingStore(embedding_name(Config), word2id, torch.from_numpy(vectors))
+                return _stores[prefix]
+        word2id, vectors = read_cache(prefix)
+        print(f"Loaded {embedding_name(Config)} embeddings of shape {vectors.shape} from {prefix}")
+        _stores[prefix] = EmbeddingStore(embedding_name(Config), word2id, torch.from_numpy(vectors))
+    return _stores[prefix]
+
+
+if __name__ == "__main__":
+    from project.utils.memory_budget import get_peak_rss_mb
+    from project.utils.model_factory import load_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', type=str, required=True)
+    parser.add_argument('--original', action='store_true', default=False,
+                        help='Time the original loaders instead of the cache, run it in a separate process')
+    args = parser.parse_args()
+
+    Config = load_config(args.config_file)
+    start_rss = get_peak_rss_mb()
+    start_time = time.perf_counter()
+    if args.original:
+        # vocab, then vectors again in the model constructor
+        load_original_embeddings(Config)
+        word2id, vectors = load_original_embeddings(Config)
+        vectors = torch.from_numpy(vectors)
+    else:
+        store = load_embedding_store(Config)
+        word2id, vectors = store.word2id, store.vectors
+        # the model constructor gets the same store
+        load_embedding_store(Config)
+    # nn.Embedding.from_pretrained reads every row once
+    vectors.sum()
+    print(f"{'Original' if args.original else 'Cached'} load of {embedding_name(Config)} "
+          f"{tuple(vectors.shape)}: {time.perf_counter() - start_time:.2f}s, "
+          f"peak RSS +{get_peak_rss_mb() - start_rss:.0f}MB")
@@ -40,8 +40,20 @@ if __name__ == "__main__":
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument(
         "rootdir", help="Root directory of the model architecture")
+    arg_parser.add_argument(
+        "--store", default=None,
+        help="Result store (utils/result_store.py), rootdir is then relative to the imported model zoo")
     args = arg_parser.parse_args()
 
+    if args.store:
+        from result_store import ResultStore, best_head
+        best_head_name, sums = best_head(ResultStore(args.store), args.rootdir, HEAD_CONFIGS)
+        for head, sum_acc in sums.items():
+            print(f"Heads: {head}, sum_acc: {sum_acc}")
+        print(f"\nArch: {args.rootdir}")
+        print(f"\nBest head: {best_head_name}, best sum acc: {sums[best_head_name]}")
+        exit(0)
+
     best_head = None
     best_sum_acc = 0
 
@@ -0,0 +1,343 @@
+# A native greedy word-importance + substitution attack that works directly on
+# the id tensors produced by MyTokenizer, similar to TextFooler without the USE
+# and POS constraints. Every candidate is scored in large batched forwards,
+# so it is a fast robustness estimator for training and model selection.
+# It is not a replacement for the TextAttack recipes reported in the paper,
+# use --calibrate-against to compare it with a ta_results_{epoch}.csv.
+
+# Usage:
+# export MODEL_CHOICE=transformer
+# python utils/id_attack.py --model-path tran/baseline/transformer_model_epoch50.pt \
+# --csv-folder data/yelp-polarity --num-examples 1000 --query-budget 300
+
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+import torch
+
+from project.utils.synonym_index import SynonymIndex, default_index_dir
+from project.utils.tokenizer import MyTokenizer
+
+OUTCOME_SUCCESS = 's'
+OUTCOME_FAILED = 'f'
+OUTCOME_SKIPPED = 'k'
+
+
+def build_candidate_table(word2id: dict, synonym_index: SynonymIndex, k: int = 50):
+    """
+    Map the synonym index (paragramcf id space) to the id space of the model vocab.
+    Return (candidates, sims) of shape (vocab_size, k), candidates are -1 when missing.
+    For paragramcf models the two id spaces are the same.
+    """
+    vocab_size = max(word2id.values()) + 1
+    # paragramcf id -> model id and model id -> paragramcf id
+    para2model = np.full(len(synonym_index), -1, dtype=np.int64)
+    model2para = np.full(vocab_size, -1, dtype=np.int64)
+    for word, model_id in word2id.items():
+        para_id = synonym_index.word2index.get(word)
+        if para_id is not None and para_id < len(synonym_index):
+            para2model[para_id] = model_id
+            model2para[model_id] = para_id
+
+    candidates = np.full((vocab_size, k), -1, dtype=np.int64)
+    sims = np.zeros((vocab_size, k), dtype=np.float32)
+    known = np.nonzero(model2para >= 0)[0]
+    candidates[known] = para2model[synonym_index.neighbour_ids(model2para[known], k)]
+    sims[known] = synonym_index.neighbour_sims(model2para[known], k)
+    return torch.from_numpy(candidates), torch.from_numpy(sims)
+
+
+class GreedyIdAttack():
+    """
+    Greedy attack on token ids:
+    1. Rank words by the drop of the true class probability when the word is deleted
+    2. In that order, replace each word with the counter-fitted synonym that lowers the
+       true class probability the most, until the prediction flips or the budget is used up
+    Reviews of a batch are attacked in lock-step, so every step is one batched forward.
+    """
+
+    def __init__(self, model, candidates, candidate_sims, device, query_budget=300,
+                 min_sim=0.5, max_candidates=50, max_perturb_ratio=None, batch_size=1024):
+        """
+        :param model: MyTransformer or MyLSTM returning logits of shape (batch_size, 1)
+        :param candidates, candidate_sims: output of build_candidate_table
+        :param query_budget: maximum number of model queries per review, None for unlimited
+        :param min_sim: minimum cosine similarity of a substitution
+        :param max_perturb_ratio: stop once this ratio of words is perturbed, None for unlimited
+        :param batch_size: maximum number of sequences per forward
+        """
+        self.model = model
+        self.candidates = candidates[:, :max_candidates]
+        self.candidate_sims = candidate_sims[:, :max_candidates]
+        self.device = device
+        self.query_budget = query_budget if query_budget else float('inf')
+        self.min_sim = min_sim
+        self.max_perturb_ratio = max_perturb_ratio
+        self.batch_size = batch_size
+        self.num_forwards = 0
+
+    @torch.no_grad()
+    def _true_class_prob(self, ids: torch.Tensor, labels: torch.Tensor) -> torch.Tensor:
+        """
+        Probability of the true class for every row, in chunks of self.batch_size
+        """
+        probs = []
+        for start in range(0, ids.shape[0], self.batch_size):
+            logits = self.model(ids[start:start + self.batch_size].to(self.device))
+            probs.append(torch.sigmoid(logits).squeeze(1).float().cpu())
+            self.num_forwards += 1
+        if not probs:
+            return torch.zeros(0)
+        probs = torch.cat(probs)
+        return torch.where(labels == 1, probs, 1 - probs)
+
+    def _valid_candidates(self, token_id: int):
+        candidates = self.candidates[token_id]
+        sims = self.candidate_sims[token_id]
+        valid = (candidates > 0) & (candidates != token_id) & (sims >= self.min_sim)
+        return candidates[valid], sims[valid]
+
+    def _word_importance(self, ids, labels, orig_probs, active, queries):
+        """
+        Delete every word (shift the rest to the left) and score all deletions of
+        all reviews in one batched pass. Return the positions of each review
+        sorted by importance, most important first.
+        """
+        seq_length = ids.shape[1]
+        padded = torch.cat([ids, torch.zeros(ids.shape[0], 1, dtype=ids.dtype)], dim=1)
+        arange = torch.arange(seq_length)
+        variants, owners, positions = [], [], []
+        for n in np.nonzero(active)[0]:
+            pos = torch.nonzero(ids[n] != 0).squeeze(1)
+            # do not rank more words than the budget allows
+            remaining = self.query_budget - queries[n]
+            if remaining < len(pos):
+                pos = pos[:int(max(remaining, 0))]
+            # for deletion at position j, token i comes from i + (i >= j)
+            src = arange.unsqueeze(0) + (arange.unsqueeze(0) >= pos.unsqueeze(1)).long()
+            variants.append(padded[n][src])
+            owners.append(torch.full((len(pos),), n, dtype=torch.long))
+            positions.append(pos)
+            queries[n] += len(pos)
+        orders = [[] for _ in range(ids.shape[0])]
+        if not variants:
+            return orders
+        variants = torch.cat(variants)
+        owners = torch.cat(owners)
+        deleted_probs = self._true_class_prob(variants, labels[owners])
+        offset = 0
+        for n, pos in zip(np.nonzero(active)[0], positions):
+            importance = orig_probs[n] - deleted_probs[offset:offset + len(pos)]
+            offset += len(pos)
+            orders[n] = pos[torch.argsort(importance, descending=True)].tolist()
+        return orders
+
+    def attack(self, ids: torch.Tensor, labels: torch.Tensor) -> list:
+        """
+        Attack a batch of reviews.
+        :param ids: (num_reviews, seq_length) ids from MyTokenizer
+        :param labels: (num_reviews,) labels
+        Return a list of dicts with outcome, queries, perturbed word ratio and perturbed ids
+        """
+        ids = ids.long().cpu().clone()
+        labels = labels.long().cpu()
+        num_reviews = ids.shape[0]
+        num_words = (ids != 0).sum(dim=1).clamp_min(1)
+
+        orig_probs = self._true_class_prob(ids, labels)
+        queries = np.ones(num_reviews)
+        # skipped: already misclassified
+        active = (orig_probs > 0.5).numpy()
+        outcomes = np.where(active, OUTCOME_FAILED, OUTCOME_SKIPPED)
+        orders = self._word_importance(ids, labels, orig_probs, active, queries)
+
+        cur_probs = orig_probs.clone()
+        pointers = np.zeros(num_reviews, dtype=np.int64)
+        num_perturbed = np.zeros(num_reviews, dtype=np.int64)
+        while active.any():
+            rows, owners, row_positions, row_sims = [], [], [], []
+            for n in np.nonzero(active)[0]:
+                candidates = torch.zeros(0, dtype=torch.long)
+                # find the next word that has synonyms, skipping costs no query
+                while pointers[n] < len(orders[n]) and len(candidates) == 0:
+                    position = orders[n][pointers[n]]
+                    candidates, sims = self._valid_candidates(int(ids[n, position]))
+                    pointers[n] += 1
+                remaining = int(min(self.query_budget - queries[n], len(candidates)))
+                if remaining <= 0:
+                    # no words left or budget used up
+                    active[n] = False
+                    continue
+                candidates, sims = candidates[:remaining], sims[:remaining]
+                substituted = ids[n].repeat(len(candidates), 1)
+                substituted[:, position] = candidates
+                rows.append(substituted)
+                owners.append(torch.full((len(candidates),), n, dtype=torch.long))
+                row_positions.append(position)
+                row_sims.append(sims)
+                queries[n] += len(candidates)
+            if not rows:
+                break
+
+            probs = self._true_class_prob(torch.cat(rows), labels[torch.cat(owners)])
+            offset = 0
+            for substituted, owner, position, sims in zip(rows, owners, row_positions, row_sims):
+                n = int(owner[0])
+                review_probs = probs[offset:offset + len(substituted)]
+                offset += len(substituted)
+                flipped = review_probs < 0.5
+                if flipped.any():
+                    # among the successful substitutions, keep the most similar word
+                    best = int(torch.argmax(torch.where(flipped, sims, torch.full_like(sims, -1))))
+                    ids[n] = substituted[best]
+                    num_perturbed[n] += 1
+                    outcomes[n] = OUTCOME_SUCCESS
+                    active[n] = False
+                    continue
+                best = int(torch.argmin(review_probs))
+                if review_probs[best] < cur_probs[n]:
+                    ids[n] = substituted[best]
+                    cur_probs[n] = review_probs[best]
+                    num_perturbed[n] += 1
+                if self.max_perturb_ratio is not None and \
+                        num_perturbed[n] / int(num_words[n]) > self.max_perturb_ratio:
+                    active[n] = False
+
+        results = []
+        for n in range(num_reviews):
+            results.append({
+                "outcome": str(outcomes[n]),
+                "queries": int(queries[n]),
+                "perturbed_word_ratio": float(num_perturbed[n] / int(num_words[n])),
+                "perturbed_ids": ids[n],
+            })
+        return results
+
+
+def summarize_results(results: list) -> dict:
+    """
+    Summarize attack results in the same format as utils/ta_output_parser.parse_ta_output
+    """
+    outcomes = [r["outcome"] for r in results]
+    num_success = outcomes.count(OUTCOME_SUCCESS)
+    num_failed = outcomes.count(OUTCOME_FAILED)
+    num_skipped = outcomes.count(OUTCOME_SKIPPED)
+    total = len(results)
+    attacked = num_success + num_failed
+    perturbed = [r["perturbed_word_ratio"] for r in results if r["outcome"] == OUTCOME_SUCCESS]
+    queries = [r["queries"] for r in results if r["outcome"] != OUTCOME_SKIPPED]
+    return {
+        "original_accuracy": f"{attacked / total * 100:.2f}%",
+        "accuracy_under_attack": f"{num_failed / total * 100:.2f}%",
+        "attack_success_rate": f"{(num_success / attacked * 100) if attacked else 0:.2f}%",
+        "avg_perturbed_word": f"{(np.mean(perturbed) * 100) if perturbed else 0:.2f}%",
+        "avg_num_queries": f"{np.mean(queries) if queries else 0:.2f}",
+    }
+
+
+def load_synonym_candidates(Config, vocab, k: int = 50):
+    """
+    Load the synonym index of Config.SYNONYM_INDEX_DIR, or the default one in
+    Config.PARAGRAMCF_DIR, and map it to the model vocab
+    """
+    model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    index_dir = getattr(Config, 'SYNONYM_INDEX_DIR', None) or \
+        default_index_dir(Config.PARAGRAMCF_DIR)
+    synonym_index = SynonymIndex.from_paragramcf_dir(Config.PARAGRAMCF_DIR, index_dir)
+    return build_candidate_table(model_tokenizer.word2id, synonym_index, k)
+
+
+def native_attack_texts(model, Config, vocab, device, texts: list, labels: list,
+                        query_budget=300, attack_batch_size=64, candidates=None, **attack_kwargs):
+    """
+    Tokenize texts once and attack them with GreedyIdAttack.
+    Return (list of per example results, summary dict)
+    """
+    model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    if candidates is None:
+        candidates = load_synonym_candidates(Config, vocab)
+    attack = GreedyIdAttack(model, candidates[0], candidates[1], device,
+                            query_budget=query_budget, **attack_kwargs)
+    ids = torch.tensor(model_tokenizer(list(texts)), dtype=torch.long)
+    labels = torch.tensor(list(labels), dtype=torch.long)
+    model.eval()
+    results = []
+    for start in range(0, len(ids), attack_batch_size):
+        results += attack.attack(ids[start:start + attack_batch_size],
+                                 labels[start:start + attack_batch_size])
+    return results, summarize_results(results)
+
+
+def calibration_report(native_data: dict, ta_results_csv: str, recipe: str = "textfooler"):
+    """
+    Compare the native attack with a TextAttack recipe in ta_results_{epoch}.csv
+    written by utils/ta_output_parser.write_to_csv
+    """
+    df = pd.read_csv(ta_results_csv)
+    row = df[df['Attack Recipe'] == recipe]
+    if len(row) == 0:
+        raise ValueError(f"Could not find {recipe} in {ta_results_csv}")
+    row = row.iloc[0]
+    print(f"\nCalibration against {recipe} in {ta_results_csv}")
+    print(f"{'':<28}{'native':>10}{recipe:>12}")
+    for name, key, column in [
+        ("Original accuracy", "original_accuracy", "Original accuracy"),
+        ("Accuracy under attack", "accuracy_under_attack", "Accuracy under attack"),
+        ("Attack success rate", "attack_success_rate", "Attack success rate"),
+        ("Average perturbed word %", "avg_perturbed_word", "Average perturbed word %"),
+    ]:
+        print(f"{name:<28}{native_data[key]:>10}{row[column]:>12}")
+    native_acc = float(native_data["accuracy_under_attack"][:-1])
+    ta_acc = float(row["Accuracy under attack"][:-1])
+    print(f"Accuracy under attack difference (native - {recipe}): {native_acc - ta_acc:+.2f}%")
+
+
+if __name__ == "__main__":
+    from project.utils.attack_subset import attack_dataframe
+    from project.utils.model_factory import construct_model_from_config
+    from project.utils.ta_output_parser import write_to_csv
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', type=str, required=True)
+    parser.add_argument('--csv-folder', type=str, required=True)
+    parser.add_argument('--split', type=str, default='test', choices=['test', 'val'])
+    parser.add_argument('--num-examples', type=int, default=1000)
+    parser.add_argument('--query-budget', type=int, default=300, help='0 means unlimited')
+    parser.add_argument('--attack-batch-size', type=int, default=64,
+                        help='Number of reviews attacked in lock-step')
+    parser.add_argument('--model-batch-size', type=int, default=1024,
+                        help='Maximum number of sequences per forward')
+    parser.add_argument('--min-sim', type=float, default=0.5)
+    parser.add_argument('--max-candidates', type=int, default=50)
+    parser.add_argument('--write-csv', action='store_true', default=False,
+                        help='Append the results to ta_results_{epoch}.csv as recipe "native-greedy"')
+    parser.add_argument('--calibrate-against', type=str,
+                        help='ta_results_{epoch}.csv to compare with')
+    args = parser.parse_args()
+
+    output_dir = os.path.dirname(args.model_path)
+    model, Config, vocab, device = construct_model_from_config(f'{output_dir}/config.py')
+    model.load_state_dict(torch.load(args.model_path, map_location=device))
+    model.eval()
+
+    # same seeded, stratified examples as the TextAttack rows of ta_results_{epoch}.csv
+    df = attack_dataframe(pd.read_csv(f'{args.csv_folder}/{args.split}.csv'), args.num_examples)
+    start_time = time.time()
+    results, data = native_attack_texts(
+        model, Config, vocab, device, df['text'].tolist(), df['label'].tolist(),
+        query_budget=args.query_budget, attack_batch_size=args.attack_batch_size,
+        min_sim=args.min_sim, max_candidates=args.max_candidates,
+        batch_size=args.model_batch_size)
+    elapsed = time.time() - start_time
+    for key, value in data.items():
+        print(f"{key}: {value}")
+    print(f"Attacked {len(results)} examples in {elapsed:.1f}s "
+          f"({len(results) / elapsed:.2f} examples/s)")
+
+    if args.write_csv:
+        epoch_num = os.path.basename(args.model_path).split('_')[-1].split('.')[0]
+        write_to_csv(data, output_dir, epoch_num, "native-greedy")
+    if args.calibrate_against:
+        calibration_report(data, args.calibrate_against)
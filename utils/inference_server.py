@@ -0,0 +1,349 @@
+# Local inference server for a victim model.
+# Several attack processes can share one copy of the model (and its embeddings)
+# instead of loading their own through ta_model_loader.py. Concurrent requests
+# are merged into larger batches: a batch is run once it has max_batch_size
+# reviews, or max_latency_ms after its first request arrived.
+# Only the standard library is used for the transport (multiprocessing.connection
+# over a Unix socket or a localhost port), so it runs fully offline.
+#
+# Usage:
+# PYTHONPATH=.. MODEL_CHOICE=transformer python utils/inference_server.py \
+# --model-path tran/baseline/15head/transformer_model_epoch50.pt --address /tmp/victim.sock
+# then point attacks at it with TA_INFERENCE_SERVER=/tmp/victim.sock (see ta_model_loader.py),
+# or use RemoteModelWrapper("/tmp/victim.sock") directly.
+# The server only returns probabilities: gradient based recipes (GRADIENT_RECIPES in
+# utils/attack_stream.py, i.e. a2t) need the PyTorch model in the attacking process
+# and are rejected with a RemoteModelWrapper.
+
+import argparse
+import os
+import pickle
+import queue
+import threading
+import time
+from collections import deque
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+from textattack.models.wrappers import ModelWrapper
+
+DEFAULT_AUTHKEY = b"victim-model"
+
+
+def parse_address(address: str):
+    """
+    "host:port" -> (host, port) for TCP, anything else is a Unix socket path
+    """
+    if not address.startswith("/") and ":" in address:
+        host, port = address.rsplit(":", 1)
+        return (host, int(port))
+    return address
+
+
+def get_authkey() -> bytes:
+    return os.environ.get("TA_INFERENCE_SERVER_AUTHKEY", DEFAULT_AUTHKEY.decode()).encode()
+
+
+def _send(conn, result):
+    try:
+        conn.send(result)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        # exceptions holding e.g. tensors or locks cannot be pickled
+        conn.send(RuntimeError(f"{type(result).__name__}: {result}"))
+
+
+class _Request():
+    def __init__(self, ids: np.ndarray):
+        self.ids = ids
+        self.arrival_time = time.perf_counter()
+        self.done = threading.Event()
+        self.output = None
+        self.error = None  # exception of the forward, raised again in predict
+
+
+class ServerStats():
+    """
+    Throughput and latency of the server, latency is from the arrival of
+    a request to its output being ready (queueing + batching + forward)
+    """
+
+    def __init__(self, window: int = 100000):
+        self.start_time = time.perf_counter()
+        self.num_requests = 0
+        self.num_reviews = 0
+        self.num_batches = 0
+        self.forward_seconds = 0.
+        self.latencies = deque(maxlen=window)  # seconds, of the last window requests
+        self.lock = threading.Lock()
+
+    def update(self, requests: list, forward_seconds: float):
+        now = time.perf_counter()
+        with self.lock:
+            self.num_batches += 1
+            self.forward_seconds += forward_seconds
+            for request in requests:
+                self.num_requests += 1
+                self.num_reviews += len(request.ids)
+                self.latencies.append(now - request.arrival_time)
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            elapsed = time.perf_counter() - self.start_time
+            latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+            return {
+                "requests": self.num_requests,
+                "reviews": self.num_reviews,
+                "batches": self.num_batches,
+                "avg_batch_size": self.num_reviews / self.num_batches if self.num_batches else 0,
+                "reviews_per_sec": self.num_reviews / elapsed if elapsed > 0 else 0,
+                "forward_busy": self.forward_seconds / elapsed if elapsed > 0 else 0,
+                "latency_p50_ms": float(np.percentile(latencies, 50)),
+                "latency_p99_ms": float(np.percentile(latencies, 99)),
+            }
+
+    def report(self) -> str:
+        stats = self.get_stats()
+        return (f"Inference server: {stats['requests']} requests, {stats['reviews']} reviews "
+                f"in {stats['batches']} batches (avg {stats['avg_batch_size']:.1f}), "
+                f"{stats['reviews_per_sec']:.1f} reviews/s, model busy {stats['forward_busy'] * 100:.1f}%, "
+                f"latency p50 {stats['latency_p50_ms']:.1f}ms p99 {stats['latency_p99_ms']:.1f}ms")
+
+
+class InferenceServer():
+    """
+    Serve the probabilities of ModelWithSigmoid(model) for lists of texts
+    """
+
+    def __init__(self, model, model_tokenizer, device, max_batch_size: int = 512,
+                 max_latency_ms: float = 5.):
+        """
+        :param model: ModelWithSigmoid, in eval mode
+        :param model_tokenizer: MyTokenizer
+        :param max_batch_size: maximum number of reviews per forward
+        :param max_latency_ms: how long the first request of a batch waits for others
+        """
+        self.model = model
+        self.model_tokenizer = model_tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.requests = queue.Queue()
+        self.stats = ServerStats()
+        self.stopped = threading.Event()
+
+    @classmethod
+    def from_checkpoint(cls, config_path: str, model_path: str, quantize: bool = False, **kwargs):
+        """
+        Load the model once through construct_model_from_config,
+        model_path can be an int8 artifact from utils/quantization.py
+        """
+        from project.utils.model_factory import ModelWithSigmoid
+        from project.utils.quantization import load_model_checkpoint
+        from project.utils.tokenizer import MyTokenizer
+
+        model, Config, vocab, device = load_model_checkpoint(config_path, model_path, quantize)
+        model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+        return cls(ModelWithSigmoid(model), model_tokenizer, device, **kwargs)
+
+    def predict(self, texts: list) -> np.ndarray:
+        """
+        Tokenize in the calling thread, then wait for the batcher
+        """
+        request = _Request(np.asarray(self.model_tokenizer(list(texts)), dtype=np.int64))
+        self.requests.put(request)
+        while not request.done.wait(0.1):
+            if self.stopped.is_set():
+                raise RuntimeError("The inference server stopped before answering the request")
+        if request.error is not None:
+            raise request.error
+        return request.output
+
+    def _next_batch(self) -> list:
+        try:
+            first = self.requests.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        batch = [first]
+        num_reviews = len(first.ids)
+        deadline = first.arrival_time + self.max_latency
+        while num_reviews < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_reviews += len(request.ids)
+        return batch
+
+    def _run_batch(self, batch: list):
+        import torch
+
+        start_time = time.perf_counter()
+        ids = np.concatenate([request.ids for request in batch], axis=0)
+        outputs = []
+        with torch.no_grad():
+            # a single request can be larger than max_batch_size
+            for start in range(0, len(ids), self.max_batch_size):
+                chunk = torch.from_numpy(ids[start:start + self.max_batch_size]).to(self.device)
+                outputs.append(self.model(chunk).cpu().numpy())
+        outputs = np.concatenate(outputs, axis=0)
+        self.stats.update(batch, time.perf_counter() - start_time)
+        offset = 0
+        for request in batch:
+            request.output = outputs[offset:offset + len(request.ids)]
+            offset += len(request.ids)
+
+    def _batch_loop(self):
+        while not self.stopped.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                # e.g. bad input or out of memory, the batcher keeps serving the other requests
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+        # answer the requests that arrived after a shutdown
+        while True:
+            try:
+                request = self.requests.get_nowait()
+            except queue.Empty:
+                break
+            request.error = RuntimeError("The inference server stopped before answering the request")
+            request.done.set()
+
+    def _handle_connection(self, conn):
+        try:
+            while True:
+                command, payload = conn.recv()
+                try:
+                    if command == "predict":
+                        result = self.predict(payload)
+                    elif command == "stats":
+                        result = self.stats.get_stats()
+                    elif command == "shutdown":
+                        result = True
+                        self.stopped.set()
+                    else:
+                        result = ValueError(f"Unknown command {command}")
+                except Exception as e:
+                    # RemoteModelWrapper raises it in the client
+                    result = e
+                _send(conn, result)
+                if command == "shutdown":
+                    break
+        except (EOFError, OSError):
+            # the client has gone away
+            pass
+        finally:
+            conn.close()
+
+    def serve_forever(self, address, authkey: bytes = DEFAULT_AUTHKEY, report_every: float = 60.):
+        """
+        Accept clients until a client sends "shutdown" or the process is interrupted
+        """
+        if isinstance(address, str) and os.path.exists(address):
+            # stale socket of a previous server
+            os.remove(address)
+        listener = Listener(address, authkey=authkey)
+        print(f"Inference server listening on {address}")
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+        def accept_loop():
+            while not self.stopped.is_set():
+                try:
+                    conn = listener.accept()
+                except AuthenticationError as e:
+                    # e.g. a client with another TA_INFERENCE_SERVER_AUTHKEY, keep serving the others
+                    print(f"Rejected a connection: {e}")
+                    continue
+                except (OSError, EOFError):
+                    continue
+                threading.Thread(target=self._handle_connection, args=(conn,), daemon=True).start()
+
+        threading.Thread(target=accept_loop, daemon=True).start()
+        try:
+            while not self.stopped.wait(report_every):
+                print(self.stats.report())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stopped.set()
+            listener.close()
+            print(self.stats.report())
+
+
+class RemoteModelWrapper(ModelWrapper):
+    """
+    Drop-in TextAttack model wrapper that asks an InferenceServer for the predictions.
+    The connection is opened lazily, once per process.
+    There is no get_grad, gradient based recipes cannot attack it.
+    """
+
+    def __init__(self, address, authkey: bytes = None):
+        self.address = parse_address(address) if isinstance(address, str) else address
+        self.authkey = authkey or get_authkey()
+        self.model = None  # the weights live in the server
+        self._conn = None
+        self._pid = None
+
+    def _get_connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = Client(self.address, authkey=self.authkey)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _request(self, command: str, payload=None):
+        conn = self._get_connection()
+        conn.send((command, payload))
+        result = conn.recv()
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def __call__(self, text_input_list, batch_size=32):
+        # batch_size is ignored, the server decides the batch sizes
+        return self._request("predict", list(text_input_list))
+
+    def get_server_stats(self) -> dict:
+        return self._request("stats")
+
+    def shutdown_server(self):
+        self._request("shutdown")
+
+    def __getstate__(self):
+        # connections cannot be pickled, reconnect in the new process
+        state = self.__dict__.copy()
+        state["_conn"] = None
+        state["_pid"] = None
+        return state
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='Victim model, config.py must be in the same folder')
+    parser.add_argument('--address', type=str, default='/tmp/victim.sock',
+                        help='Unix socket path, or host:port e.g. localhost:6000')
+    parser.add_argument('--max-batch-size', type=int, default=512)
+    parser.add_argument('--max-latency-ms', type=float, default=5.)
+    parser.add_argument('--report-every', type=float, default=60.,
+                        help='Print the throughput and latency stats every n seconds')
+    parser.add_argument('--quantize', action='store_true', default=False,
+                        help='int8 dynamic quantization of an fp32 checkpoint (CPU only)')
+    args = parser.parse_args()
+
+    assert os.environ.get("MODEL_CHOICE") in [
+        "lstm", "transformer"], "env var MODEL_CHOICE must be either lstm or transformer"
+    server = InferenceServer.from_checkpoint(
+        f"{os.path.dirname(args.model_path)}/config.py", args.model_path,
+        max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms,
+        quantize=args.quantize)
+    server.serve_forever(parse_address(args.address), get_authkey(), args.report_every)
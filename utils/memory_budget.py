@@ -0,0 +1,209 @@
+# Memory-budgeted training of deep / wide MyTransformers.
+# The activations stored for backward grow with BATCH_SIZE x NUM_LAYERS (x MAX_SEQ_LENGTH^2 for the
+# L x L attentions), and decide the peak RSS of training on CPU nodes. Two knobs trade time for memory:
+#   CHECKPOINT_LAYERS   encoder layers that only keep their input and recompute the rest in backward
+#   MICRO_BATCH_SIZE    the batch is split into micro-batches whose gradients are accumulated
+#                       (standard training), the update is the same as with the whole batch
+# With Config.MEMORY_BUDGET_MB set, train.py calls plan_memory_budget, which picks both:
+#   - the activation memory per review is measured once per checkpointing policy (none, every
+#     second layer, all layers) on a small probe batch, from the tensors autograd saves for backward,
+#     so planning never allocates the activations of a full batch,
+#   - the peak is estimated as current RSS + gradients and Adam moments of the trainable parameters
+#     + activations of one micro-batch (+ one recomputed layer when checkpointing),
+#   - for every policy, the largest micro-batch whose estimate fits the budget is timed with a
+#     real training step, and the fastest one is used.
+# It prints the candidates with their estimated peak and step time, and the step-time overhead of
+# checkpointing. Standard and embedding adversarial training print the measured peak RSS every epoch.
+#
+# Usage (plan without training):
+# PYTHONPATH=.. MODEL_CHOICE=transformer python utils/memory_budget.py --config-file tran/config.py --budget-mb 8000
+
+import argparse
+import math
+import os
+import resource
+import time
+
+import numpy as np
+import torch
+
+MARGIN = 0.1  # part of the budget kept free for the allocator, data loading and tokenization
+
+
+def get_rss_mb() -> float:
+    """
+    Current resident set size of this process in MB,
+    falls back to the peak RSS where /proc is not available
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            rss_pages = int(f.read().split()[1])
+        return rss_pages * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        return get_peak_rss_mb()
+
+
+def get_peak_rss_mb() -> float:
+    # ru_maxrss is in kB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def checkpoint_policies(model) -> list:
+    """
+    [(name, checkpoint layers)] from the cheapest in time to the cheapest in memory
+    """
+    if not hasattr(model, 'set_checkpoint_layers'):
+        # e.g. MyLSTM, only micro-batches
+        return [("none", [])]
+    num_layers = len(model.layers)
+    policies = [("none", []), ("every second layer", list(range(0, num_layers, 2))),
+                ("all layers", list(range(num_layers)))]
+    # with one layer, every second layer is all layers
+    return [policy for i, policy in enumerate(policies) if policy[1] not in [p[1] for p in policies[:i]]]
+
+
+def _random_batch(model, batch_size: int, seq_len: int, device):
+    ids = torch.randint(1, model.embedding.num_embeddings, (batch_size, seq_len), device=device)
+    labels = torch.randint(0, 2, (batch_size, 1), device=device).float()
+    return ids, labels
+
+
+def _reset_regularization(model):
+    # e.g. ReLU value attention sums a regularization term in every forward
+    for module in model.modules():
+        if hasattr(module, 'reset_regularization'):
+            module.reset_regularization()
+
+
+def saved_activation_mb(model, batch_size: int, seq_len: int, device) -> float:
+    """
+    MB of the tensors autograd saves for backward in one training forward,
+    not counting the parameters and buffers
+    """
+    static = {tensor.untyped_storage().data_ptr() for tensor in list(model.parameters()) + list(model.buffers())}
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in static:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    ids, _ = _random_batch(model, batch_size, seq_len, device)
+    model.train()
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        outputs = model(ids)
+    del outputs
+    _reset_regularization(model)
+    return sum(saved.values()) / 1024 ** 2
+
+
+def time_step(model, batch_size: int, seq_len: int, device, repeats: int = 2) -> float:
+    """
+    Median seconds of a forward and backward pass of batch_size random reviews
+    """
+    criterion = torch.nn.BCEWithLogitsLoss()
+    ids, labels = _random_batch(model, batch_size, seq_len, device)
+    model.train()
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        criterion(model(ids), labels).backward()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start_time)
+        model.zero_grad(set_to_none=True)
+    _reset_regularization(model)
+    return float(np.median(times))
+
+
+def plan_memory_budget(model, Config, device, budget_mb: float, allow_micro_batches: bool = True,
+                       probe_batch_size: int = 8) -> dict:
+    """
+    Pick the checkpointing policy and micro-batch size of the fastest training step whose
+    estimated peak memory fits budget_mb, apply the policy to the model and
+    return {"checkpoint_layers", "micro_batch_size", "estimated_peak_mb", "candidates"}
+    """
+    batch_size, seq_len = Config.BATCH_SIZE, Config.MAX_SEQ_LENGTH
+    probe = min(probe_batch_size, batch_size)
+    if device.type == 'cpu':
+        physical_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 1024 ** 2
+        if budget_mb > physical_mb:
+            # the candidates are timed with real steps, they must not swap or be killed
+            print(f"Memory budget {budget_mb:.0f}MB is more than the {physical_mb:.0f}MB of this machine")
+            budget_mb = physical_mb
+    trainable_mb = sum(p.numel() * p.element_size() for p in model.parameters() if p.requires_grad) / 1024 ** 2
+    current_mb = get_rss_mb() if device.type == 'cpu' else torch.cuda.memory_allocated(device) / 1024 ** 2
+    # gradients and the two Adam moments of the trainable parameters
+    static_mb = current_mb + 3 * trainable_mb
+    policies = checkpoint_policies(model)
+    per_review_mb = {}
+    for name, layers in policies:
+        if hasattr(model, 'set_checkpoint_layers'):
+            model.set_checkpoint_layers(layers)
+        per_review_mb[name] = saved_activation_mb(model, probe, seq_len, device) / probe
+    # a checkpointed layer recomputes its own activations in backward, one layer at a time
+    layer_mb = (per_review_mb["none"] - per_review_mb[policies[-1][0]]) / max(len(policies[-1][1]), 1)
+
+    micro_batch_sizes = [batch_size]
+    while allow_micro_batches and micro_batch_sizes[-1] > 1:
+        micro_batch_sizes.append(math.ceil(micro_batch_sizes[-1] / 2))
+    candidates = []
+    for name, layers in policies:
+        for micro_batch_size in micro_batch_sizes:
+            estimate = static_mb + micro_batch_size * (per_review_mb[name] + (layer_mb if layers else 0))
+            candidates.append({"policy": name, "checkpoint_layers": layers, "micro_batch_size": micro_batch_size,
+                               "estimated_peak_mb": estimate, "batch_seconds": None})
+    fitting = {}
+    for candidate in candidates:
+        # the largest micro-batch of every policy that fits
+        if candidate["estimated_peak_mb"] <= budget_mb * (1 - MARGIN) and candidate["policy"] not in fitting:
+            fitting[candidate["policy"]] = candidate
+    for candidate in fitting.values():
+        if hasattr(model, 'set_checkpoint_layers'):
+            model.set_checkpoint_layers(candidate["checkpoint_layers"])
+        num_micro_batches = math.ceil(batch_size / candidate["micro_batch_size"])
+        candidate["batch_seconds"] = time_step(model, candidate["micro_batch_size"], seq_len, device) * num_micro_batches
+    if fitting:
+        chosen = min(fitting.values(), key=lambda candidate: candidate["batch_seconds"])
+    else:
+        chosen = min(candidates, key=lambda candidate: candidate["estimated_peak_mb"])
+        print(f"No setting is estimated to fit {budget_mb:.0f}MB, using the smallest estimate")
+    if hasattr(model, 'set_checkpoint_layers'):
+        model.set_checkpoint_layers(chosen["checkpoint_layers"])
+
+    print(f"Memory budget {budget_mb:.0f}MB: current {current_mb:.0f}MB, "
+          f"parameter gradients and Adam moments {3 * trainable_mb:.0f}MB")
+    for name, _ in policies:
+        print(f"    checkpoint {name}: {per_review_mb[name]:.2f}MB activations per review")
+    for candidate in candidates:
+        if candidate["micro_batch_size"] in [batch_size, chosen["micro_batch_size"]] or candidate["batch_seconds"]:
+            timing = f", {candidate['batch_seconds']:.2f}s per batch" if candidate["batch_seconds"] else ""
+            print(f"    checkpoint {candidate['policy']}, micro-batch {candidate['micro_batch_size']}: "
+                  f"estimated peak {candidate['estimated_peak_mb']:.0f}MB{timing}")
+    if len(policies) > 1:
+        # measured on the probe batch, where every policy fits
+        model.set_checkpoint_layers([])
+        eager_seconds = time_step(model, probe, seq_len, device)
+        model.set_checkpoint_layers(chosen["checkpoint_layers"])
+        overhead = time_step(model, probe, seq_len, device) / eager_seconds - 1
+        print(f"    step-time overhead of checkpoint {chosen['policy']}: {overhead * 100:+.0f}% "
+              f"(batch of {probe})")
+    print(f"Using checkpoint {chosen['policy']} and micro-batch {chosen['micro_batch_size']}, "
+          f"estimated peak {chosen['estimated_peak_mb']:.0f}MB")
+    return {"checkpoint_layers": chosen["checkpoint_layers"], "micro_batch_size": chosen["micro_batch_size"],
+            "estimated_peak_mb": chosen["estimated_peak_mb"], "candidates": candidates}
+
+
+if __name__ == "__main__":
+    from project.utils.model_factory import construct_model_from_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', type=str, required=True)
+    parser.add_argument('--budget-mb', type=float, default=None,
+                        help='Defaults to Config.MEMORY_BUDGET_MB')
+    args = parser.parse_args()
+
+    model, Config, vocab, device = construct_model_from_config(args.config_file)
+    model.to(device)
+    plan_memory_budget(model, Config, device, args.budget_mb or Config.MEMORY_BUDGET_MB)
@@ -0,0 +1,246 @@
+# Compiled inference for MyTransformer and MyLSTM.
+# Eager forward passes pay Python overhead for the shape checks, the per-layer loop and
+# the attention type branching on every call, which dominates with the small batches
+# of attack workloads. CompiledModel wraps an eval-mode model and runs a compiled graph
+# per input shape instead:
+#   trace:   TorchScript graph from torch.jit.trace (torch.jit.script does not support
+#            the attention modules, e.g. nn.Parameter created in forward, class definitions)
+#   compile: torch.compile (TorchDynamo + Inductor)
+# Batches are padded to the next power of two, so attacks with varying batch sizes only
+# build a handful of graphs. The first call of every shape is checked against eager mode,
+# and a model falls back to eager mode if its config is in EAGER_ONLY, if compiling fails
+# or if the outputs differ. Gradients (e.g. gradient-based attacks) always run in eager mode.
+#
+# Usage (parity and latency check, exits with 1 if a compiled graph differs from eager mode by more than --atol):
+# PYTHONPATH=.. MODEL_CHOICE=transformer python utils/model_compiler.py \
+# --model-path tran/baseline/15head/transformer_model_epoch50.pt --backend trace <--csv-folder data/yelp-polarity>
+# <--check-attentions> also compiles a randomly initialized MyTransformer of every attention type,
+# like check_attention_exports of utils/onnx_export.py, the types that fail belong in EAGER_ONLY.
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+BACKENDS = ["trace", "compile"]
+
+# (config attribute, value) -> why these models run in eager mode, e.g. ("ATTENTION_TYPE", "soft").
+# No attention type is known to fail, so none is listed: check_attention_compiles finds the ones
+# that fail with the installed torch, and any other failure falls back to eager mode at runtime.
+EAGER_ONLY = {
+    ("RELU_REGULARIZATION", True): "the ReLU regularization of reva is accumulated as a side effect of forward",
+}
+
+
+def eager_only_reason(Config):
+    """
+    Return why models of this config cannot be compiled, or None
+    """
+    for (attribute, value), reason in EAGER_ONLY.items():
+        if getattr(Config, attribute, None) == value:
+            return reason
+    return None
+
+
+def config_key(Config) -> str:
+    """
+    Key of everything in the config that changes the graph of the model
+    """
+    attributes = ['ATTENTION_TYPE', 'MH_TYPE', 'FFN_TYPE', 'NORM_ATTENTION_TYPE', 'POSITIONAL_ENCODING',
+                  'NUM_LAYERS', 'D_MODEL', 'N_HEAD', 'MAX_SEQ_LENGTH', 'LSTM_NUM_LAYERS', 'LSTM_HIDDEN_SIZE']
+    values = [f"{attribute}={getattr(Config, attribute)}" for attribute in attributes if hasattr(Config, attribute)]
+    return f"{os.environ.get('MODEL_CHOICE')}:" + ",".join(values)
+
+
+def padded_batch_size(batch_size: int) -> int:
+    return 1 << (batch_size - 1).bit_length()
+
+
+class CompiledModel(nn.Module):
+    """
+    Inference-only wrapper that runs a cached compiled graph per (config, input shape)
+    """
+
+    def __init__(self, model, Config, backend: str = "trace", check_parity: bool = True,
+                 atol: float = 1e-4, pad_batch: bool = True):
+        super(CompiledModel, self).__init__()
+        assert backend in BACKENDS, f"backend must be one of {BACKENDS}"
+        self.model = model.eval()
+        self.backend = backend
+        self.config_key = config_key(Config)
+        self.check_parity = check_parity
+        self.atol = atol
+        self.pad_batch = pad_batch
+        self.graphs = {}  # (config key, input shape, dtype, device) -> compiled module, or None for eager
+        self.fallback_reason = eager_only_reason(Config)
+        self._compiled = None  # torch.compile handles every shape with one object
+        if self.fallback_reason:
+            print(f"Running in eager mode: {self.fallback_reason}")
+
+    @property
+    def embedding(self):
+        # ModelWithSigmoid.get_input_embeddings
+        return self.model.embedding
+
+    def _build(self, x):
+        if self.backend == "trace":
+            return torch.jit.trace(self.model, (x,), check_trace=False)
+        if self._compiled is None:
+            self._compiled = torch.compile(self.model)
+        return self._compiled
+
+    def _get_graph(self, x):
+        key = (self.config_key, tuple(x.shape), x.dtype, x.device.type)
+        if key not in self.graphs:
+            try:
+                graph = self._build(x)
+                if self.check_parity:
+                    max_diff = (graph(x) - self.model(x)).abs().max().item()
+                    if max_diff > self.atol:
+                        print(f"{self.backend} output differs from eager mode by {max_diff:.2e} "
+                              f"for input shape {tuple(x.shape)}, using eager mode for it")
+                        graph = None
+            except Exception as e:
+                self.fallback_reason = f"{self.backend} failed ({type(e).__name__}: {str(e).splitlines()[0]})"
+                print(f"Running in eager mode: {self.fallback_reason}")
+                return None
+            self.graphs[key] = graph
+        return self.graphs[key]
+
+    def forward(self, x):
+        if self.fallback_reason or torch.is_grad_enabled() or x.dim() != 2:
+            return self.model(x)
+        batch_size = x.shape[0]
+        if self.pad_batch and padded_batch_size(batch_size) != batch_size:
+            # the rows of a batch are independent in eval mode, padding rows are dropped
+            padding = x.new_zeros((padded_batch_size(batch_size) - batch_size, x.shape[1]))
+            x = torch.cat((x, padding))
+        graph = self._get_graph(x)
+        if graph is None:
+            return self.model(x[:batch_size])
+        return graph(x)[:batch_size]
+
+    def report(self) -> str:
+        if self.fallback_reason:
+            return f"Compiled model: eager mode, {self.fallback_reason}"
+        num_eager = sum(graph is None for graph in self.graphs.values())
+        return (f"Compiled model ({self.backend}): {len(self.graphs) - num_eager} graphs, "
+                f"{num_eager} input shapes in eager mode")
+
+
+def compile_model(model, Config, backend: str = None):
+    """
+    Wrap model in a CompiledModel, or return it unchanged if backend is None
+    """
+    if backend is None:
+        return model
+    return CompiledModel(model, Config, backend)
+
+
+def check_attention_compiles(Config, vocab_size: int, backend: str = "trace", attention_types: list = None,
+                             batch_size: int = 8, atol: float = 1e-4) -> dict:
+    """
+    Compile a randomly initialized MyTransformer of every attention type,
+    return {attention type: "ok" or why it has to run in eager mode}
+    """
+    from project.transformer.my_transformer import MyTransformer
+    from project.utils.onnx_export import ATTENTION_TYPES
+
+    results = {}
+    for attention_type in attention_types or ATTENTION_TYPES:
+        # MyTransformer overwrites Config.ATTENTION_TYPE for transnormer and diagcos
+        AttentionConfig = type("AttentionConfig", (Config,), {"ATTENTION_TYPE": attention_type})
+        model = MyTransformer(AttentionConfig, vocab_size, 1, torch.device('cpu')).eval()
+        compiled_model = CompiledModel(model, AttentionConfig, backend, check_parity=False)
+        x = torch.randint(1, vocab_size, (batch_size, Config.MAX_SEQ_LENGTH))
+        with torch.no_grad():
+            try:
+                graph = compiled_model._get_graph(x)
+                if graph is None:
+                    results[attention_type] = compiled_model.fallback_reason
+                    continue
+                max_diff = (graph(x) - model(x)).abs().max().item()
+            except Exception as e:
+                results[attention_type] = f"failed ({type(e).__name__}: {str(e).splitlines()[0]})"
+                continue
+        results[attention_type] = "ok" if max_diff <= atol else f"max abs diff {max_diff:.2e}"
+    for attention_type, result in results.items():
+        print(f"{attention_type}: {backend} {result}")
+    return results
+
+
+def measure_latency(model, x, repeats: int) -> float:
+    """
+    Median latency in ms of model(x)
+    """
+    latencies = []
+    with torch.no_grad():
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            model(x)
+            latencies.append((time.perf_counter() - start_time) * 1000)
+    return float(np.median(latencies))
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    from project.utils.quantization import load_model_checkpoint
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='Checkpoint, config.py must be in the same folder')
+    parser.add_argument('--backend', type=str, default='trace', choices=BACKENDS)
+    parser.add_argument('--csv-folder', type=str, default=None,
+                        help='Use reviews of {csv_folder}/test.csv, defaults to random token ids')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 8, 32, 200])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--atol', type=float, default=1e-4,
+                        help='Maximum abs difference between compiled and eager outputs')
+    parser.add_argument('--check-attentions', action='store_true', default=False,
+                        help='Also compile a random MyTransformer of every attention type')
+    args = parser.parse_args()
+
+    assert os.environ.get("MODEL_CHOICE") in [
+        "lstm", "transformer"], "env var MODEL_CHOICE must be either lstm or transformer"
+    model, Config, vocab, device = load_model_checkpoint(
+        f"{os.path.dirname(args.model_path)}/config.py", args.model_path)
+    # without the parity check of the first call, a wrong graph is not replaced by eager mode
+    compiled_model = CompiledModel(model, Config, args.backend, check_parity=False, atol=args.atol)
+
+    max_batch_size = max(args.batch_sizes)
+    if args.csv_folder:
+        from project.utils.checkpoint_evaluator import tokenize_dataframe
+        df = pd.read_csv(f'{args.csv_folder}/test.csv').head(max_batch_size)
+        ids, _ = tokenize_dataframe(df, vocab, Config.MAX_SEQ_LENGTH)
+    else:
+        ids = torch.randint(1, len(vocab), (max_batch_size, Config.MAX_SEQ_LENGTH))
+    ids = ids.to(device)
+
+    mismatches = []
+    for batch_size in args.batch_sizes:
+        x = ids[:batch_size]
+        with torch.no_grad():
+            compile_start = time.perf_counter()
+            compiled_output = compiled_model(x)
+            compile_time = time.perf_counter() - compile_start
+            max_diff = (compiled_output - model(x)).abs().max().item()
+        eager_latency = measure_latency(model, x, args.repeats)
+        compiled_latency = measure_latency(compiled_model, x, args.repeats)
+        print(f"Batch size {batch_size}: max abs diff {max_diff:.2e}, first call {compile_time:.2f}s, "
+              f"eager {eager_latency:.2f}ms, {args.backend} {compiled_latency:.2f}ms "
+              f"({eager_latency / compiled_latency:.2f}x)")
+        if max_diff > args.atol:
+            mismatches.append(batch_size)
+    print(compiled_model.report())
+    if args.check_attentions and os.environ["MODEL_CHOICE"] == "transformer":
+        attention_results = check_attention_compiles(
+            Config, len(vocab), args.backend, atol=args.atol)
+        mismatches += [attention_type for attention_type, result in attention_results.items() if result != "ok"]
+    if mismatches:
+        print(f"Parity check failed (atol {args.atol}) for: {mismatches}")
+        sys.exit(1)
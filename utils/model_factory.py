@@ -1,6 +1,5 @@
 # Get model from config file
 import importlib
-import numpy as np
 import pickle
 import torch
 import os
@@ -21,7 +20,11 @@ def validate_config_path(config_path: str):
     return config_path
 
 
-def construct_model_from_config(config_path: str):
+def load_config(config_path: str):
+    """
+    Load the Config class of env var MODEL_CHOICE from a config file,
+    without constructing the model
+    """
     assert os.environ["MODEL_CHOICE"] in [
         'lstm', 'transformer'], "Env var MODEL_CHOICE must be either 'lstm' or 'transformer'"
     # load Config object from config file
@@ -32,31 +35,43 @@ def construct_model_from_config(config_path: str):
     spec.loader.exec_module(config_module)
     if os.environ["MODEL_CHOICE"] == 'lstm':
         Config = config_module.LSTMConfig
-        from project.lstm.my_lstm import MyLSTM
     elif os.environ["MODEL_CHOICE"] == 'transformer':
         Config = config_module.TransformerConfig
-        # from transformer.my_transformer import MyTransformer
-        from project.transformer.my_transformer import MyTransformer
     print(f"Using config {Config.__name__} from {config_path}")
+    return Config
+
 
-    # load custom vocab or GloVe
+def load_vocab(Config):
+    """
+    Load the vocab of Config.WORD_EMBEDDING, without constructing the model
+    """
+    # load custom vocab, or the word2id of the GloVe / paragramcf embedding store
     if Config.WORD_EMBEDDING == 'custom':
         with open(Config.CUSTOM_VOCAB_PATH, 'rb') as f:
             vocab = pickle.load(f)
-    elif Config.WORD_EMBEDDING == 'glove':
-        import torchtext
-        glove = torchtext.vocab.GloVe(
-            name='6B', dim=Config.GLOVE_EMBEDDING_SIZE,
-            cache=Config.GLOVE_CACHE_DIR)
-        vocab = glove
-    elif Config.WORD_EMBEDDING == 'paragramcf':
-        word_list_file = os.path.join(Config.PARAGRAMCF_DIR, 'wordlist.pickle')
-        word2index = np.load(word_list_file, allow_pickle=True)
-        vocab = word2index
+    elif Config.WORD_EMBEDDING in ['glove', 'paragramcf']:
+        from project.utils.embedding_store import load_embedding_store
+        vocab = load_embedding_store(Config).word2id
     else:
         raise ValueError(
             "Config.WORD_EMBEDDING must be one of 'custom', 'glove' and 'paragramcf'")
+    return vocab
+
+
+def construct_model_from_config(config_path: str):
+    Config = load_config(config_path)
+    if os.environ["MODEL_CHOICE"] == 'lstm':
+        from project.lstm.my_lstm import MyLSTM
+    elif os.environ["MODEL_CHOICE"] == 'transformer':
+        # from transformer.my_transformer import MyTransformer
+        from project.transformer.my_transformer import MyTransformer
 
+    vocab = load_vocab(Config)
+    # the pretrained vectors are loaded once and shared with the model
+    embedding_store = None
+    if Config.WORD_EMBEDDING != 'custom':
+        from project.utils.embedding_store import load_embedding_store
+        embedding_store = load_embedding_store(Config)
     device = torch.device(
         'cuda' if Config.USE_GPU and torch.cuda.is_available() else 'cpu')
     print('Using device:', device)
@@ -70,10 +85,10 @@ def construct_model_from_config(config_path: str):
     # define model
     if os.environ["MODEL_CHOICE"] == 'lstm':
         model = MyLSTM(Config=Config, vocab_size=len(
-            vocab), num_classes=1, device=device).to(device)
+            vocab), num_classes=1, device=device, embedding_store=embedding_store).to(device)
     elif os.environ["MODEL_CHOICE"] == 'transformer':
         model = MyTransformer(Config=Config, vocab_size=len(
-            vocab), output_dim=1, device=device).to(device)
+            vocab), output_dim=1, device=device, embedding_store=embedding_store).to(device)
 
     return model, Config, vocab, device
 
@@ -0,0 +1,188 @@
+# ONNX export of victim models and an onnxruntime backed TextAttack model wrapper.
+# export_onnx converts ModelWithSigmoid(MyTransformer / MyLSTM) to an ONNX graph with
+# dynamic batch and sequence axes, so CPU-bound robustness evaluation can run outside
+# the PyTorch eager runtime. OnnxModelWrapper serves it with onnxruntime, and
+# ta_model_loader.py uses it when TA_VICTIM_MODEL_PATH is a .onnx file (config.py in
+# the same folder is still needed for the tokenizer). onnxruntime only runs the forward,
+# so gradient based recipes (GRADIENT_RECIPES in utils/attack_stream.py, i.e. a2t) are
+# rejected for ONNX victims and still need the PyTorch checkpoint.
+# Attentions that are sized by MAX_SEQ_LENGTH (e.g. linformer, paas) only run with
+# the full sequence length, check_attention_exports reports which variants export
+# cleanly, and whether they match PyTorch with other batch sizes and sequence lengths.
+#
+# Usage: PYTHONPATH=.. MODEL_CHOICE=transformer python utils/onnx_export.py \
+# --model-path tran/baseline/15head/transformer_model_epoch50.pt <--check-attentions>
+
+import argparse
+import inspect
+import os
+
+import numpy as np
+import torch
+from textattack.models.wrappers import ModelWrapper
+
+ATTENTION_TYPES = ['dot_product', 'additive', 'paas', 'paas-linear', 'simal1', 'simal2', 'soft',
+                   'linformer', 'cosformer', 'norm', 'diag', 'experiment', 'local', 'robust',
+                   'reva', 'revcos', 'nreva', 'sigva', 'tanhva', 'absva', 'transnormer', 'diagcos']
+
+
+def export_onnx(model, Config, output_path: str, opset: int = 17):
+    """
+    Export ModelWithSigmoid(model) to output_path, input "input_ids" (batch, sequence)
+    int64 token ids, output "probs" (batch, 2)
+    """
+    from project.utils.model_factory import ModelWithSigmoid
+
+    victim = ModelWithSigmoid(model).cpu().eval()
+    if hasattr(model, 'device'):
+        # MyLSTM creates its initial states on self.device
+        model.device = torch.device('cpu')
+    dummy_input = torch.randint(1, 100, (2, Config.MAX_SEQ_LENGTH), dtype=torch.long)
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # dynamic_axes belong to the TorchScript based exporter
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(victim, (dummy_input,), output_path, input_names=["input_ids"],
+                          output_names=["probs"], opset_version=opset,
+                          dynamic_axes={"input_ids": {0: "batch", 1: "sequence"}, "probs": {0: "batch"}},
+                          **kwargs)
+    return output_path
+
+
+def create_session(onnx_path: str, intra_op_threads: int = None, inter_op_threads: int = None,
+                   providers: list = None):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    if inter_op_threads:
+        options.inter_op_num_threads = inter_op_threads
+    return onnxruntime.InferenceSession(onnx_path, options, providers=providers or ["CPUExecutionProvider"])
+
+
+def compare_with_pytorch(session, model, ids) -> float:
+    """
+    Max abs difference of the probabilities of onnxruntime and PyTorch on ids
+    """
+    from project.utils.model_factory import ModelWithSigmoid
+
+    with torch.no_grad():
+        expected = ModelWithSigmoid(model).cpu().eval()(ids).numpy()
+    probs = session.run(["probs"], {"input_ids": ids.numpy()})[0]
+    return float(np.abs(probs - expected).max())
+
+
+def check_onnx_export(onnx_path: str, model, Config, atol: float = 1e-4) -> dict:
+    """
+    Compare an exported model with PyTorch on other batch sizes and a shorter sequence length
+    """
+    session = create_session(onnx_path)
+    result = {}
+    for name, shape in [("batch", (5, Config.MAX_SEQ_LENGTH)), ("sequence", (3, Config.MAX_SEQ_LENGTH // 2))]:
+        ids = torch.randint(1, 100, shape, dtype=torch.long)
+        try:
+            max_diff = compare_with_pytorch(session, model, ids)
+            result[f"dynamic_{name}"] = "ok" if max_diff <= atol else f"max abs diff {max_diff:.2e}"
+        except Exception as e:
+            result[f"dynamic_{name}"] = f"failed ({type(e).__name__})"
+    return result
+
+
+def check_attention_exports(Config, vocab_size: int, output_dir: str, attention_types: list = None) -> dict:
+    """
+    Export a randomly initialized MyTransformer of every attention type,
+    return {attention type: {"export": ..., "dynamic_batch": ..., "dynamic_sequence": ...}}
+    """
+    from project.transformer.my_transformer import MyTransformer
+
+    os.makedirs(output_dir, exist_ok=True)
+    results = {}
+    for attention_type in attention_types or ATTENTION_TYPES:
+        # MyTransformer overwrites Config.ATTENTION_TYPE for transnormer and diagcos
+        AttentionConfig = type("AttentionConfig", (Config,), {"ATTENTION_TYPE": attention_type})
+        model = MyTransformer(AttentionConfig, vocab_size, 1, torch.device('cpu')).eval()
+        onnx_path = os.path.join(output_dir, f"{attention_type}.onnx")
+        try:
+            export_onnx(model, AttentionConfig, onnx_path)
+        except Exception as e:
+            results[attention_type] = {"export": f"failed ({type(e).__name__}: {str(e).splitlines()[0]})"}
+            continue
+        results[attention_type] = {"export": "ok", **check_onnx_export(onnx_path, model, AttentionConfig)}
+    for attention_type, result in results.items():
+        print(f"{attention_type}: " + ", ".join(f"{key} {value}" for key, value in result.items()))
+    return results
+
+
+class OnnxModelWrapper(ModelWrapper):
+    """
+    TextAttack model wrapper of an exported victim model, run by onnxruntime.
+    The session is created lazily, once per process.
+    There is no get_grad, gradient based recipes cannot attack it.
+    """
+
+    def __init__(self, onnx_path: str, tokenizer, intra_op_threads: int = None,
+                 inter_op_threads: int = None, providers: list = None):
+        """
+        :param tokenizer: MyTokenizer of the exported model
+        :param intra_op_threads: threads of one operator, None for the onnxruntime default
+        """
+        self.onnx_path = onnx_path
+        self.tokenizer = tokenizer
+        self.intra_op_threads = intra_op_threads
+        self.inter_op_threads = inter_op_threads
+        self.providers = providers
+        self.model = None  # there is no PyTorch model
+        self._session = None
+        self._pid = None
+
+    def _get_session(self):
+        if self._session is None or self._pid != os.getpid():
+            self._session = create_session(self.onnx_path, self.intra_op_threads,
+                                           self.inter_op_threads, self.providers)
+            self._pid = os.getpid()
+        return self._session
+
+    def __call__(self, text_input_list, batch_size=32):
+        session = self._get_session()
+        ids = np.array(self.tokenizer(list(text_input_list)), dtype=np.int64)
+        outputs = [session.run(["probs"], {"input_ids": ids[start:start + batch_size]})[0]
+                   for start in range(0, len(ids), batch_size)]
+        return np.concatenate(outputs)
+
+    def __getstate__(self):
+        # sessions cannot be pickled, create a new one in the new process
+        state = self.__dict__.copy()
+        state["_session"] = None
+        state["_pid"] = None
+        return state
+
+
+if __name__ == "__main__":
+    from project.utils.quantization import load_model_checkpoint
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='fp32 checkpoint, config.py must be in the same folder')
+    parser.add_argument('--output-path', type=str, default=None,
+                        help='Defaults to {model path without .pt}.onnx')
+    parser.add_argument('--opset', type=int, default=17)
+    parser.add_argument('--check-attentions', action='store_true', default=False,
+                        help='Also check which attention types export cleanly, with the config of the model')
+    args = parser.parse_args()
+
+    assert os.environ.get("MODEL_CHOICE") in [
+        "lstm", "transformer"], "env var MODEL_CHOICE must be either lstm or transformer"
+    model, Config, vocab, device = load_model_checkpoint(
+        f"{os.path.dirname(args.model_path)}/config.py", args.model_path)
+    output_path = args.output_path or f"{args.model_path[:-len('.pt')]}.onnx"
+    export_onnx(model, Config, output_path, args.opset)
+    print(f"Exported model to {output_path}")
+    for check, status in check_onnx_export(output_path, model, Config).items():
+        print(f"{check}: {status}")
+
+    if args.check_attentions:
+        assert os.environ["MODEL_CHOICE"] == "transformer", "attention types only apply to MyTransformer"
+        check_attention_exports(Config, len(vocab), os.path.join(os.path.dirname(output_path), "onnx_check"))
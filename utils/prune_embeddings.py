@@ -0,0 +1,196 @@
+# Corpus-pruned GloVe / paragramcf embedding tables.
+# Only the words that MyTokenizer produces on the Yelp csv files, plus the counter-fitted
+# neighbours an attack can swap in, are ever looked up, but every model (and every
+# checkpoint) holds the full table. This tool keeps
+#   id 0 of the full vocab (the padding id), '<unk>' if there is one,
+#   every token of {csv_folder}/train.csv, val.csv and test.csv,
+#   the top-k synonym index neighbours of those tokens, and their lemmas,
+#   the words of --extra-words-file, e.g. words introduced by other attacks,
+# and writes them in the format of utils/embedding_store.py with new, compact ids:
+#   {name}.vectors.npy  {name}.word2id.pkl  {name}.old_ids.npy (new id -> full vocab id)
+# Set Config.PRUNED_EMBEDDING_DIR to the output folder to use it. Words outside the
+# pruned vocab become id 0 (or '<unk>'). Checkpoints trained with the full table
+# can be converted with --checkpoints.
+#
+# Usage: PYTHONPATH=.. MODEL_CHOICE=transformer python utils/prune_embeddings.py \
+# --config-file tran/config.py --csv-folder data/yelp-polarity --output-dir data/pruned_paragramcf
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+OLD_IDS_SUFFIX = ".old_ids.npy"
+
+
+def _tokenize_unique(texts: list) -> set:
+    from project.utils.tokenizer import tokenize
+    words = set()
+    for text in texts:
+        words.update(tokenize(text))
+    return words
+
+
+def corpus_words(csv_paths: list, num_workers: int = 1, chunk_size: int = 2000) -> set:
+    """
+    Set of the tokens MyTokenizer produces on the reviews of csv_paths
+    """
+    texts = []
+    for csv_path in csv_paths:
+        texts.extend(pd.read_csv(csv_path)['text'].tolist())
+    chunks = [texts[start:start + chunk_size] for start in range(0, len(texts), chunk_size)]
+    words = set()
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            for chunk_words in tqdm(pool.imap_unordered(_tokenize_unique, chunks), total=len(chunks)):
+                words.update(chunk_words)
+    else:
+        for chunk in tqdm(chunks):
+            words.update(_tokenize_unique(chunk))
+    return words
+
+
+def neighbour_words(words: set, Config, k: int) -> set:
+    """
+    Counter-fitted neighbours of words from the synonym index, and their lemmas
+    (attacks swap in the raw neighbour, the tokenizer then lemmatizes it)
+    """
+    from project.utils.synonym_index import SynonymIndex, default_index_dir
+    from project.utils.tokenizer import tokenize
+
+    index_dir = getattr(Config, 'SYNONYM_INDEX_DIR', None) or default_index_dir(Config.PARAGRAMCF_DIR)
+    synonym_index = SynonymIndex.from_paragramcf_dir(Config.PARAGRAMCF_DIR, index_dir)
+    para_ids = np.array([synonym_index.word2index[word] for word in words
+                         if synonym_index.word2index.get(word, len(synonym_index)) < len(synonym_index)],
+                        dtype=np.int64)
+    neighbours = set()
+    for neighbour_id in np.unique(synonym_index.neighbour_ids(para_ids, k)):
+        word = synonym_index.index2word[int(neighbour_id)]
+        neighbours.add(word)
+        neighbours.update(tokenize(word))
+    return neighbours
+
+
+def select_ids(word2id: dict, words: set) -> np.ndarray:
+    """
+    Sorted full vocab ids to keep, id 0 first so that padding keeps its vector
+    """
+    keep = {0}
+    if '<unk>' in word2id:
+        keep.add(word2id['<unk>'])
+    keep.update(word2id[word] for word in words if word in word2id)
+    return np.array(sorted(keep), dtype=np.int64)
+
+
+def prune_store(store, old_ids: np.ndarray) -> tuple:
+    """
+    Return (word2id with new ids, vectors) of the rows old_ids of an EmbeddingStore
+    """
+    old2new = {int(old_id): new_id for new_id, old_id in enumerate(old_ids)}
+    word2id = {word: old2new[old_id] for word, old_id in store.word2id.items() if old_id in old2new}
+    vectors = store.vectors.numpy()[old_ids]
+    return word2id, vectors
+
+
+def load_old_ids(Config) -> np.ndarray:
+    from project.utils.embedding_store import cache_prefix
+    return np.load(cache_prefix(Config) + OLD_IDS_SUFFIX)
+
+
+def remap_neighbour_matrix(nn_matrix: np.ndarray, old_ids: np.ndarray) -> np.ndarray:
+    """
+    Map a (full vocab size, k) neighbour matrix to the pruned ids,
+    neighbours outside the pruned vocab are replaced by the word itself
+    """
+    old2new = np.full(max(len(nn_matrix), int(old_ids.max()) + 1), -1, dtype=np.int64)
+    old2new[old_ids] = np.arange(len(old_ids))
+    pruned = old2new[nn_matrix[old_ids]]
+    own_ids = np.broadcast_to(np.arange(len(old_ids))[:, None], pruned.shape)
+    return np.where(pruned >= 0, pruned, own_ids)
+
+
+def prune_checkpoint(state_dict: dict, old_ids: np.ndarray) -> dict:
+    """
+    Keep the rows old_ids of the embedding table of a full vocab checkpoint
+    """
+    state_dict = dict(state_dict)
+    state_dict['embedding.weight'] = state_dict['embedding.weight'][torch.from_numpy(old_ids)].clone()
+    return state_dict
+
+
+def time_load(prefix: str) -> float:
+    """
+    Seconds to read a store from disk, as nn.Embedding.from_pretrained does
+    """
+    from project.utils.embedding_store import read_cache
+    start_time = time.perf_counter()
+    _, vectors = read_cache(prefix)
+    np.asarray(vectors).sum()
+    return time.perf_counter() - start_time
+
+
+if __name__ == "__main__":
+    from project.utils.embedding_store import (cache_prefix, embedding_name, load_embedding_store,
+                                               write_cache, VECTORS_SUFFIX)
+    from project.utils.model_factory import load_config
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config-file', type=str, required=True,
+                        help='Config of the full embedding, WORD_EMBEDDING must be glove or paragramcf')
+    parser.add_argument('--csv-folder', type=str, required=True)
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--num-neighbours', type=int, default=50,
+                        help='Synonym index neighbours kept per corpus word, 0 to skip')
+    parser.add_argument('--extra-words-file', type=str, default=None,
+                        help='Text file with one extra word to keep per line')
+    parser.add_argument('--checkpoints', type=str, nargs='*', default=[],
+                        help='Full vocab checkpoints to convert to {path without .pt}_pruned.pt')
+    parser.add_argument('--num-workers', type=int, default=os.cpu_count(),
+                        help='Processes that tokenize the corpus')
+    args = parser.parse_args()
+
+    Config = load_config(args.config_file)
+    assert not getattr(Config, 'PRUNED_EMBEDDING_DIR', None), "Config must use the full embedding"
+    store = load_embedding_store(Config)
+
+    csv_paths = [f'{args.csv_folder}/{split}.csv' for split in ['train', 'val', 'test']
+                 if os.path.exists(f'{args.csv_folder}/{split}.csv')]
+    print(f"Tokenizing {csv_paths}")
+    words = corpus_words(csv_paths, args.num_workers)
+    num_corpus_words = len(words)
+    if args.num_neighbours > 0:
+        try:
+            words |= neighbour_words(words, Config, args.num_neighbours)
+        except FileNotFoundError as e:
+            print(f"Keeping no synonym neighbours: {e}")
+    if args.extra_words_file:
+        with open(args.extra_words_file, 'r') as f:
+            words.update(line.strip() for line in f if line.strip())
+    old_ids = select_ids(store.word2id, words)
+
+    word2id, vectors = prune_store(store, old_ids)
+    prefix = os.path.join(args.output_dir, embedding_name(Config))
+    write_cache(prefix, word2id, vectors)
+    np.save(prefix + OLD_IDS_SUFFIX, old_ids)
+
+    for checkpoint in args.checkpoints:
+        pruned_path = f"{checkpoint[:-len('.pt')]}_pruned.pt"
+        torch.save(prune_checkpoint(torch.load(checkpoint, map_location='cpu'), old_ids), pruned_path)
+        print(f"Saved {pruned_path}")
+
+    full_mb = store.vectors.numel() * store.vectors.element_size() / 1024 ** 2
+    pruned_mb = vectors.nbytes / 1024 ** 2
+    covered = sum(word in store.word2id for word in words)
+    print(f"{num_corpus_words} corpus tokens, {len(words)} with neighbours and extra words, "
+          f"{covered} of them in {embedding_name(Config)}")
+    print(f"Rows: {len(store.vectors)} -> {len(vectors)} ({len(vectors) / len(store.vectors) * 100:.2f}%)")
+    print(f"Embedding table: {full_mb:.1f}MB -> {pruned_mb:.1f}MB per model and per checkpoint")
+    full_prefix = cache_prefix(Config)
+    if os.path.exists(full_prefix + VECTORS_SUFFIX):
+        print(f"Load time: {time_load(full_prefix):.3f}s -> {time_load(prefix):.3f}s")
+    print(f"Saved pruned embeddings to {prefix}, set PRUNED_EMBEDDING_DIR = '{args.output_dir}'")
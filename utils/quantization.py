@@ -0,0 +1,170 @@
+# Dynamic int8 quantization of victim / serving models for CPU hosts.
+# The nn.Linear layers of MyTransformer (QKV projections, w_concat, FFN, fc) and the
+# nn.LSTM of MyLSTM get int8 weights, activations are quantized on the fly. The
+# embedding tables stay in fp32. A quantized artifact is saved as
+#   {"quantization": "dynamic_int8", "state_dict": ...}
+# and loaded by building the fp32 model from its config, quantizing it and loading
+# the int8 state dict, so the architecture code stays the single source of truth.
+#
+# Usage: PYTHONPATH=.. MODEL_CHOICE=transformer python utils/quantization.py \
+# --model-path tran/baseline/15head/transformer_model_epoch50.pt --csv-folder data/yelp-polarity
+
+import argparse
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+QUANTIZATION_KEY = "quantization"
+DYNAMIC_INT8 = "dynamic_int8"
+
+
+def quantize_model(model):
+    """
+    int8 dynamic quantization of the Linear and LSTM layers, CPU only
+    """
+    model.eval()
+    return torch.ao.quantization.quantize_dynamic(model, {nn.Linear, nn.LSTM}, dtype=torch.qint8)
+
+
+def save_quantized(model, path: str):
+    torch.save({QUANTIZATION_KEY: DYNAMIC_INT8, "state_dict": model.state_dict()}, path)
+
+
+def is_quantized_checkpoint(checkpoint) -> bool:
+    return isinstance(checkpoint, dict) and checkpoint.get(QUANTIZATION_KEY) == DYNAMIC_INT8
+
+
+def load_model_checkpoint(config_path: str, model_path: str, quantize: bool = False) -> tuple:
+    """
+    Build the model of config_path and load model_path into it, which can be
+    an fp32 checkpoint or a quantized artifact from save_quantized.
+    With quantize=True an fp32 checkpoint is quantized after loading.
+    Return (model, Config, vocab, device) like construct_model_from_config
+    """
+    from project.utils.model_factory import construct_model_from_config
+
+    model, Config, vocab, device = construct_model_from_config(config_path)
+    checkpoint = torch.load(model_path, map_location='cpu')
+    if is_quantized_checkpoint(checkpoint):
+        model = quantize_model(model.cpu())
+        model.load_state_dict(checkpoint["state_dict"])
+        device = torch.device('cpu')
+        print(f"Loaded int8 quantized model from {model_path}")
+    else:
+        model.load_state_dict(checkpoint)
+        if quantize:
+            model = quantize_model(model.cpu())
+            device = torch.device('cpu')
+            print("Quantized model to int8")
+    model.eval()
+    return model, Config, vocab, device
+
+
+def model_size_mb(model) -> float:
+    """
+    Size of the serialized state dict
+    """
+    import io
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell() / 1024 ** 2
+
+
+def evaluate_accuracy(model, ids, labels, batch_size: int = 200) -> tuple:
+    """
+    Return (accuracy, reviews per second) on pre-tokenized data
+    """
+    correct = 0
+    start_time = time.perf_counter()
+    with torch.no_grad():
+        for start in range(0, len(ids), batch_size):
+            outputs = model(ids[start:start + batch_size]).squeeze(1)
+            correct += ((outputs > 0).float() == labels[start:start + batch_size]).sum().item()
+    return correct / len(ids), len(ids) / (time.perf_counter() - start_time)
+
+
+def evaluate_acc_under_attack(model, Config, vocab, texts: list, labels: list,
+                              attack_recipe: str = "textfooler", query_budget: int = 300) -> dict:
+    """
+    In-process TextAttack attack of (truncated) texts, summary in the parse_ta_output format
+    """
+    from project.utils.attack_stream import build_attack_recipe, stream_attack_records
+    from project.utils.cached_model_wrapper import CachedModelWrapper
+    from project.utils.id_attack import summarize_results
+    from project.utils.model_factory import ModelWithSigmoid
+    from project.utils.tokenizer import MyTokenizer
+
+    model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+    model_wrapper = CachedModelWrapper(ModelWithSigmoid(model), model_tokenizer)
+    attack = build_attack_recipe(attack_recipe, model_wrapper)
+    examples = [(model_tokenizer.truncate(text), label) for text, label in zip(texts, labels)]
+    with torch.no_grad():
+        records = list(stream_attack_records(attack, examples, query_budget))
+    return summarize_results(records)
+
+
+def compare_fp32_int8(config_path: str, model_path: str, data_path: str, num_examples: int,
+                      num_attack_examples: int, attack_recipe: str, query_budget: int,
+                      quantized_model=None) -> dict:
+    """
+    Report the accuracy, accuracy under attack, size and speed of the int8 model against fp32
+    """
+    import pandas as pd
+    from project.utils.checkpoint_evaluator import tokenize_dataframe
+
+    fp32_model, Config, vocab, _ = load_model_checkpoint(config_path, model_path)
+    fp32_model = fp32_model.cpu()
+    int8_model = quantized_model if quantized_model is not None else quantize_model(fp32_model)
+    df = pd.read_csv(data_path).head(num_examples).reset_index(drop=True)
+    ids, labels = tokenize_dataframe(df, vocab, Config.MAX_SEQ_LENGTH)
+
+    report = {}
+    for name, model in [("fp32", fp32_model), ("int8", int8_model)]:
+        accuracy, speed = evaluate_accuracy(model, ids, labels, Config.BATCH_SIZE)
+        report[name] = {"accuracy": accuracy, "reviews_per_sec": speed, "size_mb": model_size_mb(model)}
+        if num_attack_examples > 0:
+            attack_df = df.head(num_attack_examples)
+            data = evaluate_acc_under_attack(model, Config, vocab, attack_df['text'].tolist(),
+                                             attack_df['label'].tolist(), attack_recipe, query_budget)
+            report[name]["accuracy_under_attack"] = float(data["accuracy_under_attack"][:-1]) / 100
+        print(f"{name}: {report[name]}")
+
+    print(f"Size: {report['fp32']['size_mb']:.1f}MB -> {report['int8']['size_mb']:.1f}MB, "
+          f"speed: {report['fp32']['reviews_per_sec']:.1f} -> {report['int8']['reviews_per_sec']:.1f} reviews/sec")
+    print(f"Accuracy delta (int8 - fp32): "
+          f"{(report['int8']['accuracy'] - report['fp32']['accuracy']) * 100:+.2f}%")
+    if num_attack_examples > 0:
+        print(f"Accuracy under {attack_recipe} delta (int8 - fp32): "
+              f"{(report['int8']['accuracy_under_attack'] - report['fp32']['accuracy_under_attack']) * 100:+.2f}%")
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model-path', type=str, required=True,
+                        help='fp32 checkpoint, config.py must be in the same folder')
+    parser.add_argument('--output-path', type=str, default=None,
+                        help='Defaults to {model path without .pt}_int8.pt')
+    parser.add_argument('--csv-folder', type=str, default=None,
+                        help='Compare the int8 model with fp32 on {csv_folder}/test.csv')
+    parser.add_argument('--num-examples', type=int, default=5000,
+                        help='Test examples for the accuracy comparison')
+    parser.add_argument('--num-attack-examples', type=int, default=200,
+                        help='Test examples for the accuracy under attack comparison, 0 to skip')
+    parser.add_argument('--attack-recipe', type=str, default='textfooler')
+    parser.add_argument('--query-budget', type=int, default=300)
+    args = parser.parse_args()
+
+    assert os.environ.get("MODEL_CHOICE") in [
+        "lstm", "transformer"], "env var MODEL_CHOICE must be either lstm or transformer"
+    config_path = f"{os.path.dirname(args.model_path)}/config.py"
+    model, Config, vocab, device = load_model_checkpoint(config_path, args.model_path, quantize=True)
+    output_path = args.output_path or f"{args.model_path[:-len('.pt')]}_int8.pt"
+    save_quantized(model, output_path)
+    print(f"Saved int8 model to {output_path}")
+
+    if args.csv_folder:
+        compare_fp32_int8(config_path, args.model_path, f"{args.csv_folder}/test.csv", args.num_examples,
+                          args.num_attack_examples, args.attack_recipe, args.query_budget, model)
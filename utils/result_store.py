@@ -0,0 +1,387 @@
+# Columnar store of per-example attack results.
+# One .npz file per model (model directory + epoch) under the store root, holding
+#   example_ids  int64   (N,)      ids (row numbers) of the attacked examples
+#   recipes      str     (R,)      attack recipes, one row per recipe in the arrays below
+#   outcomes     int8    (R, N)    OUTCOME_* codes, MISSING if a recipe did not attack the example
+#   queries      int32   (R, N)    number of model queries, -1 if unknown
+#   perturbed    float16 (R, N)    perturbed word ratio of successful attacks, 0 otherwise
+#   summary_keys / summary_values  model level numbers, e.g. the standard accuracy from
+#                                  model_selection_result.txt or the aggregates of ta_results_*.csv
+# Overall robustness, confidence intervals and head comparisons are NumPy reductions
+# over these arrays, instead of re-reading csv and txt files row by row.
+#
+# Usage:
+# python utils/result_store.py import --zoo-root vol_folder/model_zoo --store vol_folder/result_store
+# python utils/result_store.py overall --store vol_folder/result_store --key continue/4-layer/trial1/tran/nreva/20head/epoch44
+# python utils/result_store.py best-head --store vol_folder/result_store --rootdir continue/4-layer/trial1/tran/nreva
+# python utils/result_store.py ci --store vol_folder/result_store --arch nreva --best-head 20head
+
+import argparse
+import csv
+import glob
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+OUTCOME_MISSING = -1
+OUTCOME_SKIPPED = 0
+OUTCOME_FAILED = 1  # the model stayed correct under attack
+OUTCOME_SUCCESS = 2
+OUTCOME_CODES = {'k': OUTCOME_SKIPPED, 'f': OUTCOME_FAILED, 's': OUTCOME_SUCCESS}
+
+ATTACKS = ['textbugger', 'textfooler', 'bae', 'deepwordbug', 'pwws', 'a2t']
+HEAD_CONFIGS = ["3head", "5head", "10head", "15head", "20head", "30head"]
+TRIAL_NAMES = ["trial1", "trial2", "trial3"]
+
+# summary keys
+STANDARD_ACCURACY = "standard_accuracy"
+SELECTION_ACC_UNDER_ATTACK = "selection_acc_under_attack"
+SELECTED_EPOCH = "selected_epoch"
+
+
+def recipe_summary_key(recipe: str, column: str) -> str:
+    """
+    e.g. ("textfooler", "Accuracy under attack") -> "textfooler/accuracy_under_attack"
+    """
+    return f"{recipe}/{column.lower().replace(' %', '').replace(' ', '_')}"
+
+
+class ModelResults():
+    """
+    In-memory columns of one model
+    """
+
+    def __init__(self, example_ids=None, recipes=None, outcomes=None, queries=None,
+                 perturbed=None, summary=None):
+        self.example_ids = np.zeros(0, dtype=np.int64) if example_ids is None else example_ids
+        self.recipes = [] if recipes is None else list(recipes)
+        num_examples = len(self.example_ids)
+        shape = (len(self.recipes), num_examples)
+        self.outcomes = np.full(shape, OUTCOME_MISSING, dtype=np.int8) if outcomes is None else outcomes
+        self.queries = np.full(shape, -1, dtype=np.int32) if queries is None else queries
+        self.perturbed = np.zeros(shape, dtype=np.float16) if perturbed is None else perturbed
+        self.summary = {} if summary is None else summary
+
+    def _ensure_examples(self, example_ids: np.ndarray):
+        new_ids = np.setdiff1d(example_ids, self.example_ids)
+        if len(new_ids) == 0:
+            return
+        all_ids = np.union1d(self.example_ids, new_ids)
+        positions = np.searchsorted(all_ids, self.example_ids)
+        for name, fill in [("outcomes", OUTCOME_MISSING), ("queries", -1), ("perturbed", 0)]:
+            old = getattr(self, name)
+            new = np.full((len(self.recipes), len(all_ids)), fill, dtype=old.dtype)
+            new[:, positions] = old
+            setattr(self, name, new)
+        self.example_ids = all_ids
+
+    def _ensure_recipe(self, recipe: str) -> int:
+        if recipe not in self.recipes:
+            self.recipes.append(recipe)
+            num_examples = len(self.example_ids)
+            self.outcomes = np.vstack([self.outcomes, np.full((1, num_examples), OUTCOME_MISSING, np.int8)])
+            self.queries = np.vstack([self.queries, np.full((1, num_examples), -1, np.int32)])
+            self.perturbed = np.vstack([self.perturbed, np.zeros((1, num_examples), np.float16)])
+        return self.recipes.index(recipe)
+
+    def set_recipe(self, recipe: str, example_ids, outcomes, queries=None, perturbed=None):
+        """
+        :param outcomes: 's'/'f'/'k' strings or OUTCOME_* codes
+        """
+        example_ids = np.asarray(example_ids, dtype=np.int64)
+        outcomes = np.asarray([OUTCOME_CODES[o] if isinstance(o, str) else o for o in outcomes], dtype=np.int8)
+        self._ensure_examples(example_ids)
+        row = self._ensure_recipe(recipe)
+        positions = np.searchsorted(self.example_ids, example_ids)
+        self.outcomes[row, positions] = outcomes
+        if queries is not None:
+            self.queries[row, positions] = np.asarray(queries, dtype=np.int32)
+        if perturbed is not None:
+            self.perturbed[row, positions] = np.asarray(perturbed, dtype=np.float16)
+
+    def outcome_matrix(self, recipes: list = None) -> np.ndarray:
+        """
+        (len(recipes), N) outcome codes, in the order of recipes
+        """
+        recipes = recipes or self.recipes
+        missing = [recipe for recipe in recipes if recipe not in self.recipes]
+        if missing:
+            raise ValueError(f"No per example results of {missing}, have {self.recipes}")
+        return self.outcomes[[self.recipes.index(recipe) for recipe in recipes]]
+
+
+class ResultStore():
+    """
+    Directory of ModelResults, keyed by model directory (relative to the model zoo) + epoch
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, f"{key}.npz")
+
+    def keys(self, prefix: str = "") -> list:
+        paths = glob.glob(os.path.join(self.root, prefix, "**", "*.npz"), recursive=True)
+        # skip the temporary files of interrupted saves
+        return sorted(os.path.relpath(path, self.root)[:-len(".npz")] for path in paths
+                      if not path.endswith(".tmp.npz"))
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self._path(key))
+
+    def load(self, key: str) -> ModelResults:
+        if not self.exists(key):
+            return ModelResults()
+        with np.load(self._path(key), allow_pickle=False) as data:
+            summary = dict(zip(data["summary_keys"].tolist(), data["summary_values"].tolist()))
+            return ModelResults(data["example_ids"], data["recipes"].tolist(), data["outcomes"],
+                                data["queries"], data["perturbed"], summary)
+
+    def save(self, key: str, results: ModelResults):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            example_ids=results.example_ids,
+            recipes=np.array(results.recipes, dtype=str),
+            outcomes=results.outcomes,
+            queries=results.queries,
+            perturbed=results.perturbed,
+            summary_keys=np.array(list(results.summary.keys()), dtype=str),
+            summary_values=np.array(list(results.summary.values()), dtype=np.float64))
+        os.replace(tmp_path, path)
+
+    def summary_matrix(self, keys: list, summary_keys: list) -> np.ndarray:
+        """
+        (len(keys), len(summary_keys)) float array, nan where a number is missing
+        """
+        matrix = np.full((len(keys), len(summary_keys)), np.nan)
+        for i, key in enumerate(keys):
+            summary = self.load(key).summary
+            for j, summary_key in enumerate(summary_keys):
+                matrix[i, j] = summary.get(summary_key, np.nan)
+        return matrix
+
+
+# Vectorized reductions
+
+def overall_robustness(outcomes: np.ndarray) -> tuple:
+    """
+    :param outcomes: (num_recipes, N) outcome codes
+    Return (overall robustness accuracy, cumulative accuracy after each recipe),
+    an example is robust only if every attack failed on it
+    """
+    robust = np.logical_and.accumulate(outcomes == OUTCOME_FAILED, axis=0)
+    cumulative = robust.mean(axis=1)
+    return float(cumulative[-1]), cumulative
+
+
+def calculate_ci(values: np.ndarray, axis: int = 0) -> tuple:
+    """
+    Mean and 95% confidence interval along axis, same formula as utils/calculate_ci.calculate_ci
+    """
+    values = np.asarray(values, dtype=np.float64)
+    mean = values.mean(axis=axis)
+    ci = 1.96 * values.std(axis=axis) / np.sqrt(values.shape[axis])
+    return mean, ci
+
+
+def recipe_accuracies(results: ModelResults) -> dict:
+    """
+    Accuracy under attack of every recipe from the per example outcomes
+    """
+    attacked = results.outcomes != OUTCOME_MISSING
+    failed = (results.outcomes == OUTCOME_FAILED).sum(axis=1)
+    accuracies = failed / np.maximum(attacked.sum(axis=1), 1)
+    return dict(zip(results.recipes, accuracies.tolist()))
+
+
+def best_head(store: ResultStore, rootdir: str, heads: list = HEAD_CONFIGS) -> tuple:
+    """
+    Same choice as utils/find_best_head.py, from the stored model selection results.
+    Return (best head, sums of standard accuracy and accuracy under attack per head)
+    """
+    keys = [f"{rootdir}/{head}/selection" for head in heads]
+    matrix = store.summary_matrix(keys, [STANDARD_ACCURACY, SELECTION_ACC_UNDER_ATTACK])
+    if np.isnan(matrix).any():
+        missing = [key for key, row in zip(keys, matrix) if np.isnan(row).any()]
+        raise ValueError(f"Missing model selection results for {missing}")
+    sums = matrix.sum(axis=1)
+    return heads[int(np.argmax(sums))], dict(zip(heads, sums.tolist()))
+
+
+def ci_over_trials(store: ResultStore, zoo_prefix: str, arch: str, head: str,
+                   trials: list = TRIAL_NAMES, recipes: list = ATTACKS) -> tuple:
+    """
+    Same numbers as utils/calculate_ci.find_ci_from_rootdir, from the stored ta_results aggregates.
+    Return (std_acc_mean, std_acc_ci, acc_under_attack_mean, acc_under_attack_ci) in percent
+    """
+    columns = [recipe_summary_key(recipe, "Original accuracy") for recipe in recipes] + \
+        [recipe_summary_key(recipe, "Accuracy under attack") for recipe in recipes]
+    keys = []
+    for trial in trials:
+        head_dir = f"{zoo_prefix}/{trial}/tran/{arch}/{head}"
+        # the first model of the head directory that has ta_results, like find_ci_from_rootdir
+        trial_keys = [key for key in store.keys(head_dir)
+                      if os.path.dirname(key) == head_dir and columns[0] in store.load(key).summary]
+        if not trial_keys:
+            raise ValueError(f"No ta_results found for {head_dir}, did you run the test?")
+        keys.append(trial_keys[0])
+    matrix = store.summary_matrix(keys, columns)
+    if np.isnan(matrix).any():
+        raise ValueError(f"Incomplete ta_results in {keys}, did the test finish?")
+    # original accuracy is the same for all recipes, accuracy under attack is averaged over recipes
+    std_acc = matrix[:, 0]
+    acc_under_attack = matrix[:, len(recipes):].mean(axis=1)
+    std_acc_mean, std_acc_ci = calculate_ci(std_acc)
+    acc_under_attack_mean, acc_under_attack_ci = calculate_ci(acc_under_attack)
+    return std_acc_mean, std_acc_ci, acc_under_attack_mean, acc_under_attack_ci
+
+
+# Importers for the existing outputs
+
+def _percent(value: str) -> float:
+    # "66.67%" -> 66.67
+    return float(str(value).strip().rstrip('%'))
+
+
+def import_model_selection_txt(store: ResultStore, key: str, txt_path: str):
+    """
+    model_selection_result.txt -> summary of {key}/selection
+    """
+    with open(txt_path, 'r') as f:
+        lines = f.readlines()
+    epoch = re.search(r":\s*(\d+)", lines[0])
+    numbers = lines[1][lines[1].find("(") + 1:lines[1].find(")")].split(",")
+    results = store.load(key)
+    results.summary[STANDARD_ACCURACY] = float(numbers[0].replace("np.float64(", ""))
+    results.summary[SELECTION_ACC_UNDER_ATTACK] = float(numbers[1].replace("np.float64(", ""))
+    if epoch:
+        results.summary[SELECTED_EPOCH] = float(epoch.group(1))
+    store.save(key, results)
+
+
+def import_ta_results_csv(store: ResultStore, key: str, csv_path: str):
+    """
+    ta_results_{epoch}.csv (write_to_csv format) -> per recipe aggregates in the summary of key
+    """
+    df = pd.read_csv(csv_path)
+    results = store.load(key)
+    for _, row in df.iterrows():
+        for column in ["Accuracy under attack", "Attack success rate",
+                       "Average perturbed word %", "Original accuracy"]:
+            results.summary[recipe_summary_key(row["Attack Recipe"], column)] = _percent(row[column])
+    store.save(key, results)
+
+
+def import_attack_details(store: ResultStore, key: str, details_dir: str):
+    """
+    attack_details/{epoch}/{recipe}.csv with one s/f/k per row -> per example outcomes
+    """
+    results = store.load(key)
+    for csv_path in sorted(glob.glob(os.path.join(details_dir, "*.csv"))):
+        recipe = os.path.splitext(os.path.basename(csv_path))[0]
+        with open(csv_path, 'r') as f:
+            outcomes = [row[0] for row in csv.reader(f) if row]
+        results.set_recipe(recipe, np.arange(len(outcomes)), outcomes)
+    store.save(key, results)
+
+
+def import_attack_shards(store: ResultStore, key: str, shard_dir: str):
+    """
+    Shards of utils/attack_runner.py ({recipe}_{shard}.jsonl) -> per example outcomes,
+    queries and perturbed word ratios
+    """
+    results = store.load(key)
+    shards = {}
+    for path in sorted(glob.glob(os.path.join(shard_dir, "*.jsonl"))):
+        recipe, shard_idx = os.path.basename(path)[:-len(".jsonl")].rsplit("_", 1)
+        shards.setdefault(recipe, []).append(path)
+    for recipe, paths in shards.items():
+        records = []
+        for path in sorted(paths):
+            with open(path, 'r') as f:
+                records.extend(json.loads(line) for line in f if line.strip())
+        results.set_recipe(recipe, np.arange(len(records)), [r["outcome"] for r in records],
+                           [r["queries"] for r in records], [r["perturbed_word_ratio"] for r in records])
+    store.save(key, results)
+
+
+def import_model_zoo(zoo_root: str, store: ResultStore) -> int:
+    """
+    Walk a model zoo and import every result file found, return the number of files imported
+    """
+    num_imported = 0
+    for dirpath, dirnames, filenames in os.walk(zoo_root):
+        rel_dir = os.path.relpath(dirpath, zoo_root)
+        if "attack_details" in rel_dir.split(os.sep):
+            continue
+        if "model_selection_result.txt" in filenames:
+            import_model_selection_txt(store, f"{rel_dir}/selection",
+                                       os.path.join(dirpath, "model_selection_result.txt"))
+            num_imported += 1
+        for filename in filenames:
+            match = re.match(r"ta_results_(.+)\.csv$", filename)
+            if match:
+                import_ta_results_csv(store, f"{rel_dir}/{match.group(1)}", os.path.join(dirpath, filename))
+                num_imported += 1
+        for dirname in dirnames:
+            match = re.match(r"ta_results_(.+)_shards$", dirname)
+            if match:
+                import_attack_shards(store, f"{rel_dir}/{match.group(1)}", os.path.join(dirpath, dirname))
+                num_imported += 1
+        details_root = os.path.join(dirpath, "attack_details")
+        if os.path.isdir(details_root):
+            for epoch in sorted(os.listdir(details_root)):
+                import_attack_details(store, f"{rel_dir}/{epoch}", os.path.join(details_root, epoch))
+                num_imported += 1
+    return num_imported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['import', 'overall', 'best-head', 'ci', 'show'])
+    parser.add_argument('--store', type=str, required=True, help='Root directory of the result store')
+    parser.add_argument('--zoo-root', type=str, help='Model zoo to import, for import')
+    parser.add_argument('--key', type=str, help='Model key, e.g. continue/4-layer/trial1/tran/nreva/20head/epoch44')
+    parser.add_argument('--rootdir', type=str, help='Architecture directory relative to the zoo, for best-head')
+    parser.add_argument('--zoo-prefix', type=str, default='continue/4-layer', help='For ci')
+    parser.add_argument('--arch', type=str, help='For ci')
+    parser.add_argument('--best-head', type=str, help='For ci')
+    args = parser.parse_args()
+
+    store = ResultStore(args.store)
+    if args.command == 'import':
+        num_imported = import_model_zoo(args.zoo_root, store)
+        print(f"Imported {num_imported} result files into {len(store.keys())} models in {args.store}")
+    elif args.command == 'overall':
+        results = store.load(args.key)
+        accuracy, cumulative = overall_robustness(results.outcome_matrix(ATTACKS))
+        print(f'Number of testing samples: {len(results.example_ids)}')
+        for i, (attack, attack_accuracy) in enumerate(zip(ATTACKS, cumulative)):
+            print(f"{i+1}/{len(ATTACKS)}: After {attack}, overall robustness accuracy: "
+                  f"{attack_accuracy * 100:.2f}%")
+        print(f'Overall robustness accuracy: {accuracy * 100:.2f}%')
+    elif args.command == 'best-head':
+        head, sums = best_head(store, args.rootdir)
+        for head_name, sum_acc in sums.items():
+            print(f"Heads: {head_name}, sum_acc: {sum_acc}")
+        print(f"\nBest head: {head}, best sum acc: {sums[head]}")
+    elif args.command == 'ci':
+        std_acc_mean, std_acc_ci, acc_under_attack_mean, acc_under_attack_ci = ci_over_trials(
+            store, args.zoo_prefix, args.arch, args.best_head)
+        print(f"Architecture: {args.arch}, best_head: {args.best_head}")
+        print(f"Standard accuracy: {std_acc_mean:.2f}% ± {std_acc_ci:.2f}%")
+        print(f"Accuracy under attack: {acc_under_attack_mean:.2f}% ± {acc_under_attack_ci:.2f}%")
+    elif args.command == 'show':
+        results = store.load(args.key)
+        print(f"{len(results.example_ids)} examples, recipes {results.recipes}")
+        for recipe, accuracy in recipe_accuracies(results).items():
+            print(f"{recipe}: accuracy under attack {accuracy * 100:.2f}%")
+        for summary_key, value in sorted(results.summary.items()):
+            print(f"{summary_key}: {value}")
@@ -0,0 +1,266 @@
+# Sharded binary format of the review csv files, with O(1) random access.
+# Every entry point used to pd.read_csv the whole split, and utils/split_csv.py copied the
+# training set into chunk folders for adversarial training. This tool ingests
+# {csv_folder}/{split}.csv once into
+#   {output_dir}/{split}/shard-00000.bin  reviews as uint32 little-endian byte length + UTF-8 bytes
+#   {output_dir}/{split}/offsets.npy      int64 byte offset of every review in its shard
+#   {output_dir}/{split}/labels.npy       int8 label of every review
+#   {output_dir}/{split}/meta.json        number of reviews, reviews per shard, shard files and
+#                                         path, size and mtime of the csv, written last, it marks
+#                                         a complete split
+# ReviewShards memory maps the shards and the index, so opening a split reads nothing, and
+# review i is one slice of shard i // rows_per_shard. select, chunk and sample return views
+# (an array of row numbers) instead of copies, e.g. train.py --train-chunk 3/10 replaces
+# the data/split-for-adv-train/3 folder.
+# open_split returns the ReviewShards of a split when it has been ingested and the DataFrame
+# of {split}.csv otherwise, so train.py, validation.py, test.py, utils/augment.py and the
+# TextAttack dataset loaders accept either folder layout. Shards are only used while their csv
+# is unchanged: when {split}.csv next to them (or the csv they were ingested from) has another
+# size or is newer, has_shards warns and the entry points read the csv instead.
+#
+# Usage: python utils/review_shards.py --csv-folder data/yelp-polarity <--output-dir data/yelp-polarity>
+
+import argparse
+import json
+import mmap
+import os
+import shutil
+import struct
+
+import numpy as np
+import pandas as pd
+import torch
+
+from project.utils.yelp_review_dataset import YelpReviewDataset
+
+SPLITS = ["train", "val", "test"]
+META_FILE = "meta.json"
+LENGTH_PREFIX = struct.Struct("<I")
+
+
+def shard_file(shard: int) -> str:
+    return f"shard-{shard:05d}.bin"
+
+
+def write_split(csv_path: str, split_dir: str, rows_per_shard: int = 100000) -> int:
+    """
+    Ingest a csv file with 'text' and 'label' columns into split_dir,
+    reading rows_per_shard reviews at a time, return the number of reviews
+    """
+    tmp_dir = f"{split_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    offsets, labels, shards = [], [], []
+    # before reading, so that an edit during the ingestion makes the shards stale
+    csv_stat = os.stat(csv_path)
+    for shard, chunk in enumerate(pd.read_csv(csv_path, chunksize=rows_per_shard)):
+        offset = 0
+        with open(os.path.join(tmp_dir, shard_file(shard)), 'wb') as f:
+            for text in chunk['text'].fillna('').astype(str):
+                blob = text.encode('utf-8')
+                f.write(LENGTH_PREFIX.pack(len(blob)))
+                f.write(blob)
+                offsets.append(offset)
+                offset += LENGTH_PREFIX.size + len(blob)
+        labels.append(chunk['label'].to_numpy(dtype=np.int8))
+        shards.append(shard_file(shard))
+    np.save(os.path.join(tmp_dir, "offsets.npy"), np.array(offsets, dtype=np.int64))
+    np.save(os.path.join(tmp_dir, "labels.npy"), np.concatenate(labels) if labels else np.zeros(0, np.int8))
+    with open(os.path.join(tmp_dir, META_FILE), 'w') as f:
+        json.dump({"num_rows": len(offsets), "rows_per_shard": rows_per_shard, "shards": shards,
+                   "source_csv": os.path.abspath(csv_path), "source_size": csv_stat.st_size,
+                   "source_mtime": csv_stat.st_mtime}, f)
+    # replace an older ingestion of the split
+    if os.path.exists(split_dir):
+        shutil.rmtree(split_dir)
+    os.replace(tmp_dir, split_dir)
+    return len(offsets)
+
+
+class ReviewShards():
+    """
+    Read-only sequence of (text, label) of an ingested split, or of a subset of its rows
+    """
+
+    def __init__(self, split_dir: str, rows: np.ndarray = None):
+        """
+        :param rows: row numbers of the split in this view, None for all of them
+        """
+        self.split_dir = split_dir
+        with open(os.path.join(split_dir, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(split_dir, "offsets.npy"), mmap_mode='r')
+        self._labels = np.load(os.path.join(split_dir, "labels.npy"), mmap_mode='r')
+        self.rows = None if rows is None else np.asarray(rows, dtype=np.int64)
+        self._shards = {}  # shard -> mmap, opened on first access
+
+    def __len__(self):
+        return self.meta["num_rows"] if self.rows is None else len(self.rows)
+
+    @property
+    def labels(self) -> np.ndarray:
+        return np.asarray(self._labels if self.rows is None else self._labels[self.rows])
+
+    def _row(self, i: int) -> int:
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"review {i} out of range for {len(self)} reviews")
+        return i if self.rows is None else int(self.rows[i])
+
+    def _shard(self, shard: int):
+        if shard not in self._shards:
+            with open(os.path.join(self.split_dir, self.meta["shards"][shard]), 'rb') as f:
+                self._shards[shard] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shards[shard]
+
+    def text(self, i: int) -> str:
+        row = self._row(i)
+        shard = self._shard(row // self.meta["rows_per_shard"])
+        start = int(self.offsets[row]) + LENGTH_PREFIX.size
+        length, = LENGTH_PREFIX.unpack_from(shard, start - LENGTH_PREFIX.size)
+        return shard[start:start + length].decode('utf-8')
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.text(i), int(self._labels[self._row(i)])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def select(self, indices) -> "ReviewShards":
+        """
+        View of the reviews at positions indices of this view
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        return ReviewShards(self.split_dir, indices if self.rows is None else self.rows[indices])
+
+    def chunk(self, index: int, num_chunks: int) -> "ReviewShards":
+        """
+        View of chunk index (from 0) of num_chunks equal sized chunks,
+        the same rows as folder index + 1 of utils/split_csv.py
+        """
+        chunk_size = len(self) // num_chunks
+        return self.select(np.arange(index * chunk_size, (index + 1) * chunk_size))
+
+    def sample(self, frac: float, seed: int = None) -> "ReviewShards":
+        """
+        View of a random frac of the reviews, like DataFrame.sample(frac=frac)
+        """
+        rng = np.random.default_rng(seed)
+        return self.select(rng.permutation(len(self))[:round(frac * len(self))])
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame({'text': [self.text(i) for i in range(len(self))], 'label': self.labels})
+
+    def __getstate__(self):
+        # mmaps cannot be pickled, e.g. for spawned DataLoader workers, they are opened again
+        state = self.__dict__.copy()
+        state["_shards"] = {}
+        return state
+
+
+class ShardedReviewDataset(YelpReviewDataset):
+    """
+    YelpReviewDataset of a ReviewShards, reviews are read when they are tokenized
+    """
+
+    def __getitem__(self, idx):
+        text, label = self.df[idx]
+        indices = torch.tensor(self.tokenizer(text), dtype=torch.long)
+        return (indices, label, text)
+
+
+def stale_reason(folder: str, split: str):
+    """
+    Why the ingested {folder}/{split} no longer matches its csv, None if it does or there is no csv
+    """
+    with open(os.path.join(folder, split, META_FILE), 'r') as f:
+        meta = json.load(f)
+    csv_path = os.path.join(folder, f"{split}.csv")
+    if not os.path.exists(csv_path):
+        csv_path = meta.get("source_csv")
+        if csv_path is None or not os.path.exists(csv_path):
+            # e.g. only the shards were copied
+            return None
+    if "source_size" not in meta:
+        return f"ingested without a record of {csv_path}"
+    csv_stat = os.stat(csv_path)
+    if csv_stat.st_size != meta["source_size"] or csv_stat.st_mtime > meta["source_mtime"]:
+        return f"{csv_path} changed since it was ingested"
+    return None
+
+
+_warned_stale = set()
+
+
+def has_shards(folder: str, split: str) -> bool:
+    """
+    Whether {folder}/{split} has been ingested from the current {split}.csv
+    """
+    if not os.path.exists(os.path.join(folder, split, META_FILE)):
+        return False
+    reason = stale_reason(folder, split)
+    if reason is not None:
+        if (folder, split) not in _warned_stale:
+            _warned_stale.add((folder, split))
+            print(f"Warning: ignoring the shards of {os.path.join(folder, split)}, {reason}, "
+                  f"reading the csv instead (ingest it again with utils/review_shards.py)")
+        return False
+    return True
+
+
+def open_split(folder: str, split: str):
+    """
+    ReviewShards of {folder}/{split} if it has been ingested, else the DataFrame of {folder}/{split}.csv
+    """
+    if has_shards(folder, split):
+        return ReviewShards(os.path.join(folder, split))
+    # Reset dataframe index so that we can use df.loc[idx, 'text']
+    return pd.read_csv(os.path.join(folder, f"{split}.csv")).reset_index(drop=True)
+
+
+def review_labels(reviews) -> np.ndarray:
+    if isinstance(reviews, ReviewShards):
+        return reviews.labels
+    return reviews['label'].to_numpy()
+
+
+def take_chunk(reviews, index: int, num_chunks: int):
+    """
+    Chunk index (from 0) of num_chunks of a ReviewShards or DataFrame
+    """
+    if isinstance(reviews, ReviewShards):
+        return reviews.chunk(index, num_chunks)
+    chunk_size = len(reviews) // num_chunks
+    return reviews.iloc[index * chunk_size:(index + 1) * chunk_size].reset_index(drop=True)
+
+
+def review_dataset(reviews, vocab, max_seq_length: int) -> YelpReviewDataset:
+    if isinstance(reviews, ReviewShards):
+        return ShardedReviewDataset(reviews, vocab, max_seq_length)
+    return YelpReviewDataset(reviews.reset_index(drop=True), vocab, max_seq_length)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--csv-folder', type=str, required=True)
+    parser.add_argument('--output-dir', type=str, default=None,
+                        help='Defaults to the csv folder, so that open_split picks the shards up')
+    parser.add_argument('--splits', type=str, nargs='+', default=SPLITS)
+    parser.add_argument('--rows-per-shard', type=int, default=100000)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or args.csv_folder
+    for split in args.splits:
+        csv_path = os.path.join(args.csv_folder, f"{split}.csv")
+        if not os.path.exists(csv_path):
+            print(f"Skipping {split}, could not find {csv_path}")
+            continue
+        num_rows = write_split(csv_path, os.path.join(output_dir, split), args.rows_per_shard)
+        shards = ReviewShards(os.path.join(output_dir, split))
+        size_mb = sum(os.path.getsize(os.path.join(shards.split_dir, name))
+                      for name in os.listdir(shards.split_dir)) / 1024 ** 2
+        print(f"{split}: {num_rows} reviews in {len(shards.meta['shards'])} shards, "
+              f"{size_mb:.1f}MB ({os.path.getsize(csv_path) / 1024 ** 2:.1f}MB csv)")
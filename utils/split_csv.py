@@ -1,4 +1,6 @@
 # Split training csv data into equal sized chunks
+# Note: train.py --train-chunk i/n trains on the same rows without copying them,
+# and reads only them when the folder has been ingested with utils/review_shards.py
 # Usage: python utils/split_csv.py --csv-folder data/data300k-with-3stars \
 # --output-dir data/split-for-adv-train
 
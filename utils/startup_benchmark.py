@@ -0,0 +1,81 @@
+# Startup benchmark of the entry points.
+# Imports train.py, test.py and ta_model_loader.py in fresh interpreters with
+# `python -X importtime`, and reports the wall time of the import, the total import
+# time and the slowest top level imports, e.g. to check that standard training does
+# not import TextAttack and that nothing downloads NLTK data at startup.
+# Importing ta_model_loader.py loads the victim model, so it needs --victim-model-path.
+#
+# Usage: PYTHONPATH=.. MODEL_CHOICE=transformer python utils/startup_benchmark.py \
+# <--victim-model-path tran/baseline/15head/transformer_model_epoch50.pt --repeats 3>
+
+import argparse
+import os
+import re
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+ENTRY_POINTS = ["train", "test", "ta_model_loader"]
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)")
+
+
+def parse_importtime(stderr: str) -> list:
+    """
+    Return [(self us, cumulative us, nesting level, module)] of the -X importtime output
+    """
+    imports = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, module = match.groups()
+            imports.append((int(self_us), int(cumulative_us), (len(indent) - 1) // 2, module))
+    return imports
+
+
+def benchmark_import(module: str, env: dict) -> tuple:
+    """
+    Import module in a fresh interpreter, return (wall seconds, importtime records)
+    """
+    start_time = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=PROJECT_ROOT, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start_time
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr.splitlines()[-1]}")
+    return wall, parse_importtime(result.stderr)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entry-points', type=str, nargs='+', default=ENTRY_POINTS)
+    parser.add_argument('--victim-model-path', type=str, default=None,
+                        help='TA_VICTIM_MODEL_PATH for ta_model_loader, skipped without it')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--top', type=int, default=10, help='Number of slowest top level imports to show')
+    args = parser.parse_args()
+
+    env = os.environ.copy()
+    if args.victim_model_path:
+        env["TA_VICTIM_MODEL_PATH"] = os.path.abspath(args.victim_model_path)
+    for module in args.entry_points:
+        if module == "ta_model_loader" and not args.victim_model_path:
+            print(f"Skipping {module}, it needs --victim-model-path")
+            continue
+        walls = []
+        for _ in range(args.repeats):
+            wall, imports = benchmark_import(module, env)
+            walls.append(wall)
+        total_import_s = sum(self_us for self_us, _, _, _ in imports) / 1e6
+        print(f"{module}: {np.median(walls):.2f}s wall (median of {args.repeats}), "
+              f"{total_import_s:.2f}s in {len(imports)} imports")
+        # direct imports of the entry point, the entry point itself is the last record
+        top_level = sorted([record for record in imports if record[2] == 1],
+                           key=lambda record: record[1], reverse=True)
+        for _, cumulative_us, _, name in top_level[:args.top]:
+            print(f"    {cumulative_us / 1e6:7.3f}s  {name}")
+        heavy = [name for name in ["textattack", "matplotlib", "torchtext", "tensorflow", "transformers"]
+                 if any(record[3] == name for record in imports)]
+        print(f"    heavy packages imported: {heavy or 'none'}")
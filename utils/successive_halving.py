@@ -0,0 +1,139 @@
+# Successive-halving model selection.
+# Instead of attacking all validation examples for every candidate epoch, every
+# candidate is attacked on a small shard first. After each round the 95% confidence
+# interval of its accuracy under attack is computed as in utils/calculate_ci.py, and
+# candidates whose best case (upper bound of standard accuracy + accuracy under attack)
+# is below the worst case (lower bound) of the current leader are pruned. The next
+# rounds use growing shards, so the remaining budget goes to the survivors, which
+# end up attacked on all examples like in the full validation.
+
+import numpy as np
+
+from project.utils.calculate_ci import calculate_ci
+
+
+def acc_under_attack_ci(records: list) -> tuple:
+    """
+    Mean and 95% confidence interval of the accuracy under attack of attack records,
+    every example counts 1 if the attack failed (the model stayed correct), else 0
+    """
+    survived = [1. if record["outcome"] == 'f' else 0. for record in records]
+    mean, ci = calculate_ci(survived)
+    # calculate_ci has no width when all outcomes are equal (e.g. on a small first shard),
+    # use the add-one estimate of the proportion as a floor
+    n = len(survived)
+    p = (sum(survived) + 1) / (n + 2)
+    return float(mean), float(max(ci, 1.96 * np.sqrt(p * (1 - p) / n)))
+
+
+def shard_schedule(num_examples: int, initial_shard: int, growth: int) -> list:
+    """
+    Return the (start, end) example ranges of each round,
+    e.g. 1000, 100, 2 -> (0, 100), (100, 300), (300, 700), (700, 1000)
+    """
+    schedule = []
+    start, size = 0, initial_shard
+    while start < num_examples:
+        end = min(start + size, num_examples)
+        schedule.append((start, end))
+        start, size = end, size * growth
+    return schedule
+
+
+class SuccessiveHalvingSelector():
+    """
+    Prune the candidates that are clearly dominated by the sum of
+    standard accuracy and accuracy under attack
+    """
+
+    def __init__(self, standard_accs: dict, attack_fn, num_examples: int = 1000,
+                 initial_shard: int = 100, growth: int = 2, min_survivors: int = 1):
+        """
+        :param standard_accs: {epoch: standard validation accuracy}, the candidates
+        :param attack_fn: attack_fn(epoch, start, end) returns the attack records
+        (dicts with "outcome" and "queries") of examples start to end for that epoch
+        :param min_survivors: never prune below this many candidates
+        """
+        self.standard_accs = standard_accs
+        self.attack_fn = attack_fn
+        self.schedule = shard_schedule(num_examples, initial_shard, growth)
+        self.num_examples = num_examples
+        self.min_survivors = min_survivors
+        self.records = {epoch: [] for epoch in standard_accs}
+        self.pruned_at = {}  # epoch -> number of examples attacked when it was pruned
+
+    def bounds(self, epoch) -> tuple:
+        """
+        (lower, estimate, upper) of standard accuracy + accuracy under attack
+        """
+        mean, ci = acc_under_attack_ci(self.records[epoch])
+        score = self.standard_accs[epoch] + mean
+        return score - ci, score, score + ci
+
+    def _prune(self, survivors: list) -> list:
+        bounds = {epoch: self.bounds(epoch) for epoch in survivors}
+        best_lower = max(lower for lower, _, _ in bounds.values())
+        # keep the min_survivors best estimates whatever their bounds
+        protected = sorted(survivors, key=lambda epoch: bounds[epoch][1], reverse=True)[:self.min_survivors]
+        remaining = []
+        for epoch in survivors:
+            if epoch in protected or bounds[epoch][2] >= best_lower:
+                remaining.append(epoch)
+            else:
+                self.pruned_at[epoch] = len(self.records[epoch])
+        return remaining
+
+    def run(self) -> list:
+        """
+        Return the surviving epochs, attacked on all num_examples
+        (even a single survivor, so that its numbers are comparable with the full validation)
+        """
+        survivors = sorted(self.standard_accs.keys())
+        for round_idx, (start, end) in enumerate(self.schedule):
+            for epoch in survivors:
+                self.records[epoch].extend(self.attack_fn(epoch, start, end))
+            if round_idx < len(self.schedule) - 1:
+                survivors = self._prune(survivors)
+            print(f"Round {round_idx + 1}/{len(self.schedule)}: attacked examples {start}-{end}, "
+                  f"{len(survivors)} candidates left: {survivors}")
+        return survivors
+
+    def get_validation_results(self) -> dict:
+        """
+        {epoch: (standard accuracy, accuracy under attack)} like
+        calculate_all_validation_results, the accuracy under attack of pruned epochs
+        is None, their partial estimates are not comparable with full results
+        """
+        results = {}
+        for epoch in sorted(self.standard_accs.keys()):
+            mean = None
+            if epoch not in self.pruned_at:
+                mean, _ = acc_under_attack_ci(self.records[epoch])
+            results[epoch] = (self.standard_accs[epoch], mean)
+        return results
+
+    def get_examples_attacked(self) -> dict:
+        """
+        {epoch: number of examples attacked}, num_examples for the survivors
+        """
+        return {epoch: len(records) for epoch, records in sorted(self.records.items())}
+
+    def report(self) -> str:
+        queries_used = 0
+        queries_full = 0.
+        examples_used = 0
+        for epoch, records in self.records.items():
+            queries = [record["queries"] for record in records]
+            queries_used += sum(queries)
+            examples_used += len(records)
+            # extrapolate the queries this epoch would have needed on all examples
+            queries_full += np.mean(queries) * self.num_examples if queries else 0
+        saved = queries_full - queries_used
+        lines = [f"Successive halving: attacked {examples_used}/{len(self.records) * self.num_examples} "
+                 f"candidate examples, {queries_used} queries, "
+                 f"about {saved:.0f} queries saved ({saved / max(queries_full, 1) * 100:.2f}%)"]
+        for epoch in sorted(self.records.keys()):
+            lower, estimate, upper = self.bounds(epoch)
+            status = f"pruned after {self.pruned_at[epoch]} examples" if epoch in self.pruned_at else "survived"
+            lines.append(f"Epoch {epoch}: sum {estimate:.4f} [{lower:.4f}, {upper:.4f}], {status}")
+        return "\n".join(lines)
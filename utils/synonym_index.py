@@ -0,0 +1,161 @@
+# Precompute the top-k cosine neighbours of every word in the paragramcf
+# (counter-fitted) vocabulary, and query them without loading the embeddings.
+# The neighbours are stored as memmapped .npy files:
+#   nn_ids.npy   int32   (vocab_size, k)  ids of the neighbours, most similar first
+#   nn_sims.npy  float16 (vocab_size, k)  cosine similarities of the neighbours
+#   meta.json    vocab size, k and the embedding file used
+#
+# Usage: python utils/synonym_index.py --paragramcf /vol/bitbucket/fh422/paragramcf \
+# --output-dir /vol/bitbucket/fh422/paragramcf/synonym_index --k 50
+
+import argparse
+import json
+import os
+import time
+import numpy as np
+from tqdm import tqdm
+
+NN_IDS_FILE = "nn_ids.npy"
+NN_SIMS_FILE = "nn_sims.npy"
+META_FILE = "meta.json"
+
+
+def default_index_dir(paragramcf_dir: str) -> str:
+    return os.path.join(paragramcf_dir, "synonym_index")
+
+
+def build_synonym_index(paragramcf_dir: str, output_dir: str, k: int = 50, block_size: int = 512):
+    """
+    Blocked and vectorized top-k cosine neighbour search over the whole vocabulary.
+    Only a (block_size, vocab_size) similarity matrix is held in memory at a time.
+    """
+    word_embeddings_file = os.path.join(paragramcf_dir, "paragram.npy")
+    embedding_matrix = np.load(word_embeddings_file).astype(np.float32)
+    vocab_size = embedding_matrix.shape[0]
+    if k >= vocab_size:
+        raise ValueError(f"k must be smaller than vocab size {vocab_size}, got {k}")
+    print(f"Building top-{k} neighbour index for embeddings of shape {embedding_matrix.shape}")
+
+    # normalize once so that cosine similarity is a dot product
+    norms = np.linalg.norm(embedding_matrix, axis=1, keepdims=True)
+    embedding_matrix /= np.maximum(norms, 1e-12)
+
+    os.makedirs(output_dir, exist_ok=True)
+    nn_ids = np.lib.format.open_memmap(
+        os.path.join(output_dir, NN_IDS_FILE), mode='w+', dtype=np.int32, shape=(vocab_size, k))
+    nn_sims = np.lib.format.open_memmap(
+        os.path.join(output_dir, NN_SIMS_FILE), mode='w+', dtype=np.float16, shape=(vocab_size, k))
+
+    start_time = time.time()
+    for start in tqdm(range(0, vocab_size, block_size)):
+        end = min(start + block_size, vocab_size)
+        sims = embedding_matrix[start:end] @ embedding_matrix.T  # (block, vocab_size)
+        # a word is not its own neighbour
+        rows = np.arange(end - start)
+        sims[rows, rows + start] = -np.inf
+        # unordered top-k, then sort only those k
+        top_k = np.argpartition(-sims, k, axis=1)[:, :k]
+        top_k_sims = np.take_along_axis(sims, top_k, axis=1)
+        order = np.argsort(-top_k_sims, axis=1)
+        nn_ids[start:end] = np.take_along_axis(top_k, order, axis=1)
+        nn_sims[start:end] = np.take_along_axis(top_k_sims, order, axis=1)
+    nn_ids.flush()
+    nn_sims.flush()
+
+    with open(os.path.join(output_dir, META_FILE), 'w') as f:
+        json.dump({
+            "vocab_size": vocab_size,
+            "k": k,
+            "embedding_file": os.path.abspath(word_embeddings_file),
+        }, f, indent=2)
+    print(f"Built synonym index in {time.time() - start_time:.1f}s, saved to {output_dir}")
+
+
+class SynonymIndex():
+    """
+    O(1) lookups of precomputed counter-fitted neighbours.
+    The arrays are memmapped, so only the rows that are queried are read from disk.
+    """
+
+    def __init__(self, index_dir: str, word2index: dict = None):
+        """
+        :param index_dir: output directory of build_synonym_index
+        :param word2index: optional mapping from words to ids (paragramcf wordlist.pickle),
+        only needed for the word based queries
+        """
+        if not os.path.exists(os.path.join(index_dir, META_FILE)):
+            raise FileNotFoundError(
+                f"Could not find synonym index in {index_dir}, run utils/synonym_index.py first")
+        with open(os.path.join(index_dir, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.k = self.meta["k"]
+        self.nn_ids = np.load(os.path.join(index_dir, NN_IDS_FILE), mmap_mode='r')
+        self.nn_sims = np.load(os.path.join(index_dir, NN_SIMS_FILE), mmap_mode='r')
+        self.word2index = word2index
+        self.index2word = None
+        if word2index is not None:
+            self.index2word = {}
+            for word, index in word2index.items():
+                self.index2word[index] = word
+
+    @classmethod
+    def from_paragramcf_dir(cls, paragramcf_dir: str, index_dir: str = None):
+        """
+        Load the index together with the paragramcf word list (but not the embeddings)
+        """
+        word_list_file = os.path.join(paragramcf_dir, "wordlist.pickle")
+        word2index = np.load(word_list_file, allow_pickle=True)
+        return cls(index_dir or default_index_dir(paragramcf_dir), word2index)
+
+    def __len__(self):
+        return self.meta["vocab_size"]
+
+    def neighbour_ids(self, ids, k: int = None) -> np.ndarray:
+        """
+        Return the neighbour ids of a single id or an array of ids,
+        of shape (*ids.shape, k), most similar first.
+        """
+        k = k or self.k
+        return np.asarray(self.nn_ids[np.asarray(ids)][..., :k])
+
+    def neighbour_sims(self, ids, k: int = None) -> np.ndarray:
+        """
+        Return the cosine similarities that match neighbour_ids()
+        """
+        k = k or self.k
+        return np.asarray(self.nn_sims[np.asarray(ids)][..., :k], dtype=np.float32)
+
+    def neighbours(self, word: str, k: int = None, min_sim: float = None) -> list:
+        """
+        Return a list of (neighbour word, cosine similarity) for a word,
+        or an empty list if the word is out of vocabulary.
+        """
+        if self.word2index is None:
+            raise ValueError("SynonymIndex needs word2index for word based queries")
+        if word not in self.word2index:
+            return []
+        index = self.word2index[word]
+        ids = self.neighbour_ids(index, k)
+        sims = self.neighbour_sims(index, k)
+        result = []
+        for neighbour_id, sim in zip(ids, sims):
+            if min_sim is not None and sim < min_sim:
+                # neighbours are sorted, the rest are less similar
+                break
+            result.append((self.index2word[int(neighbour_id)], float(sim)))
+        return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--paragramcf', type=str, required=True,
+                        help='Folder with paragram.npy and wordlist.pickle')
+    parser.add_argument('--output-dir', type=str,
+                        help='Defaults to {paragramcf}/synonym_index')
+    parser.add_argument('--k', type=int, default=50)
+    parser.add_argument('--block-size', type=int, default=512,
+                        help='Number of words per block of the similarity search')
+    args = parser.parse_args()
+
+    build_synonym_index(args.paragramcf, args.output_dir or default_index_dir(args.paragramcf),
+                        args.k, args.block_size)
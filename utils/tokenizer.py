@@ -1,10 +1,48 @@
-import nltk
 import string
-import torchtext
-from nltk.corpus import stopwords
-from nltk.stem import WordNetLemmatizer
+import sys
 
-nltk.download('punkt')  # Uncomment this line if you haven't downloaded nltk punkt
+# nltk is imported on first use, and its resources are looked up locally,
+# never downloaded: run `python -m nltk.downloader punkt wordnet stopwords`
+# once on a host with internet access and point NLTK_DATA to the result.
+_nltk = {}
+NLTK_RESOURCES = {
+    "punkt": "tokenizers/punkt",
+    "wordnet": "corpora/wordnet",
+    "stopwords": "corpora/stopwords",
+}
+
+
+def _load_nltk(remove_stopwords: bool = False) -> dict:
+    """
+    Import nltk and check that its tokenizer and lemmatizer (and stopwords) work offline
+    """
+    if "word_tokenize" not in _nltk or (remove_stopwords and "stop_words" not in _nltk):
+        import nltk
+        from nltk.stem import WordNetLemmatizer
+        try:
+            _nltk["word_tokenize"] = nltk.word_tokenize
+            _nltk["lemmatizer"] = WordNetLemmatizer()
+            # the resources are only loaded when they are first used
+            _nltk["lemmatizer"].lemmatize(_nltk["word_tokenize"]("resources loaded")[0])
+            if remove_stopwords:
+                from nltk.corpus import stopwords
+                _nltk["stop_words"] = set(stopwords.words('english'))
+        except LookupError as e:
+            _nltk.clear()
+            missing = [name for name, path in NLTK_RESOURCES.items() if not _nltk_has(nltk, path)]
+            raise LookupError(
+                f"NLTK resources {missing} are missing from {nltk.data.path}. They are not downloaded "
+                f"automatically, run `python -m nltk.downloader {' '.join(missing)}` on a host with "
+                f"internet access and set NLTK_DATA to the download folder.") from e
+    return _nltk
+
+
+def _nltk_has(nltk, path: str) -> bool:
+    try:
+        nltk.data.find(path)
+        return True
+    except LookupError:
+        return False
 
 
 def tokenize(text: str, remove_stopwords: bool = False) -> list:
@@ -15,19 +53,57 @@ def tokenize(text: str, remove_stopwords: bool = False) -> list:
     3. Lemmatize each word
     4. Return the cleaned text as a list of strings
     '''
+    nltk_tools = _load_nltk(remove_stopwords)
     text = text.lower()
     # Remove punctuation
     nopunc = [char for char in text if char not in string.punctuation]
     nopunc = ''.join(nopunc)
 
-    lemmatizer = WordNetLemmatizer()
-    tokens = nltk.word_tokenize(nopunc)
+    lemmatizer = nltk_tools["lemmatizer"]
+    tokens = nltk_tools["word_tokenize"](nopunc)
     if remove_stopwords:
-        return [lemmatizer.lemmatize(word) for word in tokens if word not in stopwords.words('english')]
+        return [lemmatizer.lemmatize(word) for word in tokens if word not in nltk_tools["stop_words"]]
     else:
         return [lemmatizer.lemmatize(word) for word in tokens]
 
 
+def truncate_to_seq_length(text: str, seq_length: int, remove_stopwords: bool = False) -> str:
+    '''
+    Cut the text right after its seq_length-th token, so that the model sees
+    the same tokens, but attacks do not waste queries on words beyond MAX_SEQ_LENGTH.
+    Follows the same steps as tokenize() and maps the cutoff back to a character
+    offset of the original text. Return the text unchanged if it is short enough
+    or the tokens cannot be aligned with the text.
+    '''
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # some unicode characters change length when lowercased
+        return text
+    # positions of the characters that survive punctuation removal
+    kept_positions = [i for i, char in enumerate(lowered) if char not in string.punctuation]
+    nopunc = ''.join([lowered[i] for i in kept_positions])
+
+    nltk_tools = _load_nltk(remove_stopwords)
+    tokens = nltk_tools["word_tokenize"](nopunc)
+    if len(tokens) <= seq_length:
+        return text
+    if remove_stopwords:
+        stop_words = nltk_tools["stop_words"]
+    num_tokens = 0
+    cursor = 0
+    for token in tokens:
+        start = nopunc.find(token, cursor)
+        if start < 0:
+            return text
+        cursor = start + len(token)
+        if remove_stopwords and token in stop_words:
+            continue
+        num_tokens += 1
+        if num_tokens == seq_length:
+            return text[:kept_positions[cursor - 1] + 1]
+    return text
+
+
 class MyTokenizer():
     """
     Wrapper for textattack tokenizer
@@ -38,15 +114,18 @@ class MyTokenizer():
         :param vocab: a mapping object/dict from tokens to indices,
         :param remove_stopwords: whether to remove stopwords using nltk
         """
-        if vocab and not isinstance(vocab, torchtext.vocab.Vocab) and not isinstance(
-                vocab, torchtext.vocab.GloVe) and not isinstance(vocab, dict):
+        # torchtext is heavy to import, a vocab can only be a torchtext object if it is already imported
+        torchtext = sys.modules.get("torchtext")
+        is_torchtext_vocab = torchtext is not None and isinstance(vocab, torchtext.vocab.Vocab)
+        is_torchtext_glove = torchtext is not None and isinstance(vocab, torchtext.vocab.GloVe)
+        if vocab and not is_torchtext_vocab and not is_torchtext_glove and not isinstance(vocab, dict):
             raise ValueError(
                 "Vocab must be either torchtext.vocab.Vocab or torchtext.vocab.GloVe or dict")
         # Different vocab object has different ways to get the mappings
-        if isinstance(vocab, torchtext.vocab.Vocab):
+        if is_torchtext_vocab:
             self.word2id = vocab.get_stoi()
             self.id2word = vocab.get_itos()
-        elif isinstance(vocab, torchtext.vocab.GloVe):
+        elif is_torchtext_glove:
             self.word2id = vocab.stoi
             self.id2word = vocab.itos
         elif isinstance(vocab, dict):
@@ -69,6 +148,12 @@ class MyTokenizer():
         '''
         return tokenize(text, self.remove_stopwords)
 
+    def truncate(self, text: str) -> str:
+        """
+        Cut the text after the last token that fits in seq_length
+        """
+        return truncate_to_seq_length(text, self.seq_length, self.remove_stopwords)
+
     def tokens_to_ids(self, token_list: list) -> list:
         """
         Return a list of ids for each token in the list of string tokens.
@@ -0,0 +1,70 @@
+# Truncate reviews to the MAX_SEQ_LENGTH tokens the model can see before attacking,
+# and report how much the attack search space shrinks.
+
+import textattack
+
+
+class TruncationStats():
+    """
+    Count the words an attack can perturb before and after truncation.
+    Word importance ranking (textfooler, pwws, a2t, textbugger, deepwordbug)
+    spends one query per word, so its query count shrinks by the same ratio.
+    """
+
+    def __init__(self):
+        self.num_texts = 0
+        self.num_truncated = 0
+        self.words_before = 0
+        self.words_after = 0
+        self.chars_before = 0
+        self.chars_after = 0
+
+    def update(self, original: str, truncated: str):
+        self.num_texts += 1
+        self.num_truncated += int(len(truncated) < len(original))
+        self.words_before += len(original.split())
+        self.words_after += len(truncated.split())
+        self.chars_before += len(original)
+        self.chars_after += len(truncated)
+
+    def report(self) -> str:
+        if self.num_texts == 0:
+            return "Truncation: no texts"
+        word_reduction = 1 - self.words_after / max(self.words_before, 1)
+        return (f"Truncation: {self.num_truncated}/{self.num_texts} reviews truncated, "
+                f"words {self.words_before} -> {self.words_after} ({word_reduction * 100:.2f}% fewer), "
+                f"chars {self.chars_before} -> {self.chars_after}, "
+                f"word importance queries shrink by about {word_reduction * 100:.2f}%")
+
+
+def truncate_texts(text_lst: list, model_tokenizer, stats: TruncationStats = None) -> list:
+    """
+    Truncate every text to the tokens model_tokenizer keeps (MyTokenizer.truncate)
+    """
+    result = []
+    for text in text_lst:
+        truncated = model_tokenizer.truncate(text)
+        if stats is not None:
+            stats.update(text, truncated)
+        result.append(truncated)
+    return result
+
+
+class TruncatedDataset(textattack.datasets.Dataset):
+    """
+    TextAttack dataset that truncates each review when it is accessed,
+    so only the examples that are actually attacked are tokenized.
+    """
+
+    def __init__(self, dataset, model_tokenizer, **kwargs):
+        super(TruncatedDataset, self).__init__(dataset, **kwargs)
+        self.model_tokenizer = model_tokenizer
+        self.stats = TruncationStats()
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        text, label = self._dataset[i]
+        truncated = self.model_tokenizer.truncate(text)
+        self.stats.update(text, truncated)
+        return self._format_as_dict((truncated, label))
@@ -0,0 +1,56 @@
+# Negative class upsampling at the sampler level.
+# Instead of duplicating negative reviews in the training DataFrame (which copies
+# the review strings and tokenizes the duplicates again), NegativeUpsamplingSampler
+# yields indices of the original dataset: every positive review once, and the negative
+# reviews UPSAMPLE_RATIO times, as whole copies plus a random subset for the fractional
+# part, redrawn every epoch. An epoch has the same length and class balance as before.
+# It only needs the labels, so it works with any map-style dataset, and
+# upsample_indices can feed a batch or bucket sampler directly.
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+
+def upsample_indices(labels: np.ndarray, ratio: float, generator: torch.Generator = None) -> torch.Tensor:
+    """
+    Return the dataset indices of one epoch, positives once and
+    int(num_negatives * ratio) negatives, in label order (not shuffled)
+    """
+    labels = np.asarray(labels)
+    positive = torch.from_numpy(np.nonzero(labels == 1)[0])
+    negative = torch.from_numpy(np.nonzero(labels == 0)[0])
+    num_upsampled = int(len(negative) * ratio)
+    num_copies, num_extra = divmod(num_upsampled, len(negative)) if len(negative) else (0, 0)
+    extra = negative[torch.randperm(len(negative), generator=generator)[:num_extra]]
+    return torch.cat([positive, negative.repeat(num_copies), extra])
+
+
+class NegativeUpsamplingSampler(Sampler):
+    """
+    Sampler that upsamples the negative reviews by ratio, use it as
+    DataLoader(dataset, batch_size, sampler=NegativeUpsamplingSampler(labels, ratio))
+    """
+
+    def __init__(self, labels, ratio: float, shuffle: bool = True, seed: int = None):
+        """
+        :param labels: label of every dataset index, e.g. df['label'].to_numpy()
+        :param ratio: Config.UPSAMPLE_RATIO, 1 means no upsampling
+        """
+        self.labels = np.asarray(labels)
+        self.ratio = ratio
+        self.shuffle = shuffle
+        self.generator = torch.Generator()
+        # follows torch.manual_seed unless a seed is given
+        self.generator.manual_seed(seed if seed is not None else int(torch.randint(2**62, ()).item()))
+        self.num_positive = int((self.labels == 1).sum())
+        self.num_negative = int(int((self.labels == 0).sum()) * ratio)
+
+    def __len__(self):
+        return self.num_positive + self.num_negative
+
+    def __iter__(self):
+        indices = upsample_indices(self.labels, self.ratio, self.generator)
+        if self.shuffle:
+            indices = indices[torch.randperm(len(indices), generator=self.generator)]
+        return iter(indices.tolist())
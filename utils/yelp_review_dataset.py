@@ -21,3 +21,13 @@ class YelpReviewDataset(Dataset):
         label = self.df.loc[idx, 'label']
         # also return text for adversarial training
         return (indices, label, text)
+
+
+def collate_without_text(batch):
+    """
+    collate_fn for when the raw text is not needed (e.g. evaluation),
+    so that worker processes do not pickle every review back to the main process
+    """
+    indices = torch.stack([item[0] for item in batch])
+    labels = torch.tensor([item[1] for item in batch])
+    return indices, labels
@@ -17,8 +17,11 @@ import torch
 import torch.nn as nn
 
 from tqdm import tqdm
-from torch.utils.data import DataLoader
 
+from utils.attack_subset import attack_dataframe
+from utils.data_pipeline import make_dataloader
+from utils.checkpoint_evaluator import MultiCheckpointEvaluator, find_epoch_checkpoints, tokenize_dataframe
+from utils.review_shards import open_split, ReviewShards
 from utils.yelp_review_dataset import YelpReviewDataset
 from utils.model_factory import construct_model_from_config
 from utils.ta_output_parser import parse_ta_output, get_acc_under_attack
@@ -49,8 +52,7 @@ def get_standard_val_acc(epoch, val_dataset, Config, model, device):
         print("Running validation process...")
         # otherwise, we need to do the validation process
         # get dataloader from dataset
-        val_loader = DataLoader(
-            val_dataset, batch_size=Config.BATCH_SIZE, shuffle=False)
+        val_loader = make_dataloader(val_dataset, Config, with_text=False, device=device)
 
         criterion = nn.BCEWithLogitsLoss()
         # val
@@ -59,7 +61,7 @@ def get_standard_val_acc(epoch, val_dataset, Config, model, device):
             total = 0
             total_loss = 0
             TP, TN = 0, 0
-            for data, labels, _ in tqdm(val_loader):
+            for data, labels in tqdm(val_loader):
                 data = data.to(device)
                 labels = labels.unsqueeze(1).float().to(device)
                 outputs = model(data)
@@ -90,6 +92,9 @@ def run_ta_calulate_acc_under_attack(model_path) -> float:
     # run the specific textattack command
     attack = "textfooler"
     num_attack_examples = 1000
+    # ta_data_loader_validation.py attacks the seeded subset of the same validation set
+    os.environ['TA_DATA_FOLDER'] = args.csv_folder
+    os.environ['TA_NUM_EXAMPLES'] = str(num_attack_examples)
     query_budget = 300
     command = f"textattack attack \
         --model-from-file ta_model_loader.py \
@@ -105,6 +110,129 @@ def run_ta_calulate_acc_under_attack(model_path) -> float:
     return get_acc_under_attack(data)
 
 
+def run_native_calculate_acc_under_attack(model, Config, vocab, device, val_data, candidates) -> float:
+    """
+    Fast estimate of the accuracy under attack with the native greedy attack
+    in utils/id_attack.py, on the same examples and query budget as
+    run_ta_calulate_acc_under_attack
+    Note: this is not textfooler, only use it to compare epochs of the same model
+    """
+    from utils.id_attack import native_attack_texts
+    num_attack_examples = 1000
+    query_budget = 300
+    attack_data = attack_dataframe(val_data, num_attack_examples)
+    _, data = native_attack_texts(
+        model, Config, vocab, device, attack_data['text'].tolist(),
+        attack_data['label'].tolist(), query_budget=query_budget, candidates=candidates)
+    print(f"Native attack results: {data}")
+    return get_acc_under_attack(data)
+
+
+class InProcessAttackEvaluator():
+    """
+    Run the same attack as run_ta_calulate_acc_under_attack in this process.
+    The recipe (with its sentence encoder) and the truncated attack examples are
+    built once, every checkpoint is loaded into the same model object, so a sweep
+    only pays the TextAttack startup cost once.
+    """
+
+    def __init__(self, model, Config, vocab, val_data, attack_recipe="textfooler",
+                 num_attack_examples=1000, query_budget=300, model_cache_size=2**15,
+                 attack_cache=None):
+        """
+        :param attack_cache: optional utils/attack_cache.AttackResultCache, examples that were
+        already attacked on the same checkpoint are then taken from it
+        """
+        # textattack is only needed for this evaluator
+        from utils.attack_stream import build_attack_recipe
+        from utils.cached_model_wrapper import CachedModelWrapper
+        from utils.model_factory import ModelWithSigmoid
+        from utils.tokenizer import MyTokenizer
+        from utils.truncation import TruncationStats, truncate_texts
+
+        self.model = model
+        self.attack_recipe = attack_recipe
+        self.query_budget = query_budget
+        self.attack_cache = attack_cache
+        if attack_cache is not None:
+            from utils.attack_cache import vocab_fingerprint
+            self.vocab_fingerprint = vocab_fingerprint(Config)
+        model_tokenizer = MyTokenizer(vocab, Config.MAX_SEQ_LENGTH, remove_stopwords=False)
+        self.model_wrapper = CachedModelWrapper(
+            ModelWithSigmoid(model), model_tokenizer, model_cache_size)
+        self.attack = build_attack_recipe(attack_recipe, self.model_wrapper)
+
+        # same examples as ta_data_loader_validation.py,
+        # truncated to the tokens the model can see
+        attack_data = attack_dataframe(val_data, num_attack_examples)
+        self.truncation_stats = TruncationStats()
+        texts = truncate_texts(attack_data['text'].tolist(), model_tokenizer, self.truncation_stats)
+        self.examples = list(zip(texts, attack_data['label'].tolist()))
+        print(self.truncation_stats.report())
+
+    def attack_examples(self, start=0, end=None, model_path=None) -> list:
+        """
+        Attack examples start to end with the current weights of the model,
+        return their records.
+        :param model_path: checkpoint the current weights were loaded from, needed for the attack cache
+        """
+        examples = self.examples[start:end]
+        if self.attack_cache is None or model_path is None:
+            return self._attack(examples)
+        from utils.attack_cache import file_hash
+        context = (file_hash(model_path), self.attack_recipe, self.query_budget, self.vocab_fingerprint)
+        records = self.attack_cache.attack_with_cache(context, examples, self._attack)
+        print(self.attack_cache.report())
+        return records
+
+    def _attack(self, examples: list) -> list:
+        from utils.attack_stream import stream_attack_records
+
+        # predictions of the previous checkpoint are stale
+        self.model_wrapper.clear_cache()
+        self.model_wrapper.reset_stats()
+        self.model.eval()
+        records = []
+        with torch.no_grad():
+            for record in tqdm(stream_attack_records(self.attack, examples, self.query_budget),
+                               total=len(examples)):
+                records.append(record)
+        return records
+
+    def evaluate(self, model_path=None) -> dict:
+        """
+        Attack the current weights of the model.
+        Return the summary in the format of parse_ta_output (plus avg_num_queries),
+        and the per example records under "records"
+        """
+        from utils.id_attack import summarize_results
+
+        records = self.attack_examples(model_path=model_path)
+        data = summarize_results(records)
+        print(f"{self.attack_recipe} results: {data}")
+        print(self.model_wrapper.report())
+        data["records"] = records
+        return data
+
+
+def run_in_process_calculate_acc_under_attack(evaluator: InProcessAttackEvaluator, model_path=None) -> float:
+    """
+    Calculate the accuracy under attack of the model currently loaded in the evaluator
+    """
+    data = evaluator.evaluate(model_path)
+    return get_acc_under_attack(data)
+
+
+def get_attack_cache(args):
+    """
+    Cache of attack records shared by all epochs (and runs), None if disabled
+    """
+    if args.no_attack_cache:
+        return None
+    from utils.attack_cache import AttackResultCache
+    return AttackResultCache(args.attack_cache or f'{args.output_dir}/attack_cache.sqlite')
+
+
 def find_model_path_for_current_epoch(model, checkpoint_dir, epoch, adversarial) -> str:
     """
     Find the model path for the current epoch
@@ -126,13 +254,10 @@ def find_model_path_for_current_epoch(model, checkpoint_dir, epoch, adversarial)
     return model_path
 
 
-def calculate_all_validation_results(Config, args, checkpoint_dir, vocab, model, device, adversarial=False):
+def get_candidate_epochs(Config, adversarial=False) -> tuple:
     """
-    Top down function to calculate the validation results of every n epochs
+    Return (epochs to validate, total epochs)
     """
-    # create a dict to accumulate the results of every n epochs
-    # dict key: epoch, value: (standard accuracy, accuracy under textfooler)
-    validation_results = {}
     # adversarial training and normal training have different total epochs in Config
     if adversarial:
         if hasattr(Config, 'NUM_ADV_EPOCHS'):
@@ -142,16 +267,6 @@ def calculate_all_validation_results(Config, args, checkpoint_dir, vocab, model,
     else:
         # normal training
         total_epochs = Config.NUM_EPOCHS
-    # create a csv file with header to store the results of every n epochs
-    with open(f'{args.output_dir}/model_selection_result.csv', 'a') as f:
-        writer = csv.writer(f)
-        writer.writerow(
-            [
-                "Epoch",
-                "Standard validation accuracy",
-                "Accuracy under attack",
-            ]
-        )
     # Important Note:
     # when n = 5, it will calculate the validation results of every 5 epochs,
     # when n = 1, it will calculate the validation results of every epoch.
@@ -159,42 +274,169 @@ def calculate_all_validation_results(Config, args, checkpoint_dir, vocab, model,
     # output model in adv-checkpoints folder.
     n = 1 if adversarial else 5
     # we can skip the first n epochs, since they are not well trained
-    for epoch in range(n, total_epochs + 1, n):
-        print(f'\n#####\nValidating epoch {epoch}/{total_epochs}\n#####\n')
+    return range(n, total_epochs + 1, n), total_epochs
+
+
+def load_val_data(args) -> pd.DataFrame:
+    val_data = open_split(args.csv_folder, 'val')
+    if isinstance(val_data, ReviewShards):
+        # the validation set is tokenized as a whole
+        val_data = val_data.to_dataframe()
+    return val_data
 
-        model_path = find_model_path_for_current_epoch(model, checkpoint_dir, epoch, adversarial)
-        # If this epoch is not found, we skip it
-        if not model_path:
-            continue
-        model.eval()
 
-        val_data = pd.read_csv(f'{args.csv_folder}/val.csv')
-        # Reset dataframe index so that we can use df.loc[idx, 'text']
-        val_data = val_data.reset_index(drop=True)
+def calculate_all_standard_val_accs(Config, args, checkpoint_dir, vocab, model, device,
+                                    val_data, epochs, adversarial=False) -> dict:
+    """
+    Return {epoch: standard validation accuracy} of the epochs that have a checkpoint.
+    Unless they are already in {model_choice}_val_accuracy.txt, the standard accuracies
+    of all epochs are evaluated together, with the validation set tokenized once
+    """
+    checkpoints = find_epoch_checkpoints(checkpoint_dir, epochs, adversarial)
+    standard_val_accs = {}
+    if args.sequential_eval or \
+            os.path.exists(f'{args.output_dir}/{os.environ["MODEL_CHOICE"]}_val_accuracy.txt'):
         val_dataset = YelpReviewDataset(val_data, vocab, Config.MAX_SEQ_LENGTH)
+        for epoch in checkpoints:
+            find_model_path_for_current_epoch(model, checkpoint_dir, epoch, adversarial)
+            model.eval()
+            standard_val_accs[epoch] = get_standard_val_acc(epoch, val_dataset, Config, model, device)
+        return standard_val_accs
+    ids, labels = tokenize_dataframe(val_data, vocab, Config.MAX_SEQ_LENGTH)
+    checkpoint_evaluator = MultiCheckpointEvaluator(
+        model, ids, labels, device, Config.BATCH_SIZE, args.eval_group_size)
+    for epoch, (accuracy, loss) in checkpoint_evaluator.evaluate(checkpoints).items():
+        print(f"Epoch {epoch}: Validation Accuracy: {accuracy:.4f}, Validation Loss: {loss:.4f}")
+        standard_val_accs[epoch] = accuracy
+    return standard_val_accs
+
+
+def write_model_selection_csv(args, validation_results: dict, examples_attacked: dict = None,
+                              header: bool = True):
+    """
+    Append to model_selection_result.csv the header (unless header is False) and one row per epoch,
+    with examples_attacked ({epoch: number}) an "Examples attacked" column is added
+    and a missing accuracy under attack is left empty
+    """
+    with open(f'{args.output_dir}/model_selection_result.csv', 'a') as f:
+        writer = csv.writer(f)
+        if header:
+            columns = [
+                "Epoch",
+                "Standard validation accuracy",
+                "Accuracy under attack",
+            ]
+            if examples_attacked is not None:
+                columns.append("Examples attacked")
+            writer.writerow(columns)
+        for epoch, (float_standard_val_acc, float_acc_under_attack) in validation_results.items():
+            row = [
+                epoch,
+                float_standard_val_acc,
+                "" if float_acc_under_attack is None else float_acc_under_attack,
+            ]
+            if examples_attacked is not None:
+                row.append(examples_attacked[epoch])
+            writer.writerow(row)
+
 
-        # calculate the standard accuracy for this epoch
-        float_standard_val_acc = get_standard_val_acc(
-            epoch, val_dataset, Config, model, device)
+def calculate_all_validation_results(Config, args, checkpoint_dir, vocab, model, device, adversarial=False):
+    """
+    Top down function to calculate the validation results of every n epochs
+    """
+    # create a dict to accumulate the results of every n epochs
+    # dict key: epoch, value: (standard accuracy, accuracy under textfooler)
+    validation_results = {}
+    epochs, total_epochs = get_candidate_epochs(Config, adversarial)
+    # create a csv file with header to store the results of every n epochs
+    write_model_selection_csv(args, {})
+    # synonym candidates of the native attack and the in-process attack
+    # are built once for all epochs
+    candidates = None
+    attack_evaluator = None
+    # the validation data is the same for all epochs
+    val_data = load_val_data(args)
+    standard_val_accs = calculate_all_standard_val_accs(
+        Config, args, checkpoint_dir, vocab, model, device, val_data, epochs, adversarial)
+    for epoch in epochs:
+        print(f'\n#####\nValidating epoch {epoch}/{total_epochs}\n#####\n')
+        # If this epoch is not found, we skip it
+        if epoch not in standard_val_accs:
+            continue
+        model_path = find_model_path_for_current_epoch(model, checkpoint_dir, epoch, adversarial)
+        model.eval()
+        float_standard_val_acc = standard_val_accs[epoch]
 
         # now validate the accuracy under attack (textfooler)
-        float_acc_under_attack = run_ta_calulate_acc_under_attack(model_path)
+        if args.native_attack:
+            if candidates is None:
+                from utils.id_attack import load_synonym_candidates
+                candidates = load_synonym_candidates(Config, vocab)
+            float_acc_under_attack = run_native_calculate_acc_under_attack(
+                model, Config, vocab, device, val_data, candidates)
+        elif args.ta_subprocess:
+            float_acc_under_attack = run_ta_calulate_acc_under_attack(model_path)
+        else:
+            if attack_evaluator is None:
+                attack_evaluator = InProcessAttackEvaluator(
+                    model, Config, vocab, val_data, attack_cache=get_attack_cache(args))
+            float_acc_under_attack = run_in_process_calculate_acc_under_attack(attack_evaluator, model_path)
 
         validation_results[epoch] = (
             float_standard_val_acc, float_acc_under_attack)
         # write the results of each epoch to the csv file
-        with open(f'{args.output_dir}/model_selection_result.csv', 'a') as f:
-            writer = csv.writer(f)
-            writer.writerow(
-                [
-                    epoch,
-                    float_standard_val_acc,
-                    float_acc_under_attack,
-                ]
-            )
+        write_model_selection_csv(args, {epoch: validation_results[epoch]}, header=False)
     return validation_results
 
 
+def select_by_successive_halving(Config, args, checkpoint_dir, vocab, model, device, adversarial=False) -> tuple:
+    """
+    Attack every candidate on a small shard first, prune the candidates that are
+    clearly dominated and spend the rest of the attack budget on the survivors.
+    Return (validation results of all candidates, surviving epochs, report),
+    the accuracy under attack of the pruned candidates is None
+    """
+    from utils.successive_halving import SuccessiveHalvingSelector
+
+    epochs, _ = get_candidate_epochs(Config, adversarial)
+    val_data = load_val_data(args)
+    standard_val_accs = calculate_all_standard_val_accs(
+        Config, args, checkpoint_dir, vocab, model, device, val_data, epochs, adversarial)
+    num_attack_examples = 1000
+    query_budget = 300
+    if args.native_attack:
+        from utils.id_attack import load_synonym_candidates, native_attack_texts
+        candidates = load_synonym_candidates(Config, vocab)
+        attack_data = attack_dataframe(val_data, num_attack_examples)
+        texts, labels = attack_data['text'].tolist(), attack_data['label'].tolist()
+
+        def attack_examples(start, end):
+            results, _ = native_attack_texts(
+                model, Config, vocab, device, texts[start:end], labels[start:end],
+                query_budget=query_budget, candidates=candidates)
+            return results
+    else:
+        attack_evaluator = InProcessAttackEvaluator(
+            model, Config, vocab, val_data, num_attack_examples=num_attack_examples,
+            query_budget=query_budget, attack_cache=get_attack_cache(args))
+        attack_examples = attack_evaluator.attack_examples
+
+    def attack_fn(epoch, start, end):
+        print(f'\n#####\nAttacking epoch {epoch}, examples {start}-{end}\n#####\n')
+        model_path = find_model_path_for_current_epoch(model, checkpoint_dir, epoch, adversarial)
+        model.eval()
+        if args.native_attack:
+            return attack_examples(start, end)
+        return attack_examples(start, end, model_path)
+
+    selector = SuccessiveHalvingSelector(
+        standard_val_accs, attack_fn, num_attack_examples, args.halving_initial_shard)
+    survivors = selector.run()
+    validation_results = selector.get_validation_results()
+    write_model_selection_csv(args, validation_results, selector.get_examples_attacked())
+    return validation_results, survivors, selector.report()
+
+
 def find_best_epochs(validation_results):
     """
     Find the best epoch based on 2 strategies:
@@ -208,6 +450,9 @@ def find_best_epochs(validation_results):
     best_epoch_of_sum = 0
     max_sum_of_accuracy = 0
     for epoch, (standard_val_acc, acc_under_attack) in validation_results.items():
+        if acc_under_attack is None:
+            # pruned by successive halving, not attacked on all examples
+            continue
         sum_of_accuracy = standard_val_acc + acc_under_attack
         if sum_of_accuracy > max_sum_of_accuracy:
             max_sum_of_accuracy = sum_of_accuracy
@@ -231,7 +476,32 @@ if __name__ == "__main__":
     parser.add_argument('--output-dir', type=str, default='tmp')
     parser.add_argument('--adversarial', action='store_true', default=False,
                         help='Whether this is an adversarial training run')
+    parser.add_argument('--native-attack', action='store_true', default=False,
+                        help='Estimate the accuracy under attack with the native greedy attack \
+                        in utils/id_attack.py instead of textfooler, much faster but not comparable \
+                        with TextAttack numbers')
+    parser.add_argument('--sequential-eval', action='store_true', default=False,
+                        help='Calculate the standard accuracy one epoch at a time \
+                        instead of evaluating all checkpoints together')
+    parser.add_argument('--eval-group-size', type=int, default=None,
+                        help='Maximum number of checkpoints evaluated in one pass, defaults to all')
+    parser.add_argument('--successive-halving', action='store_true', default=False,
+                        help='Attack every candidate on a small shard first and only attack \
+                        the candidates that are not clearly dominated on all examples')
+    parser.add_argument('--halving-initial-shard', type=int, default=100,
+                        help='Number of examples of the first successive halving round')
+    parser.add_argument('--attack-cache', type=str, default=None,
+                        help='sqlite file of cached attack records, defaults to {output_dir}/attack_cache.sqlite, \
+                        can be shared between model directories')
+    parser.add_argument('--no-attack-cache', action='store_true', default=False,
+                        help='Attack every example again instead of using cached records')
+    parser.add_argument('--ta-subprocess', action='store_true', default=False,
+                        help='Run every textfooler attack through the textattack CLI in a subprocess \
+                        instead of in this process, not with --successive-halving')
     args = parser.parse_args()
+    if args.successive_halving and args.ta_subprocess:
+        # the shards of successive halving are attacked in process
+        raise ValueError("--ta-subprocess is not supported with --successive-halving")
 
     # default config file to output_dir/config.py
     config_path = f'{args.output_dir}/config.py'
@@ -241,13 +511,23 @@ if __name__ == "__main__":
 
     model, Config, vocab, device = construct_model_from_config(config_path)
 
-    # calculate the validation results of every n epochs
-    validation_results = calculate_all_validation_results(
-        Config, args, checkpoint_dir, vocab, model, device, args.adversarial)
+    halving_report = None
+    if args.successive_halving:
+        validation_results, survivors, halving_report = select_by_successive_halving(
+            Config, args, checkpoint_dir, vocab, model, device, args.adversarial)
+        # only the survivors are attacked on all examples, the standard accuracy
+        # is known for every candidate
+        best_epoch_of_sum, _ = find_best_epochs(
+            {epoch: validation_results[epoch] for epoch in survivors})
+        _, best_epoch_of_standard = find_best_epochs(validation_results)
+    else:
+        # calculate the validation results of every n epochs
+        validation_results = calculate_all_validation_results(
+            Config, args, checkpoint_dir, vocab, model, device, args.adversarial)
 
-    # in the end, we find the best epoch based on the sum of two metrics:
-    best_epoch_of_sum, best_epoch_of_standard = find_best_epochs(
-        validation_results)
+        # in the end, we find the best epoch based on the sum of two metrics:
+        best_epoch_of_sum, best_epoch_of_standard = find_best_epochs(
+            validation_results)
 
     # output the best epochs and their accuracy to a txt file in output_dir
     with open(f'{args.output_dir}/model_selection_result.txt', 'w') as f:
@@ -257,8 +537,13 @@ if __name__ == "__main__":
             f'Standard accuracy and accuracy under attack for 1.: {validation_results[best_epoch_of_sum]}\n')
         f.write(
             f'2. Best epoch based on standard accuracy: {best_epoch_of_standard}\n')
+        pruned_note = ' (pruned by successive halving, accuracy under attack not measured on all examples)' \
+            if validation_results[best_epoch_of_standard][1] is None else ''
         f.write(
-            f'Standard accuracy and accuracy under attack for 2.: {validation_results[best_epoch_of_standard]}\n')
+            f'Standard accuracy and accuracy under attack for 2.: '
+            f'{validation_results[best_epoch_of_standard]}{pruned_note}\n')
+        if halving_report:
+            f.write(f'{halving_report}\n')
 
     # print the best epochs and their accuracy
     with open(f'{args.output_dir}/model_selection_result.txt', 'r') as f: